@@ -0,0 +1,152 @@
+"""A local copy of the shift4shop product catalog"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger("shift4shopcatalog")
+
+# how old the local catalog can get before a poll syncs it again
+CATALOG_MAX_AGE_SECONDS = 60 * 60
+# how many products to look up at once when refreshing the ones that just sold
+MAX_DETAIL_REQUESTS = 4
+# a product that sold is looked up again if we haven't fetched it in this long, so a
+# burst of sales, or the same sale from a webhook and a poll, shares one lookup
+PRODUCT_MAX_AGE_SECONDS = 60
+
+FetchProducts = Callable[[], Iterator[Dict[str, Any]]]
+# catalog id -> that product, None if it doesn't exist anymore
+FetchProduct = Callable[[str], Optional[Dict[str, Any]]]
+
+
+class Shift4ShopCatalog:
+    """
+    Product names and stock from the shift4shop catalog, stored in a json file keyed by
+    catalog id. Shift4Shop has no way to ask for just what changed, so a sync pages
+    through every product, and products that just sold are refreshed one by one if
+    what we have for them is out of date.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.synced_at_unix = 0.0
+        # catalog id -> {"name": ..., "stock": ...}
+        self.products: Dict[str, Dict[str, Any]] = {}
+        # catalog id -> when it was last refreshed on its own, otherwise synced_at_unix
+        self.refreshed_at: Dict[str, float] = {}
+        # the webhook server shares one catalog between its threads, so changes and
+        # saves take turns
+        self._lock = threading.Lock()
+        self._load()
+
+    def lookup(self, catalog_id: Any) -> Optional[Dict[str, Any]]:
+        return self.products.get(str(catalog_id))
+
+    def is_stale(self, max_age: float = CATALOG_MAX_AGE_SECONDS) -> bool:
+        return time.time() - self.synced_at_unix > max_age
+
+    def sync(self, fetch_products: FetchProducts) -> int:
+        """Replace the catalog with every product, returning how many there are"""
+        logger.info("syncing shift4shop catalog")
+        products = {}
+        for product in fetch_products():
+            catalog_id, entry = self._entry(product)
+            products[catalog_id] = entry
+        with self._lock:
+            self.products = products
+            self.synced_at_unix = time.time()
+            self.refreshed_at = {}
+            self._save()
+        logger.info(f"synced {len(products)} shift4shop products")
+        return len(products)
+
+    def stale(
+        self, catalog_ids: Iterable[Any], max_age: float = PRODUCT_MAX_AGE_SECONDS
+    ) -> List[str]:
+        """The catalog ids we don't have, or haven't fetched within max_age"""
+        now = time.time()
+        with self._lock:
+            return sorted(
+                catalog_id
+                for catalog_id in {str(catalog_id) for catalog_id in catalog_ids}
+                if catalog_id not in self.products
+                or now - self.refreshed_at.get(catalog_id, self.synced_at_unix)
+                > max_age
+            )
+
+    def refresh(self, catalog_ids: Iterable[Any], fetch_product: FetchProduct):
+        """
+        Re-fetch a few products, e.g. the ones that just sold so their stock is current.
+        A product that can't be fetched keeps whatever we had for it.
+        """
+        catalog_ids = sorted({str(catalog_id) for catalog_id in catalog_ids})
+        if not catalog_ids:
+            return
+
+        def fetch(catalog_id: str) -> Optional[Dict[str, Any]]:
+            try:
+                return fetch_product(catalog_id)
+            except Exception as e:
+                logger.warning(f"could not refresh product {catalog_id}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=MAX_DETAIL_REQUESTS) as executor:
+            products = list(executor.map(fetch, catalog_ids))
+        refreshed_at = time.time()
+        with self._lock:
+            for product in products:
+                if product:
+                    catalog_id, entry = self._entry(product)
+                    self.products[catalog_id] = entry
+                    self.refreshed_at[catalog_id] = refreshed_at
+            self._save()
+
+    def missing(self, known_ids: Iterable[Any]) -> List[str]:
+        """Catalog ids that aren't in known_ids, e.g. the shift4shop_ids in werbies.json"""
+        known = {str(known_id) for known_id in known_ids}
+        with self._lock:
+            return sorted(
+                (catalog_id for catalog_id in self.products if catalog_id not in known),
+                key=lambda catalog_id: self.products[catalog_id]["name"],
+            )
+
+    @staticmethod
+    def _entry(product: Dict[str, Any]):
+        sku_info = product["SKUInfo"]
+        return str(sku_info["CatalogID"]), {
+            "name": sku_info.get("Name", ""),
+            "stock": sku_info.get("Stock"),
+        }
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.synced_at_unix = data.get("synced_at_unix", 0.0)
+        self.products = data.get("products", {})
+        self.refreshed_at = data.get("refreshed_at", {})
+
+    def _save(self):
+        # called with self._lock held. webhooks refresh products outside the poll's
+        # file lock, and other processes share the file, so every writer needs its own
+        # temp file
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.path.parent, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(
+                {
+                    "synced_at_unix": self.synced_at_unix,
+                    "products": self.products,
+                    "refreshed_at": self.refreshed_at,
+                },
+                f,
+            )
+        os.replace(f.name, self.path)
@@ -1,8 +1,11 @@
 import logging
+from pathlib import Path
 
 from dotenv import load_dotenv
 
 from wacks4shop.shift4shop import Shift4Shop
+from wacks4shop.wack import CATALOG_FILE, DATABASE_DIR
+from wacksbywarby.werbies import Werbies
 
 load_dotenv()
 
@@ -12,13 +15,24 @@ logger = logging.getLogger("wacks4shop")
 def main():
     logger.info("Querying for products...")
 
-    shift4shop = Shift4Shop(debug=False)
-
-    products = shift4shop.request_all_products()
-    for product in products:
-        catalog_id = product["SKUInfo"]["CatalogID"]
-        name = product["SKUInfo"]["Name"]
-        logger.info(f"{catalog_id}: {name}\n")
+    Path(DATABASE_DIR).mkdir(parents=True, exist_ok=True)
+    shift4shop = Shift4Shop(
+        debug=False, catalog_path=str(Path(DATABASE_DIR) / CATALOG_FILE)
+    )
+
+    shift4shop.sync_catalog()
+    catalog = shift4shop.catalog
+    for catalog_id, product in sorted(
+        catalog.products.items(), key=lambda item: item[1]["name"]
+    ):
+        logger.info(f"{catalog_id}: {product['name']} ({product['stock']} in stock)")
+
+    # anything listed here needs a shift4shop_id in werbies.json to get its own image
+    missing = catalog.missing(Werbies.catalog().indexes["shift4shop"])
+    if missing:
+        logger.info(f"\n{len(missing)} products missing from werbies.json:")
+        for catalog_id in missing:
+            logger.info(f"{catalog_id}: {catalog.lookup(catalog_id)['name']}")
 
 
 if __name__ == "__main__":
@@ -1,13 +1,19 @@
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import count
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
 
-from wacksbywarby.constants import SHIFT4SHOP_ORDER_DATE_FORMAT, SHIFT4SHOP_TIME_FORMAT
+from wacks4shop.catalog import MAX_DETAIL_REQUESTS, Shift4ShopCatalog
+from wacksbywarby.constants import SHIFT4SHOP_ORDER_DATE_FORMAT
 from wacksbywarby.models import Shift4ShopSale
+from wacksbywarby.sessions import API_TIMEOUT, build_session
+from wacksbywarby.stock import apply_stock
 
 logger = logging.getLogger("shift4shop")
 
@@ -27,38 +33,262 @@ From @rchhay:
 10 = Custom 3 (also not used)
 """
 INCOMPLETE_ORDER_STATUS = 7
+ORDER_STATUSES = [1, 2, 3, 4, 5, 6, 8, 9, 10]
+# opt-in: query each order status above separately instead of downloading every order,
+# abandoned carts included, and filtering them out here
+ORDERS_BY_STATUS = os.getenv("SHIFT4SHOP_ORDERS_BY_STATUS", "").lower() in ("1", "true")
+# small pages come back quickly, a single limit=300 request can take a minute
+ORDERS_PAGE_SIZE = 100
+PRODUCTS_PAGE_SIZE = 100
+# how many pages of orders or products to request concurrently. there's no total count in the
+# response, so these are speculative until a short page tells us we're at the end
+PREFETCH_PAGES = 4
 
 
 class Shift4Shop:
-    def __init__(self, debug=False) -> None:
+    def __init__(
+        self,
+        debug=False,
+        by_status: bool = ORDERS_BY_STATUS,
+        catalog_path: Optional[str] = None,
+        timeout: Tuple[float, float] = API_TIMEOUT,
+        session: Optional[requests.Session] = None,
+    ) -> None:
         self.key = os.getenv("SHIFT4SHOP_PRIVATE_KEY")
+        self.timeout = timeout
+        # enough connections for the busiest of our concurrent walks
+        self.session = (
+            session
+            if session is not None
+            else build_session(
+                max(PREFETCH_PAGES, len(ORDER_STATUSES), MAX_DETAIL_REQUESTS)
+            )
+        )
         self.shop_token = os.getenv("SHIFT4SHOP_SHOP_TOKEN")
         self.debug = debug
+        self.by_status = by_status
         self.headers = {
             "SecureURL": "wicksbywerby.com",
             "PrivateKey": self.key,
             "Token": self.shop_token,
         }
+        self.catalog = Shift4ShopCatalog(catalog_path) if catalog_path else None
 
     def _request_orders(self, params):
         """https://apirest.3dcart.com/v2/orders/index.html#retrieve-a-list-of-orders"""
         logger.info(f"requesting orders with params {params}")
-        return requests.get(f"{BASE_API}/Orders", params=params, headers=self.headers)
+        return self.session.get(
+            f"{BASE_API}/Orders",
+            params=params,
+            headers=self.headers,
+            timeout=self.timeout,
+        )
+
+    def _request_orders_page(self, params: dict, offset: int) -> List[dict]:
+        response = self._request_orders(
+            {**params, "limit": ORDERS_PAGE_SIZE, "offset": offset}
+        )
+        return self._page_or_empty(response, "orders")
+
+    def _request_products_page(self, offset: int) -> List[dict]:
+        """https://apirest.3dcart.com/v2/products/index.html#retrieve-a-list-of-products"""
+        logger.info(f"requesting products, offset {offset}")
+        response = self.session.get(
+            f"{BASE_API}/Products",
+            headers=self.headers,
+            params={"limit": PRODUCTS_PAGE_SIZE, "offset": offset},
+            timeout=self.timeout,
+        )
+        return self._page_or_empty(response, "products")
+
+    @staticmethod
+    def _page_or_empty(response: requests.Response, what: str) -> List[dict]:
+        """The page's results, [] past the last page, raises for any other error"""
+        if response.ok:
+            return response.json()
+        # when there are no more results, this will 404. this will happen a lot, so we
+        # really only need to log when it isn't a 404
+        if response.status_code == 404:
+            return []
+        logger.error(
+            "Something has gone wrong with getting %s! %s: %s",
+            what,
+            response.status_code,
+            response.content,
+        )
+        response.raise_for_status()
+
+    def _iter_orders(
+        self, params: dict, prefetch: int = PREFETCH_PAGES
+    ) -> Iterator[dict]:
+        return self._iter_pages(
+            lambda offset: self._request_orders_page(params, offset),
+            ORDERS_PAGE_SIZE,
+            lambda order: order["OrderID"],
+            prefetch=prefetch,
+        )
+
+    def iter_products(self) -> Iterator[dict]:
+        return self._iter_pages(
+            self._request_products_page,
+            PRODUCTS_PAGE_SIZE,
+            lambda product: product["SKUInfo"]["CatalogID"],
+        )
+
+    @staticmethod
+    def _iter_pages(
+        request_page: Callable[[int], List[dict]],
+        page_size: int,
+        id_of: Callable[[dict], Any],
+        prefetch: int = PREFETCH_PAGES,
+    ) -> Iterator[dict]:
+        """
+        Lazily walk every page request_page returns for an offset. Once the first page
+        comes back full, the next prefetch pages are requested concurrently and handed
+        out in order, or one at a time if prefetch is 0, and paging stops at the first
+        page that isn't full. Stopping early cancels whatever hasn't been fetched yet.
+        """
+        # something added while we're paging shifts everything by one, so it's possible
+        # to see the same result at the end of one page and start of the next
+        seen_ids = set()
+
+        def unseen(page: List[dict]) -> Iterator[dict]:
+            for result in page:
+                if id_of(result) in seen_ids:
+                    continue
+                seen_ids.add(id_of(result))
+                yield result
+
+        # most polls have nothing new, so don't speculate until there's more than a page
+        first_page = request_page(0)
+        yield from unseen(first_page)
+        if len(first_page) < page_size:
+            return
+
+        offsets = count(page_size, page_size)
+        if prefetch <= 0:
+            for offset in offsets:
+                page = request_page(offset)
+                yield from unseen(page)
+                if len(page) < page_size:
+                    return
+        executor = ThreadPoolExecutor(max_workers=prefetch)
+        try:
+            in_flight = deque(
+                executor.submit(request_page, next(offsets)) for _ in range(prefetch)
+            )
+            while in_flight:
+                page = in_flight.popleft().result()
+                if len(page) < page_size:
+                    # the last page, anything still in flight is past the end
+                    in_flight.clear()
+                else:
+                    in_flight.append(executor.submit(request_page, next(offsets)))
+                yield from unseen(page)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _iter_orders_by_status(self, params: dict) -> Iterator[dict]:
+        """
+        Every order matching params that isn't incomplete. The api only filters by one
+        status at a time, so the statuses are paged through concurrently and the results
+        are merged by order id. Each status pages one request at a time so there are
+        never more than one request per status in flight.
+        """
+        with ThreadPoolExecutor(max_workers=len(ORDER_STATUSES)) as executor:
+            pages_by_status = executor.map(
+                lambda status: list(
+                    self._iter_orders({**params, "orderstatus": status}, prefetch=0)
+                ),
+                ORDER_STATUSES,
+            )
+            seen_order_ids = set()
+            for orders in pages_by_status:
+                for order in orders:
+                    # an order can change status between requests
+                    if order["OrderID"] in seen_order_ids:
+                        continue
+                    seen_order_ids.add(order["OrderID"])
+                    yield order
+
+    def _fetch_orders(self, params: dict) -> Iterator[dict]:
+        if self.by_status:
+            return self._iter_orders_by_status(params)
+        return self._iter_orders(params)
+
+    def _get_orders_since_timestamp(self, timestamp: Optional[str]) -> Iterator[dict]:
+        """All orders since the timestamp, paged through lazily"""
+        params = {"datestart": timestamp} if timestamp else {}
+        return self._fetch_orders(params)
+
+    @staticmethod
+    def _count_sales(orders: Iterable[dict]) -> int:
+        """Count up the line items in every order that isn't incomplete"""
+        num_sales = 0
+        for order in orders:
+            if order["OrderStatusID"] != INCOMPLETE_ORDER_STATUS:
+                num_sales += len(order["OrderItemList"])
+        return num_sales
 
     def _request_product_details(self, catalog_id):
         """https://apirest.3dcart.com/v2/products/index.html#retrieve-a-list-of-products"""
-        return requests.get(f"{BASE_API}/Products/{catalog_id}", headers=self.headers)
+        return self.session.get(
+            f"{BASE_API}/Products/{catalog_id}",
+            headers=self.headers,
+            timeout=self.timeout,
+        )
 
-    def request_all_products(self):
+    def _get_product(self, catalog_id: str) -> Optional[dict]:
+        response = self._request_product_details(catalog_id)
+        products = self._page_or_empty(response, f"product {catalog_id}")
+        # the api answers with a list, even for a single product
+        if isinstance(products, dict):
+            return products
+        return products[0] if products else None
+
+    def request_all_products(self) -> List[dict]:
         """
         A util function that is useful for figuring out the catalog IDs of werbies in
         shift4shop
         """
-        response = requests.get(
-            f"{BASE_API}/Products/", headers=self.headers, params={"limit": 100}
-        )
-        products = response.json()
-        return products
+        return list(self.iter_products())
+
+    def sync_catalog(self) -> int:
+        if not self.catalog:
+            raise ValueError("no catalog_path was given")
+        return self.catalog.sync(self.iter_products)
+
+    def sales_from_orders(self, orders: List[dict]) -> list[Shift4ShopSale]:
+        """Sales for orders we were handed, e.g. by a webhook, rather than searched for"""
+        sales = self._orders_to_sales(orders)
+        self._apply_catalog(sales)
+        return sales
+
+    def _apply_catalog(self, sales: list[Shift4ShopSale]):
+        """
+        Use the catalog's names and current stock rather than the order's html description
+        and the stock at the time of the order
+        """
+        if not self.catalog or not sales:
+            return
+        # these products just sold, so look up any we haven't fetched recently
+        sold_ids = {sale.listing_id for sale in sales}
+        self.catalog.refresh(self.catalog.stale(sold_ids), self._get_product)
+        quantities = {}
+        for sale in sales:
+            product = self.catalog.lookup(sale.listing_id)
+            if not product:
+                continue
+            if product["name"]:
+                sale.fallback_name = product["name"]
+            if product["stock"] is not None:
+                quantities[sale.listing_id] = product["stock"]
+        # newest first, so stock for older sales accounts for what sold after them.
+        # products without a known stock keep the order's ItemUnitStock
+        sales_with_stock = [
+            sale for sale in reversed(sales) if sale.listing_id in quantities
+        ]
+        apply_stock(sales_with_stock, quantities)
 
     def determine_sales(
         self, timestamp: Optional[str]
@@ -66,34 +296,21 @@ class Shift4Shop:
         """
         Query the Shift4Shop API for all orders since the given timestamp. Then transform these orders
         into a list of Shift4ShopSale objects. Manually dedupe incomplete orders from all orders using
-        order id as the API doesn't support filtering by multiple order statuses.
+        order id as the API doesn't support filtering by multiple order statuses, unless
+        by_status is set, in which case each status is queried separately.
 
         Timestamp may be null if this is the first time running the app so we want to list
         every order
         """
-        params: dict = {"limit": 100}
-        if timestamp:
-            params["datestart"] = timestamp
-        all_orders_response = self._request_orders(params)
-
-        if not all_orders_response.ok:
-            # when there are no new orders, this will 404. this will happen a lot, so we
-            # really only need to log when it isn't a 404
-            if all_orders_response.status_code != 404:
-                logger.error(
-                    "Something has gone wrong with getting all orders! %s: %s",
-                    all_orders_response.status_code,
-                    all_orders_response.content,
-                )
-
+        all_orders_since_timestamp = list(self._get_orders_since_timestamp(timestamp))
+        if not all_orders_since_timestamp:
             return ([], timestamp)
 
-        all_orders_since_timestamp = all_orders_response.json()
-
         # Grab the most recent timestamp from ALL sales as opposed to just completed sales
         # This lets us keep the waterline not too far from the last sale in the event that
         # there are a lot of incompleted sales. This is to solve a bug for when there are >300
-        # sales between waterlines, which makes us miss orders.
+        # sales between waterlines, which makes us miss orders. When fetching by status there
+        # are no incomplete orders here, which is fine now that every page is fetched.
         try:
             most_recent_order_timestamp = sorted(
                 all_orders_since_timestamp,
@@ -105,9 +322,19 @@ class Shift4Shop:
             logger.error("Could not get most recent order date, using %s instead", timestamp)
             most_recent_order_timestamp = timestamp
 
+        ordered_sales = self._orders_to_sales(all_orders_since_timestamp)
+        self._apply_catalog(ordered_sales)
+        return (ordered_sales, most_recent_order_timestamp)
+
+    def _orders_to_sales(self, orders: List[dict]) -> list[Shift4ShopSale]:
+        """
+        Transform orders into Shift4ShopSale objects, one for each line item, skipping
+        incomplete orders. Orders at the waterline come back again on the next poll, the
+        sales ledger is what keeps them from being announced twice.
+        """
         completed_orders = [
             order
-            for order in all_orders_since_timestamp
+            for order in orders
             if order["OrderStatusID"] != INCOMPLETE_ORDER_STATUS
         ]
 
@@ -115,13 +342,7 @@ class Shift4Shop:
         for order in completed_orders:
             order_date_str = order["OrderDate"]
             order_date = datetime.strptime(order_date_str, SHIFT4SHOP_ORDER_DATE_FORMAT)
-            # if we were passed a timestamp of the last order, make sure we don't append that
-            # last order again
-            if timestamp and order_date == datetime.strptime(
-                timestamp, SHIFT4SHOP_TIME_FORMAT
-            ):
-                continue
-            for item in order["OrderItemList"]:
+            for index, item in enumerate(order["OrderItemList"]):
                 sales.append(
                     Shift4ShopSale(
                         listing_id=item["CatalogID"],
@@ -130,11 +351,12 @@ class Shift4Shop:
                         datetime=order_date,
                         location=None,
                         fallback_name=item["ItemDescription"].split("<br>")[0],
+                        order_id=str(order["OrderID"]),
+                        line_item_id=str(item.get("ItemIndexID", index)),
                     )
                 )
         # order sales by date
-        ordered_sales = sorted(sales, key=lambda sale: sale.datetime)
-        return (ordered_sales, most_recent_order_timestamp)
+        return sorted(sales, key=lambda sale: sale.datetime)
 
     def _internal_get_num_sales(self, additional_query_filters: dict) -> int:
         """
@@ -142,44 +364,24 @@ class Shift4Shop:
         Filter out any that are incomplete orders
 
         See _request_orders() for filters that can be applied to the search query.
-        Examples include "limit", "orderstatus", "datestart"
+        Examples include "orderstatus", "datestart"
         """
-        total_orders_response = self._request_orders(
-            {"limit": 300, **additional_query_filters}
-        )
-        num_sales = 0
-        for order in total_orders_response.json():
-            if order["OrderStatusID"] != INCOMPLETE_ORDER_STATUS:
-                num_sales += len(order["OrderItemList"])
-
-        return num_sales
+        return self._count_sales(self._fetch_orders(additional_query_filters))
 
     def legacy_get_num_sales(self) -> int:
         """
-        This is a stopgap solution that works by querying all the orders and
-        counting up the items within each order, to an upper limit of around 300 orders.
-        This has become quite slow already at around 100 orders, taking up to 1 minute
-        to complete the request
+        Count every sale by paging through all the orders and counting up the items
+        within each order. Used to backfill the count when nothing has been stored yet.
         """
         logger.info("getting legacy num sales")
-        num_sales = self._internal_get_num_sales({"limit": 300})
+        num_sales = self._internal_get_num_sales({})
         return num_sales
 
-    def get_num_sales(self, timestamp: str, prev_num_sales: int) -> int:
-        """
-        We store the previous number of sales so we can just get the new sales
-        since the last timestamp
-        """
-        logger.info("getting num sales")
-        num_new_sales = self._internal_get_num_sales({"datestart": timestamp})
-        num_total_sales = prev_num_sales + num_new_sales
-        return num_total_sales
+    def close(self):
+        self.session.close()
 
 
 if __name__ == "__main__":
     load_dotenv()
     shift = Shift4Shop(debug=True)
-    prev_num_sales = 0
-    timestamp = (datetime.now() - timedelta(days=1)).strftime("%m/%d/%Y %H:%M:%S")
-    num_sales = shift.get_num_sales(timestamp, 0)
-    print(num_sales)
+    print(shift.legacy_get_num_sales())
@@ -0,0 +1,106 @@
+import threading
+import time
+from typing import List
+
+import pytest
+
+from wacks4shop.shift4shop import (
+    INCOMPLETE_ORDER_STATUS,
+    ORDER_STATUSES,
+    ORDERS_PAGE_SIZE,
+    PREFETCH_PAGES,
+    Shift4Shop,
+)
+
+
+def make_order(order_id: int) -> dict:
+    return {
+        "OrderID": order_id,
+        "OrderStatusID": 1,
+        "OrderDate": "2023-05-14T12:00:00",
+        "OrderItemList": [
+            {
+                "CatalogID": 12,
+                "ItemIndexID": 1,
+                "ItemUnitStock": 4,
+                "ItemQuantity": 1,
+                "ItemDescription": "Nyx<br>4oz Tin",
+            }
+        ],
+    }
+
+
+@pytest.fixture
+def shift4shop(monkeypatch):
+    """A Shift4Shop client whose store has 650 orders"""
+    orders = [make_order(i) for i in range(650)]
+    requested_offsets: List[int] = []
+
+    def request_page(self, params, offset):
+        requested_offsets.append(offset)
+        return orders[offset : offset + ORDERS_PAGE_SIZE]
+
+    monkeypatch.setattr(Shift4Shop, "_request_orders_page", request_page)
+    client = Shift4Shop()
+    client.requested_offsets = requested_offsets  # type: ignore
+    return client
+
+
+def test_walks_every_page(shift4shop: Shift4Shop):
+    orders = list(shift4shop._iter_orders({}))
+    assert [order["OrderID"] for order in orders] == list(range(650))
+    # stops requesting once it sees the short page at 600
+    assert max(shift4shop.requested_offsets) <= 600 + PREFETCH_PAGES * ORDERS_PAGE_SIZE  # type: ignore
+    assert shift4shop.legacy_get_num_sales() == 650
+
+
+def test_one_request_when_nothing_is_new(monkeypatch):
+    requested_offsets: List[int] = []
+
+    def request_page(self, params, offset):
+        requested_offsets.append(offset)
+        return []
+
+    monkeypatch.setattr(Shift4Shop, "_request_orders_page", request_page)
+    sales, timestamp = Shift4Shop().determine_sales("05/14/2023 12:00:00")
+    assert sales == []
+    assert timestamp == "05/14/2023 12:00:00"
+    assert requested_offsets == [0]
+
+
+def test_sales_from_every_page(shift4shop: Shift4Shop):
+    sales, _ = shift4shop.determine_sales("05/13/2023 12:00:00")
+    assert len(sales) == 650
+    assert shift4shop.requested_offsets.count(0) == 1  # type: ignore
+
+
+def test_by_status_skips_incomplete_orders(monkeypatch):
+    orders = [make_order(i) for i in range(250)]
+    for order in orders[::2]:
+        order["OrderStatusID"] = INCOMPLETE_ORDER_STATUS
+    requested_statuses: List[int] = []
+    lock = threading.Lock()
+    in_flight = 0
+    most_in_flight = 0
+
+    def request_page(self, params, offset):
+        nonlocal in_flight, most_in_flight
+        with lock:
+            requested_statuses.append(params["orderstatus"])
+            in_flight += 1
+            most_in_flight = max(most_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        matching = [o for o in orders if o["OrderStatusID"] == params["orderstatus"]]
+        return matching[offset : offset + ORDERS_PAGE_SIZE]
+
+    monkeypatch.setattr(Shift4Shop, "_request_orders_page", request_page)
+    client = Shift4Shop(by_status=True)
+    sales, _ = client.determine_sales(None)
+    assert len(sales) == 125
+    assert INCOMPLETE_ORDER_STATUS not in requested_statuses
+    assert set(requested_statuses) == set(ORDER_STATUSES)
+    # one request per status at a time, no prefetching on top
+    assert most_in_flight <= len(ORDER_STATUSES)
+    assert requested_statuses.count(1) == 2
@@ -0,0 +1,103 @@
+import threading
+from pathlib import Path
+from typing import List
+
+from wacks4shop.catalog import Shift4ShopCatalog
+from wacks4shop.shift4shop import Shift4Shop
+
+
+def product(catalog_id: int, name: str, stock: int) -> dict:
+    return {"SKUInfo": {"CatalogID": catalog_id, "Name": name, "Stock": stock}}
+
+
+PRODUCTS = [product(20, "Nyx", 5), product(21, "Mochi", 0), product(22, "Fig", 3)]
+
+
+def test_sync_and_diff_against_werbies(tmp_path: Path):
+    path = str(tmp_path / "shift4shop_catalog.json")
+    catalog = Shift4ShopCatalog(path)
+    assert catalog.is_stale()
+    assert catalog.sync(lambda: iter(PRODUCTS)) == 3
+    assert not catalog.is_stale()
+
+    # werbies.json stores shift4shop ids as ints
+    assert catalog.missing([20]) == ["22", "21"]
+
+    reloaded = Shift4ShopCatalog(path)
+    assert reloaded.lookup(21) == {"name": "Mochi", "stock": 0}
+    assert reloaded.stale([20, 99]) == ["99"]
+    assert reloaded.stale([20, 99], max_age=-1) == ["20", "99"]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_refresh_keeps_products_that_cant_be_fetched(tmp_path: Path):
+    catalog = Shift4ShopCatalog(str(tmp_path / "shift4shop_catalog.json"))
+    catalog.sync(lambda: iter(PRODUCTS))
+
+    def fetch_product(catalog_id: str):
+        if catalog_id == "21":
+            raise RuntimeError("shift4shop is down")
+        return product(int(catalog_id), "Nyx Candle", 4)
+
+    catalog.refresh([20, 21], fetch_product)
+    assert catalog.lookup(20) == {"name": "Nyx Candle", "stock": 4}
+    assert catalog.lookup(21) == {"name": "Mochi", "stock": 0}
+
+
+def test_refreshes_from_several_threads(tmp_path: Path):
+    path = str(tmp_path / "shift4shop_catalog.json")
+    catalog = Shift4ShopCatalog(path)
+
+    def refresh(start: int):
+        for catalog_id in range(start, start + 50):
+            catalog.refresh(
+                [catalog_id], lambda catalog_id: product(int(catalog_id), "Nyx", 1)
+            )
+
+    # like the webhook server's threads, each adding products while others save
+    threads = [threading.Thread(target=refresh, args=(i * 50,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(Shift4ShopCatalog(path).products) == 200
+
+
+def test_determine_sales_uses_catalog_names_and_stock(tmp_path: Path, monkeypatch):
+    orders = [
+        {
+            "OrderID": order_id,
+            "OrderStatusID": 1,
+            "OrderDate": f"2023-05-14T12:00:0{order_id}",
+            "OrderItemList": [
+                {
+                    "CatalogID": 20,
+                    "ItemIndexID": 1,
+                    "ItemUnitStock": 9,
+                    "ItemQuantity": 1,
+                    "ItemDescription": "Nyx<br><b>old</b>",
+                }
+            ],
+        }
+        for order_id in range(1, 3)
+    ]
+    requested: List[str] = []
+
+    def get_product(self, catalog_id):
+        requested.append(catalog_id)
+        return product(20, "Nyx", 2)
+
+    monkeypatch.setattr(Shift4Shop, "_request_orders_page", lambda *args: orders)
+    monkeypatch.setattr(Shift4Shop, "_get_product", get_product)
+    shift4shop = Shift4Shop(catalog_path=str(tmp_path / "shift4shop_catalog.json"))
+
+    sales, _ = shift4shop.determine_sales(None)
+    assert requested == ["20"]
+    assert [sale.fallback_name for sale in sales] == ["Nyx", "Nyx"]
+    # oldest first, the older sale had one more left after it
+    assert [sale.quantity for sale in sales] == [3, 2]
+
+    # the product was just looked up, so the next poll uses what's cached
+    sales, _ = shift4shop.determine_sales(None)
+    assert requested == ["20"]
+    assert [sale.quantity for sale in sales] == [3, 2]
@@ -1,20 +1,27 @@
 import argparse
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
+from typing import Callable, List, Optional
 
 from dotenv import load_dotenv
 from filelock import FileLock, Timeout
 
 from wacks4shop.shift4shop import Shift4Shop
-from wacksbywarby.constants import SHIFT4SHOP_ORDER_DATE_FORMAT, WACK_ERROR_SENTINEL
-from wacksbywarby.db import Wackabase
+from wacksbywarby.constants import (
+    SHIFT4SHOP_ORDER_DATE_FORMAT,
+    SHIFT4SHOP_TIME_FORMAT,
+    WACK_ERROR_SENTINEL,
+)
+from wacksbywarby.db import Wackabase, open_wackabase
 from wacksbywarby.discord import Discord
-from wacksbywarby.models import Sale
-from wacksbywarby.wack import announce_new_sales
+from wacksbywarby.ledger import OVERLAP_SECONDS, SalesLedger
+from wacksbywarby.models import Sale, Shift4ShopSale
+from wacksbywarby.outbox import Outbox
+from wacksbywarby.wack import flush_outbox
 
 DATABASE_DIR = "data/wacks4shop"
+CATALOG_FILE = "shift4shop_catalog.json"
 LOCKFILE = "wacks4shop.lock"
 
 load_dotenv()
@@ -28,55 +35,131 @@ def log_waterline(db: Wackabase, timestamp: str):
     db.write_timestamp(timestamp_as_datetime)
 
 
-def main(db: Wackabase, dry=False):
+def to_sales(sales: List[Shift4ShopSale]) -> List[Sale]:
+    """
+    Convert Shift4shop sales to Sales, purely for typing purposes, as dataclasses in 3.9
+    don't handle inheritance super well, so announce_new_sales doesn't know it's ok to
+    take a Shift4Shop sale obj
+    """
+    return [
+        Sale(
+            listing_id=s.listing_id,
+            quantity=s.quantity,
+            num_sold=s.num_sold,
+            datetime=None,
+            location=None,
+            fallback_name=s.fallback_name,
+            order_id=s.order_id,
+            line_item_id=s.line_item_id,
+        )
+        for s in sales
+    ]
+
+
+def make_client(dry=False) -> Shift4Shop:
+    return Shift4Shop(debug=dry, catalog_path=str(Path(DATABASE_DIR) / CATALOG_FILE))
+
+
+def main(
+    db: Wackabase,
+    dry=False,
+    client: Optional[Shift4Shop] = None,
+    discord: Optional[Discord] = None,
+    on_sales: Optional[Callable[[List[Sale]], None]] = None,
+):
+    """
+    Poll shift4shop for new sales and announce them, moving the waterline along and
+    returning it.
+    A long running caller can pass in its own client and discord to reuse them across
+    polls, and on_sales to hear about the new sales each poll found.
+    """
     try:
         logger.info("TIME TO WACK")
         logger.debug("Dry run: %s", dry)
 
-        discord = Discord(debug=dry)
-        shift4shop = Shift4Shop(debug=dry)
+        if discord is None:
+            discord = Discord(debug=dry)
+        shift4shop = client if client is not None else make_client(dry=dry)
+        if shift4shop.catalog and shift4shop.catalog.is_stale():
+            try:
+                shift4shop.sync_catalog()
+            except Exception as e:
+                # names and stock fall back to what's on the order, so this shouldn't stop the poll
+                logger.error(
+                    "%s could not sync shift4shop catalog: %s", WACK_ERROR_SENTINEL, e
+                )
+        outbox = Outbox(db, provider="shift4shop")
 
         last_timestamp = db.get_timestamp()
-        sales, new_timestamp = shift4shop.determine_sales(timestamp=last_timestamp)
-
-        if not sales:
-            logger.info("no new sales")
-            return new_timestamp
-
-        logger.info(f"last timestamp was {last_timestamp}")
-        # convert Shift4shop sales to Sales, purely for typing purposes, as
-        # dataclasses in 3.9 don't handle inheritance super well, so announce_new_sales
-        # doesn't know it's ok to take a Shift4Shop sale obj
-        sales_to_announce = [
-            Sale(
-                listing_id=s.listing_id,
-                quantity=s.quantity,
-                num_sold=s.num_sold,
-                datetime=None,
-                location=None,
-                fallback_name=s.fallback_name
+        waterline = None
+        query_from = None
+        if last_timestamp:
+            waterline = datetime.strptime(last_timestamp, SHIFT4SHOP_TIME_FORMAT)
+            # look back a little past the waterline, the ledger drops what we've seen
+            query_from = (waterline - timedelta(seconds=OVERLAP_SECONDS)).strftime(
+                SHIFT4SHOP_TIME_FORMAT
+            )
+        ledger = SalesLedger(db.ledger_path)
+        try:
+            ledger.seed("shift4shop", waterline, db.get_last_num_sales())
+            fetched, newest_order_date = shift4shop.determine_sales(
+                timestamp=query_from
+            )
+            # with no orders at all that's just query_from handed back
+            newest_order = (
+                datetime.strptime(newest_order_date, SHIFT4SHOP_ORDER_DATE_FORMAT)
+                if newest_order_date and newest_order_date != query_from
+                else None
             )
-            for s in sales
-        ]
-
-        # grab the current number of total sales
-        previous_num_sales = db.get_last_num_sales()
-        if last_timestamp and previous_num_sales:
-            current_num_sales = shift4shop.get_num_sales(
-                last_timestamp, previous_num_sales
+            # the waterline only moves forward, an order in the overlap doesn't pull it back
+            new_waterline = waterline
+            if newest_order and (waterline is None or newest_order > waterline):
+                new_waterline = newest_order
+            new_timestamp = (
+                new_waterline.strftime(SHIFT4SHOP_ORDER_DATE_FORMAT)
+                if new_waterline
+                else None
             )
-        # if nothing has been written yet (db returns 0 for prev num sales),
-        # use legacy method to backfill
-        else:
-            current_num_sales = shift4shop.legacy_get_num_sales()
-        db.write_num_sales(current_num_sales)
+
+            sales = ledger.unseen("shift4shop", fetched)
+            if not sales:
+                logger.info("no new sales")
+                if new_waterline != waterline:
+                    # incomplete orders still move the waterline along
+                    log_waterline(db, new_timestamp)
+                # retry anything a previous run couldn't get out
+                flush_outbox(discord, outbox, ledger.num_sales("shift4shop"))
+                return new_timestamp
+
+            logger.info(f"last timestamp was {last_timestamp}")
+            if on_sales:
+                on_sales(sales)
+            sales_to_announce = to_sales(sales)
+
+            # grab the current number of total sales
+            previous_num_sales = ledger.num_sales("shift4shop")
+            # if nothing has been counted yet, use legacy method to backfill
+            backfilled = None
+            if not last_timestamp or not previous_num_sales:
+                backfilled = shift4shop.legacy_get_num_sales()
+            # queued first, the outbox drops them if a crash has them queued again
+            outbox.enqueue(sales_to_announce)
+            if new_waterline != waterline:
+                logger.info(f"writing latest sale time: {new_timestamp}")
+            current_num_sales = ledger.record_poll(
+                db,
+                "shift4shop",
+                sales,
+                new_waterline if new_waterline != waterline else None,
+                backfilled,
+            )
+        finally:
+            ledger.close()
 
         logger.info(
             f"current num sales: {current_num_sales}, previously stored num sales: {previous_num_sales}"
         )
-        announce_new_sales(
-            discord, sales_to_announce, current_num_sales, id_type="shift4shop"
-        )
+        flush_outbox(discord, outbox, current_num_sales)
 
         return new_timestamp
 
@@ -104,12 +187,10 @@ if __name__ == "__main__":
             # create the database folder if it doesn't exit
             Path(DATABASE_DIR).mkdir(parents=True, exist_ok=True)
 
-            wackabase = Wackabase(DATABASE_DIR)
-            waterline = main(db=wackabase, dry=args.dry)
+            with open_wackabase("shift4shop", DATABASE_DIR) as wackabase:
+                waterline = main(db=wackabase, dry=args.dry)
             if not waterline:
                 logger.error("No timestamp, what's going on?")
-            else:
-                log_waterline(wackabase, waterline)
             logger.info("done!")
     except Timeout:
         logger.info("Could not acquire lock! Exiting.")
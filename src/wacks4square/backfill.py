@@ -0,0 +1,169 @@
+"""Count (and optionally collect) historical square sales by splitting the range into shards"""
+
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from wacksbywarby.models import Sale
+
+logger = logging.getLogger("backfill")
+
+SHARD_SIZE = timedelta(weeks=1)
+MAX_WORKERS = 4
+
+Shard = Tuple[datetime, datetime]
+FetchOrders = Callable[[datetime, datetime], Iterator[Dict[str, Any]]]
+OrdersToSales = Callable[[Iterable[Dict[str, Any]]], List[Sale]]
+
+
+@dataclass
+class ShardResult:
+    num_sales: int
+    sales: List[Sale] = field(default_factory=list)
+
+
+@dataclass
+class BackfillResult:
+    num_sales: int
+    # newest first, the same order get_sales_since_timestamp returns
+    sales: List[Sale]
+
+
+def shard_range(start: datetime, end: datetime, shard_size: timedelta) -> List[Shard]:
+    """Split [start, end) into back to back [shard_start, shard_end) ranges"""
+    shards = []
+    shard_start = start
+    while shard_start < end:
+        shard_end = min(shard_start + shard_size, end)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+    return shards
+
+
+class Backfill:
+    """
+    Splits a long range of time into shards, e.g. a week each, and searches them
+    concurrently on a bounded pool of workers, following the cursor within each shard.
+    Results are merged back in time order.
+
+    Every finished shard is written to the checkpoint file, so a backfill that gets
+    interrupted picks up where it left off instead of starting from scratch. A last
+    shard cut short by the end of the range, usually now, is always searched again
+    since it will have a different end next time.
+    """
+
+    def __init__(
+        self,
+        fetch_orders: FetchOrders,
+        orders_to_sales: OrdersToSales,
+        checkpoint_path: Optional[str] = None,
+        shard_size: timedelta = SHARD_SIZE,
+        max_workers: int = MAX_WORKERS,
+    ) -> None:
+        self.fetch_orders = fetch_orders
+        self.orders_to_sales = orders_to_sales
+        self.checkpoint_path = Path(checkpoint_path) if checkpoint_path else None
+        self.shard_size = shard_size
+        self.max_workers = max_workers
+
+    def run(
+        self, start: datetime, end: datetime, collect_sales: bool = False
+    ) -> BackfillResult:
+        shards = shard_range(start, end, self.shard_size)
+        checkpoint = self._read_checkpoint()
+        results: Dict[str, ShardResult] = {}
+        for shard in shards:
+            key = self._shard_key(shard)
+            saved = checkpoint.get(key)
+            # a shard that was counted without collecting sales has to be redone to collect them
+            if saved is not None and (not collect_sales or "sales" in saved):
+                results[key] = ShardResult(
+                    num_sales=saved["num_sales"],
+                    sales=[Sale.from_dict(sale) for sale in saved.get("sales", [])],
+                )
+
+        remaining = [shard for shard in shards if self._shard_key(shard) not in results]
+        logger.info(
+            f"backfilling {len(remaining)} of {len(shards)} shards from {start} to {end}"
+        )
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._run_shard, shard, collect_sales): shard
+                for shard in remaining
+            }
+            error: Optional[Exception] = None
+            for future in as_completed(futures):
+                key = self._shard_key(futures[future])
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # keep checkpointing the shards that do finish, then give up
+                    logger.error(f"could not backfill shard {key}: {e}")
+                    error = error or e
+                    continue
+                results[key] = result
+                if not self._is_full(futures[future]):
+                    continue
+                checkpoint[key] = {"num_sales": result.num_sales}
+                if collect_sales:
+                    checkpoint[key]["sales"] = [sale.to_dict() for sale in result.sales]
+                self._write_checkpoint(checkpoint)
+        if error:
+            raise error
+
+        num_sales = 0
+        sales: List[Sale] = []
+        # shards are oldest first while the sales within a shard are newest first
+        for shard in reversed(shards):
+            result = results[self._shard_key(shard)]
+            num_sales += result.num_sales
+            sales.extend(result.sales)
+        logger.info(f"found {num_sales} items sold from {start} to {end}")
+        return BackfillResult(num_sales=num_sales, sales=sales)
+
+    def _run_shard(self, shard: Shard, collect_sales: bool) -> ShardResult:
+        orders = list(self.fetch_orders(*shard))
+        # count the line items a poll would turn into sales, e.g. not card fees, so a
+        # backfilled total means the same as one kept up to date by polls
+        sales = self.orders_to_sales(orders)
+        return ShardResult(num_sales=len(sales), sales=sales if collect_sales else [])
+
+    @staticmethod
+    def _shard_key(shard: Shard) -> str:
+        return f"{shard[0].isoformat()}/{shard[1].isoformat()}"
+
+    @staticmethod
+    def _key_shard(key: str) -> Shard:
+        start, end = key.split("/")
+        return datetime.fromisoformat(start), datetime.fromisoformat(end)
+
+    def _is_full(self, shard: Shard) -> bool:
+        return shard[1] - shard[0] == self.shard_size
+
+    def _read_checkpoint(self) -> dict:
+        if not self.checkpoint_path:
+            return {}
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return {}
+        # drop shards cut short by earlier runs, nothing will ask for them again
+        return {
+            key: saved
+            for key, saved in checkpoint.items()
+            if self._is_full(self._key_shard(key))
+        }
+
+    def _write_checkpoint(self, checkpoint: dict):
+        if not self.checkpoint_path:
+            return
+        tmp_path = self.checkpoint_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
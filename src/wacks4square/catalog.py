@@ -0,0 +1,114 @@
+"""A local copy of the square catalog's items and variations"""
+
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from wacks4square.constants import DATETIME_FMT
+
+logger = logging.getLogger("squarecatalog")
+
+# how old the local catalog can get before a poll syncs it again
+CATALOG_MAX_AGE_SECONDS = 60 * 60
+
+# begin_time -> catalog objects changed since then, or everything if begin_time is None
+FetchCatalogObjects = Callable[[Optional[str]], Iterator[Dict[str, Any]]]
+
+
+class SquareCatalog:
+    """
+    Items and variations from the square catalog, stored in a json file so looking up
+    a variation's name never needs a request. The first sync lists the whole catalog,
+    after that only objects that changed since the last sync are pulled.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.synced_at: Optional[str] = None
+        self.synced_at_unix = 0.0
+        # item id -> item name
+        self.items: Dict[str, str] = {}
+        # variation id -> {"item_id": ..., "name": ...}
+        self.variations: Dict[str, Dict[str, str]] = {}
+        self._load()
+
+    def lookup(self, variation_id: str) -> Optional[Tuple[str, str]]:
+        """(item name, variation name) for a variation id, if we know about it"""
+        variation = self.variations.get(variation_id)
+        if variation is None:
+            return None
+        return self.items.get(variation["item_id"], ""), variation["name"]
+
+    def is_stale(self, max_age: float = CATALOG_MAX_AGE_SECONDS) -> bool:
+        return time.time() - self.synced_at_unix > max_age
+
+    def sync(self, fetch_objects: FetchCatalogObjects) -> int:
+        """Pull in whatever changed since the last sync, returning how many objects changed"""
+        # take the time before fetching so anything edited mid-sync is picked up next time
+        started_at = datetime.utcnow()
+        logger.info(f"syncing square catalog, last synced at {self.synced_at}")
+        num_changed = 0
+        for catalog_object in fetch_objects(self.synced_at):
+            num_changed += 1
+            if catalog_object["type"] == "ITEM":
+                self._apply_item(catalog_object)
+            elif catalog_object["type"] == "ITEM_VARIATION":
+                self._apply_variation(catalog_object)
+        self.synced_at = started_at.strftime(DATETIME_FMT)
+        self.synced_at_unix = time.time()
+        self._save()
+        logger.info(f"synced {num_changed} changed catalog objects")
+        return num_changed
+
+    def _apply_item(self, item: Dict[str, Any]):
+        if item.get("is_deleted"):
+            self.items.pop(item["id"], None)
+            self.variations = {
+                variation_id: variation
+                for variation_id, variation in self.variations.items()
+                if variation["item_id"] != item["id"]
+            }
+            return
+        item_data = item.get("item_data", {})
+        self.items[item["id"]] = item_data.get("name", "")
+        for variation in item_data.get("variations", []):
+            self._apply_variation(variation)
+
+    def _apply_variation(self, variation: Dict[str, Any]):
+        if variation.get("is_deleted"):
+            self.variations.pop(variation["id"], None)
+            return
+        variation_data = variation.get("item_variation_data", {})
+        self.variations[variation["id"]] = {
+            "item_id": variation_data.get("item_id", ""),
+            "name": variation_data.get("name", ""),
+        }
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.synced_at = data.get("synced_at")
+        self.synced_at_unix = data.get("synced_at_unix", 0.0)
+        self.items = data.get("items", {})
+        self.variations = data.get("variations", {})
+
+    def _save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "synced_at": self.synced_at,
+                    "synced_at_unix": self.synced_at_unix,
+                    "items": self.items,
+                    "variations": self.variations,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.path)
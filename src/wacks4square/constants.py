@@ -1,5 +1,8 @@
 DATABASE_DIR = "data/wack4square"
 LOCKFILE = "wacks4square.lock"
+BACKFILL_CHECKPOINT = "backfill.json"
+CATALOG_FILE = "square_catalog.json"
+LOCATIONS_FILE = "square_locations.json"
 
 # ex: 2023-03-07T04:32:14Z
 DATETIME_FMT = "%Y-%m-%dT%H:%M:%SZ"
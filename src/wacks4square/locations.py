@@ -0,0 +1,137 @@
+"""Which square locations we sell from and what to call them"""
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from wacksbywarby.constants import WACK_ERROR_SENTINEL
+
+logger = logging.getLogger("squarelocations")
+
+LOCATIONS_TTL_SECONDS = 24 * 60 * 60
+# an unknown location id triggers a refresh, but not more often than this
+MIN_REFRESH_SECONDS = 60
+# SearchOrders takes at most this many location ids per request
+MAX_LOCATIONS_PER_REQUEST = 10
+
+FetchLocations = Callable[[], List[dict]]
+
+
+class LocationRegistry:
+    """
+    Square locations loaded from the Locations API and cached on disk for a day.
+
+    Orders are searched across every active location, so a new pop-up shows up without
+    a restart or an env change. An order from a location we haven't seen yet triggers
+    one refresh, and if it's still unknown the sale is labelled with the raw id rather
+    than failing the poll. Names in overrides win over square's names, e.g. to call the
+    main location after the upcoming event.
+    """
+
+    def __init__(
+        self,
+        fetch_locations: FetchLocations,
+        path: Optional[str] = None,
+        overrides: Optional[Dict[str, str]] = None,
+        fallback_ids: Optional[List[str]] = None,
+        ttl: float = LOCATIONS_TTL_SECONDS,
+    ) -> None:
+        self.fetch_locations = fetch_locations
+        self.path = Path(path) if path else None
+        self.overrides = overrides or {}
+        # used when square can't be reached and there's nothing cached
+        self.fallback_ids = fallback_ids or []
+        self.ttl = ttl
+        self.locations: List[dict] = []
+        self.fetched_at = 0.0
+        self._last_attempt = 0.0
+        self._lock = threading.Lock()
+        self._load()
+
+    def active_ids(self) -> List[str]:
+        self._refresh_if_stale()
+        ids = [
+            location["id"]
+            for location in self.locations
+            if location.get("status", "ACTIVE") == "ACTIVE"
+        ]
+        return ids or self.fallback_ids
+
+    def all_ids(self) -> List[str]:
+        """Every location, closed ones included, e.g. to count past pop-ups' sales"""
+        self._refresh_if_stale()
+        ids = [location["id"] for location in self.locations]
+        return ids + [
+            location_id for location_id in self.fallback_ids if location_id not in ids
+        ]
+
+    def active_id_batches(
+        self, size: int = MAX_LOCATIONS_PER_REQUEST
+    ) -> List[List[str]]:
+        """active_ids() split up so each request stays within square's limit"""
+        return self._batches(self.active_ids(), size)
+
+    def all_id_batches(self, size: int = MAX_LOCATIONS_PER_REQUEST) -> List[List[str]]:
+        """all_ids() split up so each request stays within square's limit"""
+        return self._batches(self.all_ids(), size)
+
+    @staticmethod
+    def _batches(ids: List[str], size: int) -> List[List[str]]:
+        # always at least one batch, even if it's empty, so callers still make a request
+        return [ids[i : i + size] for i in range(0, len(ids), size)] or [ids]
+
+    def name(self, location_id: str) -> str:
+        if location_id in self.overrides:
+            return self.overrides[location_id]
+        names = self._names()
+        if location_id not in names and self._can_refresh():
+            logger.info(f"unknown location {location_id}, refreshing locations")
+            self.refresh()
+            names = self._names()
+        return names.get(location_id, location_id)
+
+    def refresh(self):
+        with self._lock:
+            self._last_attempt = time.time()
+            try:
+                self.locations = self.fetch_locations()
+            except Exception as e:
+                logger.error(
+                    "%s could not fetch square locations: %s", WACK_ERROR_SENTINEL, e
+                )
+                return
+            self.fetched_at = time.time()
+            self._save()
+
+    def _refresh_if_stale(self):
+        if time.time() - self.fetched_at > self.ttl and self._can_refresh():
+            self.refresh()
+
+    def _can_refresh(self) -> bool:
+        return time.time() - self._last_attempt > MIN_REFRESH_SECONDS
+
+    def _names(self) -> Dict[str, str]:
+        return {location["id"]: location.get("name", "") for location in self.locations}
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.locations = data.get("locations", [])
+        self.fetched_at = data.get("fetched_at", 0.0)
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"fetched_at": self.fetched_at, "locations": self.locations}, f)
+        os.replace(tmp_path, self.path)
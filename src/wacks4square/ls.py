@@ -1,10 +1,11 @@
 import logging
+from pathlib import Path
 
 from dotenv import load_dotenv
 
-from wacks4square.constants import DATABASE_DIR
+from wacks4square.constants import CATALOG_FILE, DATABASE_DIR
 from wacks4square.square import Square
-from wacksbywarby.db import Wackabase
+from wacksbywarby.db import Wackabase, open_wackabase
 
 load_dotenv()
 
@@ -14,14 +15,24 @@ logger = logging.getLogger("wacks4square")
 def main(db: Wackabase):
     logger.info("Querying for products...")
     creds = db.get_square_creds()
-    square = Square(credentials=creds, debug=False)
-
-    square.request_all_products()
+    square = Square(
+        credentials=creds,
+        debug=False,
+        catalog_path=str(Path(DATABASE_DIR) / CATALOG_FILE),
+    )
+
+    square.sync_catalog()
+    # print each variation id so it can be copied into werbies.json
+    catalog = square.catalog
+    for variation_id in sorted(
+        catalog.variations, key=lambda variation_id: catalog.lookup(variation_id)
+    ):
+        item_name, variation_name = catalog.lookup(variation_id)
+        logger.info(f"{item_name}|{variation_name}<{variation_id}>")
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-    wackabase = Wackabase(DATABASE_DIR)
-
-    main(wackabase)
+    with open_wackabase("square", DATABASE_DIR) as wackabase:
+        main(wackabase)
@@ -5,7 +5,7 @@ from dotenv import load_dotenv
 
 from wacks4square.constants import DATABASE_DIR
 from wacks4square.square import Square
-from wacksbywarby.db import Wackabase
+from wacksbywarby.db import Wackabase, open_wackabase
 from wacksbywarby.models import SquareCredentials
 
 load_dotenv()
@@ -41,6 +41,5 @@ def main(db: Wackabase):
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 
-    db = Wackabase(DATABASE_DIR)
-
-    main(db)
+    with open_wackabase("square", DATABASE_DIR) as db:
+        main(db)
@@ -1,15 +1,21 @@
+import heapq
 import logging
 import os
 import re
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
 
+from wacks4square.backfill import MAX_WORKERS, Backfill
+from wacks4square.catalog import SquareCatalog
+from wacks4square.locations import LocationRegistry
 from wacksbywarby.constants import SQUARE_TIME_FORMAT
-from wacksbywarby.db import Wackabase
+from wacksbywarby.db import open_wackabase
 from wacksbywarby.models import Sale, SquareCredentials
+from wacksbywarby.sessions import API_TIMEOUT, build_session
+from wacksbywarby.stock import UNKNOWN_QUANTITY, StockResolver, apply_stock
 
 logger = logging.getLogger("square")
 
@@ -20,13 +26,50 @@ load_dotenv()
 UPCOMING_EVENT_NAME = "Connecticon"
 MAIN_LOCATION_ID = os.getenv("SQUARE_MAIN_LOCATION_ID")
 BACKUP_LOCATION_ID = os.getenv("SQUARE_BACKUP_LOCATION_ID")
-LOCATION_IDS = [MAIN_LOCATION_ID, BACKUP_LOCATION_ID]
-LOCATION_ID_TO_NAME = {MAIN_LOCATION_ID: UPCOMING_EVENT_NAME, BACKUP_LOCATION_ID: "Backup"}
+# used if the locations api can't be reached
+LOCATION_IDS = [
+    location_id for location_id in [MAIN_LOCATION_ID, BACKUP_LOCATION_ID] if location_id
+]
+# names to use instead of the ones set in square
+LOCATION_ID_TO_NAME = {
+    location_id: name
+    for location_id, name in [
+        (MAIN_LOCATION_ID, UPCOMING_EVENT_NAME),
+        (BACKUP_LOCATION_ID, "Backup"),
+    ]
+    if location_id
+}
+
+
+class PageBudget:
+    """How many more pages the searches making up one query may fetch between them"""
+
+    def __init__(self, max_pages: Optional[int]) -> None:
+        self.left = max_pages
+
+    def take(self) -> bool:
+        if self.left is None:
+            return True
+        if self.left <= 0:
+            return False
+        self.left -= 1
+        return True
 
 
 class Square:
-    def __init__(self, credentials: SquareCredentials, debug=False) -> None:
+    def __init__(
+        self,
+        credentials: SquareCredentials,
+        debug=False,
+        catalog_path: Optional[str] = None,
+        locations_path: Optional[str] = None,
+        timeout: Tuple[float, float] = API_TIMEOUT,
+        session: Optional[requests.Session] = None,
+    ) -> None:
         self.credentials = credentials
+        self.timeout = timeout
+        # one connection for each backfill worker
+        self.session = session if session is not None else build_session(MAX_WORKERS)
         # support env variables for now
         self.access_token = credentials.access_token or os.getenv("SQUARE_ACCESS_TOKEN")
         self.headers = {
@@ -34,27 +77,167 @@ class Square:
             "Content-Type": "application/json",
         }
         self.debug = debug
+        self.stock = StockResolver(self._batch_retrieve_inventory_counts)
+        # local copy of the catalog for naming sales without a request
+        self.catalog = SquareCatalog(catalog_path) if catalog_path else None
+        self.locations = LocationRegistry(
+            self._list_locations,
+            path=locations_path,
+            overrides=LOCATION_ID_TO_NAME,
+            fallback_ids=LOCATION_IDS,
+        )
 
-    def _search_orders(self, params):
+    def _search_orders(self, params) -> Dict[str, Any]:
+        """A single page of order search results, with a "cursor" if there are more"""
         logger.info(f"search orders request with params {params}")
-        response = requests.post(
-            f"{BASE_API}/orders/search", json=params, headers=self.headers
+        response = self.session.post(
+            f"{BASE_API}/orders/search",
+            json=params,
+            headers=self.headers,
+            timeout=self.timeout,
         )
         if response.ok:
             data = response.json()
-            return data.get("orders", [])
+            return data
         logger.error(f"error in search orders request: {response}")
         raise Exception(response.json())
 
+    def _iter_search_orders(
+        self, params, pages: Optional[PageBudget] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily yield every order matching the search, following the cursor square sends
+        back until the results are exhausted or the page budget is spent
+
+        https://developer.squareup.com/reference/square/orders-api/search-orders
+        """
+        pages = pages if pages is not None else PageBudget(None)
+        cursor = None
+        num_pages = 0
+        while pages.take():
+            page_params = {**params, "cursor": cursor} if cursor else params
+            data = self._search_orders(page_params)
+            num_pages += 1
+            yield from data.get("orders", [])
+            cursor = data.get("cursor")
+            if not cursor:
+                return
+        logger.warning(f"stopped searching orders after {num_pages} pages")
+
+    def _list_locations(self) -> List[Dict[str, Any]]:
+        """https://developer.squareup.com/reference/square/locations-api/list-locations"""
+        logger.info("listing locations")
+        response = self.session.get(
+            f"{BASE_API}/locations", headers=self.headers, timeout=self.timeout
+        )
+        if response.ok:
+            return response.json().get("locations", [])
+        logger.error(f"error listing locations: {response}")
+        raise Exception(response.json())
+
     def _get_order(self, order_id):
         logger.info(f"making get order request for order id {order_id}")
-        response = requests.get(f"{BASE_API}/orders/{order_id}", headers=self.headers)
+        response = self.session.get(
+            f"{BASE_API}/orders/{order_id}", headers=self.headers, timeout=self.timeout
+        )
         if response.ok:
             data = response.json()
             return data
         logger.error(f"error getting order: {response}")
         raise Exception(response.json())
 
+    def _batch_retrieve_inventory_counts(
+        self, catalog_object_ids: List[str]
+    ) -> Dict[str, int]:
+        """
+        In stock counts for each variation summed across our locations, following the
+        cursor if square splits them into pages. Variations square doesn't track stock
+        for are left out.
+
+        https://developer.squareup.com/reference/square/inventory-api/batch-retrieve-inventory-counts
+        """
+        quantities: Dict[str, int] = {}
+        for location_ids in self.locations.active_id_batches():
+            params: Dict[str, Any] = {
+                "catalog_object_ids": catalog_object_ids,
+                "location_ids": location_ids,
+                "states": ["IN_STOCK"],
+            }
+            while True:
+                logger.info(
+                    f"batch retrieving inventory counts for {len(catalog_object_ids)} ids"
+                )
+                response = self.session.post(
+                    f"{BASE_API}/inventory/counts/batch-retrieve",
+                    json=params,
+                    headers=self.headers,
+                    timeout=self.timeout,
+                )
+                if not response.ok:
+                    logger.error(f"error retrieving inventory counts: {response}")
+                    raise Exception(response.json())
+                data = response.json()
+                for count in data.get("counts", []):
+                    object_id = count["catalog_object_id"]
+                    # quantities are decimal strings, e.g. "5" or "2.5"
+                    quantity = int(float(count.get("quantity", 0)))
+                    quantities[object_id] = quantities.get(object_id, 0) + quantity
+                if not data.get("cursor"):
+                    break
+                params["cursor"] = data["cursor"]
+        return quantities
+
+    def _iter_catalog_objects(
+        self, begin_time: Optional[str] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Every item in the catalog (with its variations), or if begin_time is given just
+        the items and variations that changed since then, including deletions
+
+        https://developer.squareup.com/reference/square/catalog-api/list-catalog
+        https://developer.squareup.com/reference/square/catalog-api/search-catalog-objects
+        """
+        cursor = None
+        while True:
+            if begin_time is None:
+                params: Dict[str, Any] = {"types": "ITEM"}
+                if cursor:
+                    params["cursor"] = cursor
+                response = self.session.get(
+                    f"{BASE_API}/catalog/list",
+                    headers=self.headers,
+                    params=params,
+                    timeout=self.timeout,
+                )
+            else:
+                body: Dict[str, Any] = {
+                    "object_types": ["ITEM", "ITEM_VARIATION"],
+                    "begin_time": begin_time,
+                    "include_deleted_objects": True,
+                }
+                if cursor:
+                    body["cursor"] = cursor
+                response = self.session.post(
+                    f"{BASE_API}/catalog/search",
+                    headers=self.headers,
+                    json=body,
+                    timeout=self.timeout,
+                )
+            if not response.ok:
+                logger.error(f"error listing catalog: {response}")
+                raise Exception(response.json())
+            data = response.json()
+            yield from data.get("objects", [])
+            cursor = data.get("cursor")
+            if not cursor:
+                return
+
+    def sync_catalog(self) -> int:
+        """Bring the local catalog up to date, returning how many objects changed"""
+        if self.catalog is None:
+            raise ValueError("Square client was created without a catalog_path")
+        return self.catalog.sync(self._iter_catalog_objects)
+
     def request_all_products(self):
         """
         A util function that is useful for figuring out the catalog IDs of werbies in
@@ -62,13 +245,9 @@ class Square:
 
         https://developer.squareup.com/reference/square/catalog-api/list-catalog
         """
-        response = requests.get(
-            f"{BASE_API}/catalog/list", headers=self.headers, params={"types": ["ITEM"]}
-        )
-        products = response.json().get("objects")
         all_variations = []
-        for product in products:
-            if product["is_deleted"]:
+        for product in self._iter_catalog_objects():
+            if product.get("is_deleted"):
                 print("DELETED", product["item_data"]["name"])
                 continue
             variation_str = product["item_data"]["name"]
@@ -93,39 +272,77 @@ class Square:
             "client_secret": os.getenv("SQUARE_CLIENT_SECRET"),
             "refresh_token": self.credentials.refresh_token,
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self.session.post(
+            url, headers=self.headers, json=payload, timeout=self.timeout
+        )
         content = response.content.decode("utf-8")
         if response.ok:
             return content
         logger.error("error retrieving token! %s", content)
 
-    def _get_orders_since_timestamp(self, timestamp: str) -> List[Dict[str, any]]:
-        end_at = datetime.utcnow().isoformat()
-        # bump timestamp to get orders after this time
-        timestamp = (
-            datetime.strptime(timestamp, SQUARE_TIME_FORMAT) + timedelta(seconds=1)
-        ).isoformat()
+    def _iter_orders_since_timestamp(
+        self, timestamp: str, max_pages: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        end_at = datetime.utcnow()
+        start_at = datetime.strptime(timestamp, SQUARE_TIME_FORMAT)
+        return self._iter_orders_between(start_at, end_at, max_pages=max_pages)
+
+    def _iter_orders_between(
+        self,
+        start_at: datetime,
+        end_at: datetime,
+        max_pages: Optional[int] = None,
+        include_inactive: bool = False,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Completed orders closed in [start_at, end_at), newest first, from the active
+        locations or with include_inactive from every location square has. Square only
+        takes ten locations per search, so with more than that each batch is searched
+        on its own and the results are merged, with max_pages across all of them.
+        """
+        batches = (
+            self.locations.all_id_batches()
+            if include_inactive
+            else self.locations.active_id_batches()
+        )
+        pages = PageBudget(max_pages)
+        searches = [
+            self._iter_orders_at(location_ids, start_at, end_at, pages)
+            for location_ids in batches
+        ]
+        if len(searches) == 1:
+            return searches[0]
+        return heapq.merge(
+            *searches, key=lambda order: order.get("closed_at", ""), reverse=True
+        )
 
+    def _iter_orders_at(
+        self,
+        location_ids: List[str],
+        start_at: datetime,
+        end_at: datetime,
+        pages: PageBudget,
+    ) -> Iterator[Dict[str, Any]]:
         params = {
             "limit": 500,
-            "location_ids": LOCATION_IDS,
+            "location_ids": location_ids,
             # return full order data, not just order id
             "return_entries": False,
             "query": {
                 "filter": {
                     "date_time_filter": {
-                        "closed_at": {"start_at": timestamp, "end_at": end_at}
+                        "closed_at": {
+                            "start_at": start_at.isoformat(),
+                            "end_at": end_at.isoformat(),
+                        }
                     },
                     "state_filter": {"states": ["COMPLETED"]},
                 },
-                # there seems to be some implicit hard limits on the square API,
-                # no matter how big of a date_time_filter or limit you provide, sometimes orders are truncated.
-                # so we need to sort by desc to ensure the most recent items aren't truncated
+                # newest first, so callers can take the most recent sale as the new waterline
                 "sort": {"sort_field": "CLOSED_AT", "sort_order": "DESC"},
             },
         }
-        new_orders_response = self._search_orders(params)
-        return new_orders_response
+        return self._iter_search_orders(params, pages)
 
     def get_sales_since_timestamp(self, timestamp: Optional[str]) -> List[Sale]:
         """
@@ -137,9 +354,42 @@ class Square:
         logger.info(f"getting sales since timestamp, timestamp {timestamp}")
         if not timestamp:
             timestamp = self._get_default_start_time_in_isoformat()
-        new_orders_response = self._get_orders_since_timestamp(timestamp)
+        new_orders_response = self._iter_orders_since_timestamp(timestamp)
+        sales = self._orders_to_sales(new_orders_response)
+        self._apply_stock(sales)
+        return sales
+
+    def get_sales_for_order(self, order_id: str) -> List[Sale]:
+        """
+        Sales for a single order, e.g. one a webhook told us about. Orders that aren't
+        completed yet have nothing to announce.
+        """
+        order = self._get_order(order_id)["order"]
+        if order.get("state") != "COMPLETED":
+            logger.info(f"order {order_id} is {order.get('state')}, not announcing it")
+            return []
+        sales = self._orders_to_sales([order])
+        self._apply_stock(sales)
+        return sales
+
+    def _apply_stock(self, sales: List[Sale]):
+        listing_ids = {sale.listing_id for sale in sales if sale.listing_id != "CUSTOM"}
+        # stock cached before a variation last sold is out of date, anything cached since
+        # already counts the sale. closed_at is utc
+        sold_at: Dict[str, float] = {}
+        for sale in sales:
+            if sale.listing_id in listing_ids and sale.datetime:
+                sold_at_unix = sale.datetime.replace(tzinfo=timezone.utc).timestamp()
+                sold_at[sale.listing_id] = max(
+                    sold_at.get(sale.listing_id, 0), sold_at_unix
+                )
+        self.stock.invalidate_before(sold_at)
+        apply_stock(sales, self.stock.resolve(listing_ids))
+
+    def _orders_to_sales(self, orders: Iterable[Dict[str, Any]]) -> List[Sale]:
+        """Transform square orders into Sale objects, one for each line item"""
         sales = []
-        for order in new_orders_response:
+        for order in orders:
             order_id = order.get("id")
             line_items = order.get("line_items", [])
             if not line_items and order.get("refunds"):
@@ -147,8 +397,17 @@ class Square:
             for item in line_items:
                 listing_id = item.get("catalog_object_id")
                 item_name = item.get("name", "")
+                variation_name = item.get("variation_name")
+                # prefer the names from the synced catalog since they're kept up to date
+                catalog_names = (
+                    self.catalog.lookup(listing_id)
+                    if self.catalog and listing_id
+                    else None
+                )
+                if catalog_names:
+                    item_name, variation_name = catalog_names
                 # this is used as a fallback name for the sale if we don't find it by id in werbies.json
-                variation = f"({item.get('variation_name')})" if item.get("variation_name") else ""
+                variation = f"({variation_name})" if variation_name else ""
                 fallback_name = f'{item_name} {variation}'
                 if 'Fee' in item_name:
                     logger.info(f'skipping credit card service fee, item: {item}, order id: {order_id}')
@@ -185,55 +444,47 @@ class Square:
                     # in werbies.json rather than the catalog item id itself
                     listing_id=listing_id,
                     num_sold=num_sold,
-                    # TODO hardcode this for now since it seems like we need to make a new request to get the actual value
-                    quantity=10,
+                    # filled in from inventory counts by get_sales_since_timestamp
+                    quantity=UNKNOWN_QUANTITY,
                     datetime=sale_time,
                     # location is a square unique feature in which sales can be made from specific locations
-                    location=LOCATION_ID_TO_NAME[order["location_id"]],
-                    fallback_name=fallback_name
+                    location=self.locations.name(order["location_id"]),
+                    fallback_name=fallback_name,
+                    order_id=order_id,
+                    line_item_id=item.get("uid"),
                 )
                 sales.append(sale)
         return sales
 
-    def get_num_sales(self, last_timestamp: Optional[str], prev_num_sales: int) -> int:
-        """
-        Get total number of sales by using previously stored sales and timestamp and getting any new sales since
-        then. Note that there's some hard limit in Square's API so this doesn't actually return all the orders.
-        Use the sort by field to ensure you get either the latest orders or the earliest orders but know there's
-        no guarantee that the results weren't truncated.
-
-        last_timestamp datetime string in isoformat
-        """
-        logger.info(
-            f"getting num sales, last_timestamp {last_timestamp}, prev_num_sales: {prev_num_sales}"
-        )
-        if not last_timestamp:
-            last_timestamp = self._get_default_start_time_in_isoformat()
-        new_orders_response = self._get_orders_since_timestamp(last_timestamp)
-        num_new_orders = 0
-        for order in new_orders_response:
-            line_items = order.get("line_items", [])
-            num_new_orders += len(line_items)
-        num_total_sales = prev_num_sales + num_new_orders
-        return num_total_sales
-
-    def get_num_sales_slow(self) -> int:
+    def get_num_sales_slow(self, checkpoint_path: Optional[str] = None) -> int:
         """
-        Get total number of sales by using poor perf method of querying all orders
-        from square and counting up all line items
+        Get total number of sales by querying all orders from square and counting up all
+        line items, at every location including closed ones. The range is backfilled in
+        concurrent weekly shards, checkpointed to checkpoint_path if given.
         """
         logger.info("get num sales slow")
         start_time = self._get_default_start_time_in_isoformat()
-        new_orders_response = self._get_orders_since_timestamp(start_time)
-        num_orders = 0
-        for order in new_orders_response:
-            line_items = order.get("line_items", [])
-            if not line_items:
-                logger.info(f"refunded order {order}")
-            num_orders += len(line_items)
+        backfill = self.backfill(checkpoint_path=checkpoint_path)
+        num_orders = backfill.run(
+            datetime.fromisoformat(start_time), datetime.utcnow()
+        ).num_sales
         logger.info(f"found {num_orders} items sold via slow method")
         return num_orders
 
+    def backfill(self, checkpoint_path: Optional[str] = None, **kwargs) -> Backfill:
+        """
+        A backfill over the account's completed orders at every location, closed pop-ups
+        included, see Backfill for kwargs
+        """
+        return Backfill(
+            lambda start_at, end_at: self._iter_orders_between(
+                start_at, end_at, include_inactive=True
+            ),
+            self._orders_to_sales,
+            checkpoint_path=checkpoint_path,
+            **kwargs,
+        )
+
     @staticmethod
     def _get_default_start_time_in_isoformat() -> str:
         """
@@ -242,10 +493,13 @@ class Square:
         start_time = datetime(2022, 8, 11).isoformat()
         return start_time
 
+    def close(self):
+        self.session.close()
+
 
 if __name__ == "__main__":
     load_dotenv()
-    db = Wackabase("data/wack4square")
+    db = open_wackabase("square", "data/wack4square")
     creds = db.get_square_creds()
     square = Square(credentials=creds, debug=True)
     # start_time = (datetime.utcnow() - timedelta(hours=300)).isoformat()
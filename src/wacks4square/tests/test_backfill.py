@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from wacks4square.backfill import Backfill, shard_range
+from wacksbywarby.models import Sale
+
+START = datetime(2023, 1, 1)
+END = datetime(2023, 1, 29, 12)
+
+
+def fake_orders(start: datetime, end: datetime):
+    """One order with two line items and a card fee per day, newest first"""
+    day = end.replace(hour=0) if end.hour else end - timedelta(days=1)
+    while day >= start:
+        yield {"id": day.isoformat(), "line_items": [{}, {}, {"name": "Fee"}]}
+        day -= timedelta(days=1)
+
+
+def orders_to_sales(orders) -> List[Sale]:
+    return [
+        Sale(
+            listing_id="X",
+            quantity=10,
+            num_sold=1,
+            datetime=datetime.fromisoformat(order["id"]),
+            location=None,
+            fallback_name=None,
+        )
+        for order in orders
+        for item in order["line_items"]
+        if item.get("name") != "Fee"
+    ]
+
+
+def test_shard_range():
+    shards = shard_range(START, END, timedelta(weeks=1))
+    assert len(shards) == 5
+    assert shards[0] == (START, START + timedelta(weeks=1))
+    assert shards[-1] == (datetime(2023, 1, 29), END)
+
+
+def test_backfill_merges_shards_in_order():
+    result = Backfill(fake_orders, orders_to_sales).run(START, END, collect_sales=True)
+    assert result.num_sales == 29 * 2
+    times = [sale.datetime for sale in result.sales]
+    assert times == sorted(times, reverse=True)
+    assert len(times) == 29 * 2
+
+
+def test_backfill_resumes_from_checkpoint(tmp_path: Path):
+    checkpoint = str(tmp_path / "backfill.json")
+
+    def flaky_orders(start: datetime, end: datetime):
+        if start == datetime(2023, 1, 15):
+            raise RuntimeError("square is down")
+        return fake_orders(start, end)
+
+    with pytest.raises(RuntimeError):
+        Backfill(flaky_orders, orders_to_sales, checkpoint).run(START, END)
+
+    searched: List[datetime] = []
+
+    def only_open_shard(start: datetime, end: datetime):
+        searched.append(start)
+        return fake_orders(start, end)
+
+    # every shard that finished was checkpointed, even ones after the failure
+    result = Backfill(only_open_shard, orders_to_sales, checkpoint).run(START, END)
+    assert result.num_sales == 29 * 2
+    assert sorted(searched) == [datetime(2023, 1, 15), datetime(2023, 1, 29)]
+    searched.clear()
+
+    backfill = Backfill(only_open_shard, orders_to_sales, checkpoint)
+    assert backfill.run(START, END).num_sales == 58
+    # the last shard ends at END rather than a week in, so it's always searched again
+    assert searched == [datetime(2023, 1, 29)]
+    assert backfill.run(START, END + timedelta(hours=1)).num_sales == 58
+    assert len(backfill._read_checkpoint()) == 4
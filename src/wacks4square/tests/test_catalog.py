@@ -0,0 +1,60 @@
+from pathlib import Path
+from typing import List, Optional
+
+from wacks4square.catalog import SquareCatalog
+
+
+def variation(variation_id: str, item_id: str, name: str, is_deleted=False) -> dict:
+    return {
+        "type": "ITEM_VARIATION",
+        "id": variation_id,
+        "is_deleted": is_deleted,
+        "item_variation_data": {"item_id": item_id, "name": name},
+    }
+
+
+NYX = {
+    "type": "ITEM",
+    "id": "NYX",
+    "is_deleted": False,
+    "item_data": {
+        "name": "Nyx",
+        "variations": [
+            variation("NYX_TIN", "NYX", "4oz Tin Candle"),
+            variation("NYX_MELT", "NYX", "Wax Melts"),
+        ],
+    },
+}
+
+
+def test_catalog_sync_is_incremental(tmp_path: Path):
+    path = str(tmp_path / "square_catalog.json")
+    begin_times: List[Optional[str]] = []
+
+    def full_catalog(begin_time: Optional[str]):
+        begin_times.append(begin_time)
+        return iter([NYX])
+
+    catalog = SquareCatalog(path)
+    assert catalog.is_stale()
+    catalog.sync(full_catalog)
+    assert catalog.lookup("NYX_TIN") == ("Nyx", "4oz Tin Candle")
+    assert not catalog.is_stale()
+
+    def changes(begin_time: Optional[str]):
+        begin_times.append(begin_time)
+        return iter(
+            [
+                variation("NYX_MELT", "NYX", "Wax Melts", is_deleted=True),
+                variation("NYX_GLASS", "NYX", "8oz Glass Candle"),
+            ]
+        )
+
+    # a fresh process picks up where the last sync left off
+    reloaded = SquareCatalog(path)
+    reloaded.sync(changes)
+    assert begin_times[0] is None
+    assert begin_times[1] == catalog.synced_at
+    assert reloaded.lookup("NYX_GLASS") == ("Nyx", "8oz Glass Candle")
+    assert reloaded.lookup("NYX_MELT") is None
+    assert reloaded.lookup("NYX_TIN") == ("Nyx", "4oz Tin Candle")
@@ -0,0 +1,62 @@
+from pathlib import Path
+
+from wacks4square.locations import LocationRegistry
+
+LOCATIONS = [
+    {"id": "MAIN", "name": "Warby HQ", "status": "ACTIVE"},
+    {"id": "POPUP", "name": "Connecticon", "status": "ACTIVE"},
+    {"id": "OLD", "name": "Closed Shop", "status": "INACTIVE"},
+]
+
+
+def test_locations_are_cached_and_overridden(tmp_path: Path):
+    path = str(tmp_path / "square_locations.json")
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return LOCATIONS
+
+    registry = LocationRegistry(fetch, path=path, overrides={"MAIN": "Anime Expo"})
+    assert registry.active_ids() == ["MAIN", "POPUP"]
+    assert registry.name("MAIN") == "Anime Expo"
+    assert registry.name("POPUP") == "Connecticon"
+    assert len(calls) == 1
+
+    # a fresh registry reads the cache instead of asking square again
+    cached = LocationRegistry(fetch, path=path)
+    assert cached.active_ids() == ["MAIN", "POPUP"]
+    assert len(calls) == 1
+
+
+def test_unknown_location_refreshes_once_then_uses_the_id():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        if len(calls) > 1:
+            raise RuntimeError("square is down")
+        return LOCATIONS
+
+    registry = LocationRegistry(fetch, fallback_ids=["MAIN"])
+    assert registry.name("NEW") == "NEW"
+    assert registry.name("NEW") == "NEW"
+    assert len(calls) == 1
+    assert registry.active_ids() == ["MAIN", "POPUP"]
+
+
+def test_falls_back_when_square_is_unreachable():
+    def fetch():
+        raise RuntimeError("square is down")
+
+    registry = LocationRegistry(fetch, fallback_ids=["MAIN"])
+    assert registry.active_ids() == ["MAIN"]
+    assert registry.name("MAIN") == "MAIN"
+
+
+def test_active_ids_in_batches_of_ten():
+    many = [{"id": f"L{i}", "name": f"Shop {i}"} for i in range(23)]
+    registry = LocationRegistry(lambda: many)
+    batches = registry.active_id_batches()
+    assert [len(batch) for batch in batches] == [10, 10, 3]
+    assert sum(batches, []) == registry.active_ids()
@@ -1,7 +1,9 @@
+from datetime import datetime
 from pathlib import Path
 
 import pytest
 
+from wacks4square.square import Square
 from wacksbywarby.db import Wackabase
 from wacksbywarby.models import SquareCredentials
 
@@ -33,3 +35,71 @@ def test_square_creds_io(temp_database: Path, square_token: str):
     db.write_square_creds(creds)
     read_creds = db.get_square_creds()
     assert read_creds.to_string() == square_token
+
+
+def test_search_orders_follows_cursor(square_token: str, monkeypatch):
+    """Pages through order search results until there's no cursor left"""
+    pages = {
+        None: {"orders": [{"id": "1"}, {"id": "2"}], "cursor": "a"},
+        "a": {"orders": [{"id": "3"}], "cursor": "b"},
+        "b": {"orders": [{"id": "4"}]},
+    }
+    monkeypatch.setattr(
+        Square, "_search_orders", lambda self, params: pages[params.get("cursor")]
+    )
+    square = Square(credentials=SquareCredentials.from_string(square_token))
+    orders = square._iter_orders_since_timestamp("2023-03-07T04:32:14")
+    assert [order["id"] for order in orders] == ["1", "2", "3", "4"]
+    capped = square._iter_orders_since_timestamp("2023-03-07T04:32:14", max_pages=2)
+    assert [order["id"] for order in capped] == ["1", "2", "3"]
+
+
+def test_search_orders_across_more_than_ten_locations(square_token: str, monkeypatch):
+    """Each search gets at most ten locations and the results stay newest first"""
+    locations = [{"id": f"L{i}", "name": f"Shop {i}"} for i in range(12)]
+    monkeypatch.setattr(Square, "_list_locations", lambda self: locations)
+    searched = []
+
+    def search_orders(self, params):
+        searched.append(params["location_ids"])
+        return {
+            "orders": [
+                {"id": f"{location_id}", "closed_at": f"2023-07-07T12:{minute:02}:00Z"}
+                for minute, location_id in sorted(
+                    [(int(i[1:]), i) for i in params["location_ids"]], reverse=True
+                )
+            ]
+        }
+
+    monkeypatch.setattr(Square, "_search_orders", search_orders)
+    square = Square(credentials=SquareCredentials.from_string(square_token))
+    orders = list(square._iter_orders_since_timestamp("2023-07-07T00:00:00"))
+    assert [len(location_ids) for location_ids in searched] == [10, 2]
+    assert [order["id"] for order in orders] == [f"L{i}" for i in range(11, -1, -1)]
+
+
+def test_backfill_searches_closed_locations_and_caps_pages_overall(
+    square_token: str, monkeypatch
+):
+    locations = [{"id": f"L{i}", "name": f"Shop {i}"} for i in range(12)]
+    locations.append({"id": "POPUP", "name": "Connecticon", "status": "INACTIVE"})
+    monkeypatch.setattr(Square, "_list_locations", lambda self: locations)
+    searched = []
+
+    def search_orders(self, params):
+        searched.append(params["location_ids"])
+        cursor = int(params.get("cursor", 0))
+        return {"orders": [{"id": f"{cursor}", "closed_at": ""}], "cursor": cursor + 1}
+
+    monkeypatch.setattr(Square, "_search_orders", search_orders)
+    square = Square(credentials=SquareCredentials.from_string(square_token))
+    start, end = datetime(2023, 7, 1), datetime(2023, 7, 8)
+
+    # the poll only searches the open locations, at most three pages between them
+    assert len(list(square._iter_orders_between(start, end, max_pages=3))) == 3
+    assert len(searched) == 3
+    assert "POPUP" not in [i for location_ids in searched for i in location_ids]
+
+    searched.clear()
+    list(square._iter_orders_between(start, end, max_pages=3, include_inactive=True))
+    assert "POPUP" in searched[1]
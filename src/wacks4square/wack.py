@@ -1,65 +1,123 @@
 import argparse
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Callable, List, Optional
 
 from dotenv import load_dotenv
 from filelock import FileLock, Timeout
 
-from wacks4square.constants import DATABASE_DIR, LOCKFILE
+from wacks4square.constants import (
+    BACKFILL_CHECKPOINT,
+    CATALOG_FILE,
+    DATABASE_DIR,
+    LOCATIONS_FILE,
+    LOCKFILE,
+)
 from wacks4square.square import Square
 from wacksbywarby.constants import SHIFT4SHOP_TIME_FORMAT, WACK_ERROR_SENTINEL
-from wacksbywarby.db import Wackabase
+from wacksbywarby.db import Wackabase, open_wackabase
 from wacksbywarby.discord import Discord
-from wacksbywarby.wack import announce_new_sales
+from wacksbywarby.ledger import OVERLAP_SECONDS, SalesLedger
+from wacksbywarby.models import Sale
+from wacksbywarby.outbox import Outbox
+from wacksbywarby.wack import flush_outbox
 
 load_dotenv()
 
 logger = logging.getLogger("wack4square")
 
 
-def main(db: Wackabase, dry=False):
+def make_client(db: Wackabase, dry=False) -> Square:
+    return Square(
+        credentials=db.get_square_creds(),
+        debug=dry,
+        catalog_path=str(Path(DATABASE_DIR) / CATALOG_FILE),
+        locations_path=str(Path(DATABASE_DIR) / LOCATIONS_FILE),
+    )
+
+
+def main(
+    db: Wackabase,
+    dry=False,
+    client: Optional[Square] = None,
+    discord: Optional[Discord] = None,
+    on_sales: Optional[Callable[[List[Sale]], None]] = None,
+):
+    """
+    Poll square for new sales and announce them. A long running caller can pass in its
+    own client and discord to reuse them across polls, and on_sales to hear about the
+    new sales each poll found.
+    """
     try:
         logger.info("TIME TO WACK")
         logger.debug("Dry run: %s", dry)
 
-        discord = Discord(debug=dry)
-        square_creds = db.get_square_creds()
-        square = Square(credentials=square_creds, debug=dry)
+        if discord is None:
+            discord = Discord(debug=dry)
+        square = client if client is not None else make_client(db, dry=dry)
+        if square.catalog and square.catalog.is_stale():
+            try:
+                square.sync_catalog()
+            except Exception as e:
+                # names fall back to what's on the order, so this shouldn't stop the poll
+                logger.error(
+                    "%s could not sync square catalog: %s", WACK_ERROR_SENTINEL, e
+                )
+        outbox = Outbox(db, provider="square")
 
         last_timestamp = db.get_timestamp()
-        # stored in db with shift4shop format, but square requires RFC 3339 format so let's convert it
+        waterline = None
+        query_from = None
+        # stored in db with shift4shop format, but square requires RFC 3339 format so let's convert it.
+        # look back a little past the waterline, the ledger drops what we've seen
         if last_timestamp:
-            last_timestamp = datetime.strptime(
-                last_timestamp, SHIFT4SHOP_TIME_FORMAT
-            ).isoformat()
-
-        last_num_sales = db.get_last_num_sales()
-        sales = square.get_sales_since_timestamp(timestamp=last_timestamp)
-        if not sales:
-            return
-
-        logger.info(f"last timestamp was {last_timestamp}")
-
-        # grab the current number of total sales
-        if last_num_sales:
-            current_num_sales = square.get_num_sales(
-                last_timestamp=last_timestamp, prev_num_sales=last_num_sales
+            waterline = datetime.strptime(last_timestamp, SHIFT4SHOP_TIME_FORMAT)
+            query_from = (waterline - timedelta(seconds=OVERLAP_SECONDS)).isoformat()
+
+        ledger = SalesLedger(db.ledger_path)
+        try:
+            ledger.seed("square", waterline, db.get_last_num_sales())
+            fetched = square.get_sales_since_timestamp(timestamp=query_from)
+            sales = ledger.unseen("square", fetched)
+            if not sales:
+                # retry anything a previous run couldn't get out
+                flush_outbox(discord, outbox, ledger.num_sales("square"))
+                return
+
+            logger.info(f"last timestamp was {last_timestamp}")
+            if on_sales:
+                on_sales(sales)
+
+            # grab the current number of total sales, backfilling using slow method
+            backfilled = None
+            if not ledger.num_sales("square"):
+                backfilled = square.get_num_sales_slow(
+                    checkpoint_path=str(Path(DATABASE_DIR) / BACKFILL_CHECKPOINT)
+                )
+
+            # sales are by timestamp desc, so flip it in order to announce them from oldest to newest.
+            # queued first, the outbox drops them if a crash has them queued again
+            outbox.enqueue(reversed(sales))
+
+            # the waterline only moves forward, a late sale inside the overlap doesn't pull it back
+            latest_sale_timestamp = max(
+                (sale.datetime for sale in sales if sale.datetime), default=None
             )
-        else:
-            # backfill using slow method
-            current_num_sales = square.get_num_sales_slow()
-
-        logger.info(f"current num sales: {current_num_sales}")
-
-        # sales are by timestamp desc, so flip it in order to announce them from oldest to newest
-        announce_new_sales(discord, list(reversed(sales)), current_num_sales, id_type="square")
+            if (
+                waterline
+                and latest_sale_timestamp
+                and latest_sale_timestamp <= waterline
+            ):
+                latest_sale_timestamp = None
+            current_num_sales = ledger.record_poll(
+                db, "square", sales, latest_sale_timestamp, backfilled
+            )
+            logger.info(f"current num sales: {current_num_sales}")
+        finally:
+            ledger.close()
 
-        # write out the most recent sale's date (results were sorted by closed at desc, so latest one is first one)
-        latest_sale_timestamp = sales[0].datetime
-        if latest_sale_timestamp:
-            db.write_timestamp(latest_sale_timestamp)
-            db.write_num_sales(current_num_sales)
+        flush_outbox(discord, outbox, current_num_sales)
 
     except Exception as e:
         logger.error("%s: %s", WACK_ERROR_SENTINEL, e)
@@ -85,8 +143,8 @@ if __name__ == "__main__":
             # create the database folder if it doesn't exit
             Path(DATABASE_DIR).mkdir(parents=True, exist_ok=True)
 
-            wackabase = Wackabase(DATABASE_DIR)
-            main(db=wackabase, dry=args.dry)
-            wackabase.write_success()
+            with open_wackabase("square", DATABASE_DIR) as wackabase:
+                main(db=wackabase, dry=args.dry)
+                wackabase.write_success()
     except Timeout:
         logger.info("Could not acquire lock! Exiting.")
@@ -0,0 +1,85 @@
+"""How often to poll a provider, based on how fast sales have been coming in"""
+
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional
+
+from wacksbywarby.models import Sale
+
+# how far back to look when working out how fast sales are coming in
+RATE_WINDOW_SECONDS = 15 * 60
+# while sales are flowing, poll often enough to catch about this many per poll
+TARGET_SALES_PER_POLL = 1.0
+# each idle poll multiplies the interval by this, up to the ceiling
+BACKOFF_FACTOR = 2.0
+DEFAULT_CEILING_SECONDS = 15 * 60
+
+
+class Cadence:
+    """
+    Tracks recent sales for one provider and picks the wait before its next poll.
+
+    When sales have come in recently the interval shrinks to roughly the time between
+    sales, but never below floor, which should keep the provider's api rate limits in
+    mind. Once nothing has sold for a whole window each empty poll doubles the interval
+    until it reaches ceiling.
+
+    Sale times come from Sale.datetime, but providers disagree on timezones, so only
+    the spacing between a poll's sales is used, with the newest one placed at the time
+    of the poll.
+    """
+
+    def __init__(
+        self,
+        base: float,
+        floor: float,
+        ceiling: float = DEFAULT_CEILING_SECONDS,
+        window: float = RATE_WINDOW_SECONDS,
+    ) -> None:
+        self.base = max(base, floor)
+        self.floor = floor
+        self.ceiling = max(ceiling, self.base)
+        self.window = window
+        self.sale_times: Deque[float] = deque()
+        self.idle_polls = 0
+        self._lock = threading.Lock()
+
+    def record(self, sales: List[Sale], polled_at: Optional[float] = None):
+        """Record the new sales a poll found, or [] if it found none or failed"""
+        polled_at = time.time() if polled_at is None else polled_at
+        with self._lock:
+            if sales:
+                self.sale_times.extend(sorted(self._sale_times(sales, polled_at)))
+            while self.sale_times and self.sale_times[0] < polled_at - self.window:
+                self.sale_times.popleft()
+            # only polls after the window has emptied count towards backing off
+            if self.sale_times:
+                self.idle_polls = 0
+            else:
+                self.idle_polls += 1
+
+    def next_interval(self) -> float:
+        with self._lock:
+            if self.sale_times:
+                rate = len(self.sale_times) / self.window
+                interval = TARGET_SALES_PER_POLL / rate
+                return min(max(interval, self.floor), self.base)
+            # nothing in the window, so back off from the base interval
+            backoff = BACKOFF_FACTOR ** max(self.idle_polls - 1, 0)
+            return min(self.base * backoff, self.ceiling)
+
+    @staticmethod
+    def _sale_times(sales: List[Sale], polled_at: float) -> List[float]:
+        datetimes = [sale.datetime for sale in sales if sale.datetime]
+        if not datetimes:
+            return [polled_at] * len(sales)
+        newest = max(datetimes)
+        return [
+            (
+                polled_at - (newest - sale.datetime).total_seconds()
+                if sale.datetime
+                else polled_at
+            )
+            for sale in sales
+        ]
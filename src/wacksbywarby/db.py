@@ -1,9 +1,19 @@
-"""Super simple text file db"""
+"""
+Super simple text file db, or a single sqlite file shared by every provider when
+WACKS_SQLITE_PATH is set
+"""
+import argparse
+import json
 import logging
+import os
+import sqlite3
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional, Union
+
+from dotenv import load_dotenv
 
 from wacksbywarby.constants import SHIFT4SHOP_TIME_FORMAT, WACK_ERROR_SENTINEL
 from wacksbywarby.models import SquareCredentials, EtsyCredentials
@@ -11,6 +21,8 @@ from wacksbywarby.models import SquareCredentials, EtsyCredentials
 logger = logging.getLogger("db")
 
 DATA_DIR = "data"
+# how long to wait on another process's write before giving up
+SQLITE_BUSY_TIMEOUT_SECONDS = 30
 
 
 class Wackabase:
@@ -21,6 +33,8 @@ class Wackabase:
         self.timestamp_path = data_path / "timestamp.txt"
         self.square_creds = data_path / "square_creds.json"
         self.etsy_creds = data_path / "etsy_creds.json"
+        self.outbox_path = data_path / "outbox.json"
+        self.ledger_path = data_path / "ledger.sqlite3"
 
     def get_last_num_sales(self):
         try:
@@ -35,6 +49,11 @@ class Wackabase:
         with open(self.num_sales_path, "w") as f:
             f.write(str(num_sales))
 
+    def write_poll_state(self, timestamp: datetime, num_sales: int):
+        """The waterline and the count it goes with"""
+        self.write_timestamp(timestamp)
+        self.write_num_sales(num_sales)
+
     def get_last_success(self):
         try:
             with open(self.last_success_path) as f:
@@ -78,3 +97,322 @@ class Wackabase:
             creds = f.read()
             return EtsyCredentials.from_string(creds)
 
+    def get_creds_stamp(self, kind: str) -> Optional[int]:
+        """Changes whenever the etsy or square creds are rewritten"""
+        path = self.etsy_creds if kind == "etsy" else self.square_creds
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def get_outbox(self) -> dict:
+        try:
+            with open(self.outbox_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_outbox(self, entries: dict):
+        # write to a temp file and swap it in so a crash never leaves a half written outbox
+        tmp_path = self.outbox_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.outbox_path)
+
+    def close(self):
+        """Nothing is held open between calls, this is for parity with SqliteWackabase"""
+
+    def __enter__(self) -> "Wackabase":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class SqliteWackabase:
+    """
+    The same interface as Wackabase, but every provider's state lives in one sqlite
+    file in WAL mode, so several processes can share it, and the waterline and sales
+    count are written in one transaction so a crash can't leave them out of step.
+    """
+
+    def __init__(self, path: Union[str, Path], provider: str) -> None:
+        self.path = Path(path)
+        # the sales ledger keeps its own table in the same file
+        self.ledger_path = self.path
+        self.provider = provider
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path),
+            timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL is durable enough at NORMAL, a crash can only lose the last commit
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    def _transaction(self):
+        return _Transaction(self._conn, self._lock)
+
+    def transaction(self) -> "_Transaction":
+        """A write transaction, for tables in the same file that commit with ours"""
+        return self._transaction()
+
+    def _get(self, column: str):
+        with self._transaction() as conn:
+            row = conn.execute(
+                f"SELECT {column} FROM poll_state WHERE provider = ?", (self.provider,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, conn: sqlite3.Connection, column: str, value):
+        conn.execute(
+            f"INSERT INTO poll_state (provider, {column}) VALUES (?, ?) "
+            f"ON CONFLICT (provider) DO UPDATE SET {column} = excluded.{column}",
+            (self.provider, value),
+        )
+
+    def get_last_num_sales(self):
+        num_sales = self._get("num_sales")
+        if num_sales is None:
+            logger.error("%s No last num sales", WACK_ERROR_SENTINEL)
+            return 0
+        return num_sales
+
+    def write_num_sales(self, num_sales):
+        with self._transaction() as conn:
+            self._set(conn, "num_sales", int(num_sales))
+
+    def get_last_success(self):
+        return self._get("last_success") or 0
+
+    def write_success(self):
+        with self._transaction() as conn:
+            self._set(conn, "last_success", time.time())
+
+    def write_timestamp(self, timestamp: datetime):
+        with self._transaction() as conn:
+            self._set(conn, "timestamp", timestamp.strftime(SHIFT4SHOP_TIME_FORMAT))
+
+    def get_timestamp(self) -> Optional[str]:
+        return self._get("timestamp")
+
+    def write_poll_state(self, timestamp: datetime, num_sales: int):
+        """The waterline and the count it goes with, committed together"""
+        with self._transaction() as conn:
+            self.set_poll_state(conn, timestamp, num_sales)
+
+    def set_poll_state(
+        self, conn: sqlite3.Connection, timestamp: Optional[datetime], num_sales: int
+    ):
+        """write_poll_state inside a transaction, a timestamp of None leaves it be"""
+        if timestamp:
+            self._set(conn, "timestamp", timestamp.strftime(SHIFT4SHOP_TIME_FORMAT))
+        self._set(conn, "num_sales", int(num_sales))
+
+    def _write_creds(self, kind: str, creds: str):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO credentials (kind, creds, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (kind) DO UPDATE SET "
+                "creds = excluded.creds, updated_at = excluded.updated_at",
+                (kind, creds, time.time_ns()),
+            )
+
+    def _get_creds(self, kind: str) -> str:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT creds FROM credentials WHERE kind = ?", (kind,)
+            ).fetchone()
+        if row is None:
+            # same as the file db when the creds file is missing
+            raise FileNotFoundError(f"no {kind} creds in {self.path}")
+        return row[0]
+
+    def write_square_creds(self, creds: SquareCredentials):
+        self._write_creds("square", creds.to_string())
+
+    def get_square_creds(self):
+        return SquareCredentials.from_string(self._get_creds("square"))
+
+    def write_etsy_creds(self, creds: EtsyCredentials):
+        self._write_creds("etsy", creds.to_string())
+
+    def get_etsy_creds(self):
+        return EtsyCredentials.from_string(self._get_creds("etsy"))
+
+    def get_creds_stamp(self, kind: str) -> Optional[int]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT updated_at FROM credentials WHERE kind = ?", (kind,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_outbox(self) -> dict:
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT key, entry FROM outbox WHERE provider = ? ORDER BY position",
+                (self.provider,),
+            ).fetchall()
+        return {key: json.loads(entry) for key, entry in rows}
+
+    def write_outbox(self, entries: dict):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM outbox WHERE provider = ?", (self.provider,))
+            conn.executemany(
+                "INSERT INTO outbox (provider, key, position, entry) "
+                "VALUES (?, ?, ?, ?)",
+                (
+                    (self.provider, key, position, json.dumps(entry))
+                    for position, (key, entry) in enumerate(entries.items())
+                ),
+            )
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self) -> "SqliteWackabase":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS poll_state (
+    provider TEXT PRIMARY KEY,
+    timestamp TEXT,
+    num_sales INTEGER,
+    last_success REAL
+);
+CREATE TABLE IF NOT EXISTS credentials (
+    kind TEXT PRIMARY KEY,
+    creds TEXT NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    provider TEXT NOT NULL,
+    key TEXT NOT NULL,
+    -- keeps the outbox in the order sales were recorded
+    position INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (provider, key)
+);
+"""
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolling back if anything raises"""
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock) -> None:
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+AnyWackabase = Union[Wackabase, SqliteWackabase]
+
+
+def open_wackabase(provider: str, data_dir: str = DATA_DIR) -> AnyWackabase:
+    """A provider's db, the shared sqlite file if one is configured or its data dir"""
+    sqlite_path = os.getenv("WACKS_SQLITE_PATH")
+    if sqlite_path:
+        return SqliteWackabase(sqlite_path, provider)
+    return Wackabase(data_dir)
+
+
+# provider -> the data directory its text file db lives in
+PROVIDER_DATA_DIRS = {
+    "etsy": DATA_DIR,
+    "square": "data/wack4square",
+    "shift4shop": "data/wacks4shop",
+}
+
+
+def migrate(sqlite_path: str, force=False) -> Iterator[str]:
+    """
+    Copy every provider's text file db into the sqlite file, yielding the providers
+    that were copied. Providers already in the sqlite file are skipped unless force.
+    """
+    for provider, data_dir in PROVIDER_DATA_DIRS.items():
+        if not Path(data_dir).is_dir():
+            continue
+        old = Wackabase(data_dir)
+        new = SqliteWackabase(sqlite_path, provider)
+        try:
+            if new.get_timestamp() is not None and not force:
+                logger.info(f"{provider} was already migrated, skipping")
+                continue
+            with new._transaction() as conn:
+                timestamp = old.get_timestamp()
+                if timestamp:
+                    new._set(conn, "timestamp", timestamp)
+                if old.num_sales_path.exists():
+                    new._set(conn, "num_sales", old.get_last_num_sales())
+                new._set(conn, "last_success", old.get_last_success())
+            for kind, path in (("etsy", old.etsy_creds), ("square", old.square_creds)):
+                if path.exists():
+                    new._write_creds(kind, path.read_text())
+            new.write_outbox(old.get_outbox())
+            if old.ledger_path.exists():
+                # imported here since the ledger builds on this module
+                from wacksbywarby.ledger import SalesLedger
+
+                ledger = SalesLedger(new.ledger_path)
+                try:
+                    num_sales = ledger.copy_from(old.ledger_path, provider)
+                finally:
+                    ledger.close()
+                logger.info(f"copied {num_sales} {provider} sales from the ledger")
+            logger.info(f"migrated {provider} from {data_dir}")
+            yield provider
+        finally:
+            new.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wackabase!!")
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        required=False,
+        help="copy the text file dbs under data/ into WACKS_SQLITE_PATH",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        required=False,
+        help="overwrite providers that were already migrated",
+    )
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    load_dotenv()
+    args = parser.parse_args()
+    sqlite_path = os.getenv("WACKS_SQLITE_PATH")
+    if not args.migrate:
+        parser.print_help()
+    elif not sqlite_path:
+        logger.error("Set WACKS_SQLITE_PATH to the sqlite file to migrate into")
+    else:
+        migrated = list(migrate(sqlite_path, force=args.force))
+        logger.info(f"done! migrated {migrated}")
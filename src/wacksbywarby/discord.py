@@ -1,8 +1,17 @@
+import logging
 import os
+import threading
+import time
+from typing import List, Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
 
+from wacksbywarby.constants import WACK_ERROR_SENTINEL
+from wacksbywarby.sessions import build_session
+
+logger = logging.getLogger("discord")
+
 TOM_NOOK_URL = "https://gonintendo.com/uploads/file_upload/upload/72974/wb.jpg"
 CHEESE_KUN_URL = "https://pbs.twimg.com/media/DdsHM25U0AE7z8P?format=jpg&name=large"
 PIZZA_IMAGE_URLS = [
@@ -29,15 +38,150 @@ BOSTON_IMAGE_URLS = [
     "https://bostonglobe-prod.cdn.arcpublishing.com/resizer/Y6FBI4Vur93m-REZN2ckZVZJayw=/1440x0/arc-anglerfish-arc2-prod-bostonglobe.s3.amazonaws.com/public/2DP5CFVDGMI6TKM5KT3RK4TRNE.jpg",
     "https://charlesriverboat.com/wp-content/uploads/2019/08/Memorial-Drive-in-Fall.jpg",
 ]
+# how many keep-alive connections to discord we hold on to
+DEFAULT_POOL_SIZE = 4
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+# how many times a throttled payload is retried before we give up on it
+MAX_RATE_LIMIT_RETRIES = 5
+
+# https://discord.com/developers/docs/resources/channel#embed-object-embed-limits
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_MESSAGE_EMBED_CHARACTERS = 6000
+MAX_TITLE_LENGTH = 256
+MAX_DESCRIPTION_LENGTH = 4096
+MAX_FOOTER_LENGTH = 2048
+
+
+def _truncate(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    return text[: limit - 1] + "…"
+
+
+def embed_length(embed: dict) -> int:
+    """The characters of an embed that count towards discord's per message total"""
+    length = len(embed.get("title") or "") + len(embed.get("description") or "")
+    if embed.get("footer"):
+        length += len(embed["footer"].get("text") or "")
+    if embed.get("author"):
+        length += len(embed["author"].get("name") or "")
+    for field in embed.get("fields") or []:
+        length += len(field.get("name") or "") + len(field.get("value") or "")
+    return length
+
+
+def _fit_embed(embed: dict) -> dict:
+    """Truncate any text that's over discord's limits, logging what had to be cut"""
+    fitted = dict(embed)
+    if fitted.get("title"):
+        fitted["title"] = _truncate(fitted["title"], MAX_TITLE_LENGTH)
+    if fitted.get("footer") and fitted["footer"].get("text"):
+        fitted["footer"] = {
+            **fitted["footer"],
+            "text": _truncate(fitted["footer"]["text"], MAX_FOOTER_LENGTH),
+        }
+    if fitted.get("description"):
+        fitted["description"] = _truncate(fitted["description"], MAX_DESCRIPTION_LENGTH)
+        overflow = embed_length(fitted) - MAX_MESSAGE_EMBED_CHARACTERS
+        if overflow > 0:
+            fitted["description"] = _truncate(
+                fitted["description"], len(fitted["description"]) - overflow
+            )
+    if fitted != embed:
+        logger.warning(
+            "truncated embed to fit discord's limits: %s", embed.get("title")
+        )
+    return fitted
+
+
+def pack_embeds(embeds: List[dict]) -> List[List[dict]]:
+    """
+    Split embeds into as few messages as possible, keeping them in order, where each
+    message stays under both the embed count and total character limits
+    """
+    messages: List[List[dict]] = []
+    current: List[dict] = []
+    current_length = 0
+    for embed in map(_fit_embed, embeds):
+        length = embed_length(embed)
+        if current and (
+            len(current) == MAX_EMBEDS_PER_MESSAGE
+            or current_length + length > MAX_MESSAGE_EMBED_CHARACTERS
+        ):
+            messages.append(current)
+            current = []
+            current_length = 0
+        current.append(embed)
+        current_length += length
+    if current:
+        messages.append(current)
+    return messages
+
+
+class DiscordError(Exception):
+    """Discord didn't accept a payload"""
+
+
+class RateLimitBucket:
+    """
+    Tracks the webhook's rate limit bucket from the headers discord sends back, so we
+    only wait when discord tells us the bucket is empty instead of sleeping between
+    every message.
+
+    https://discord.com/developers/docs/topics/rate-limits
+    """
+
+    def __init__(self) -> None:
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+
+    def wait(self):
+        """Block until the bucket has room for another request"""
+        if self.remaining != 0:
+            return
+        delay = self.reset_at - time.monotonic()
+        if delay > 0:
+            logger.info("rate limit bucket empty, waiting %.2fs", delay)
+            time.sleep(delay)
+        self.remaining = None
+
+    def update(self, response: requests.Response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset_after = response.headers.get("X-RateLimit-Reset-After")
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = time.monotonic() + float(reset_after)
+
+    @staticmethod
+    def retry_after(response: requests.Response) -> float:
+        """How long discord asked us to back off for after a 429"""
+        try:
+            return float(response.json()["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return float(response.headers.get("Retry-After", 1))
 
 
 class Discord:
-    def __init__(self, debug=False) -> None:
+    def __init__(
+        self,
+        debug=False,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+        session: Optional[requests.Session] = None,
+    ) -> None:
         self.webhook = (
             os.getenv("DISCORD_DEBUG_WEBHOOK")
             if debug
             else os.getenv("DISCORD_WEBHOOK")
         )
+        self.timeout = timeout
+        self.session = session if session is not None else build_session(pool_size)
+        self.bucket = RateLimitBucket()
+        # held while sending a batch of messages, so when several providers share one
+        # discord their announcements don't interleave
+        self.lock = threading.RLock()
 
     def send_healthcheck_message(self, message):
         payload = {
@@ -84,10 +228,29 @@ class Discord:
 
     def _make_request(self, payload):
         print("request", payload)
-        res = requests.post(self.webhook, json=payload)
-        if res.status_code >= 400:
-            print("status code", res.status_code)
-            print(res.json())
+        for _ in range(MAX_RATE_LIMIT_RETRIES + 1):
+            self.bucket.wait()
+            res = self.session.post(self.webhook, json=payload, timeout=self.timeout)
+            self.bucket.update(res)
+            if res.status_code == 429:
+                retry_after = self.bucket.retry_after(res)
+                logger.warning("throttled by discord, retrying in %.2fs", retry_after)
+                time.sleep(retry_after)
+                continue
+            if res.status_code >= 400:
+                print("status code", res.status_code)
+                print(res.text)
+                raise DiscordError(f"discord rejected payload: {res.status_code}")
+            return
+        logger.error(
+            "%s gave up on payload after %s throttled attempts",
+            WACK_ERROR_SENTINEL,
+            MAX_RATE_LIMIT_RETRIES + 1,
+        )
+        raise DiscordError("discord kept throttling payload")
+
+    def close(self):
+        self.session.close()
 
 
 if __name__ == "__main__":
@@ -4,19 +4,43 @@ import secrets
 import hashlib
 import base64
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
 from wacksbywarby.models import Sale
-from wacksbywarby.db import Wackabase
+from wacksbywarby.sessions import API_TIMEOUT, build_session
+from wacksbywarby.stock import UNKNOWN_QUANTITY, StockResolver, apply_stock
+from wacksbywarby.db import open_wackabase
 
 logger = logging.getLogger("etsy")
 
+# the most receipts etsy will return in one request
+RECEIPTS_PAGE_SIZE = 100
+# how many pages of receipts to fetch concurrently once we know how many there are
+PREFETCH_PAGES = 4
+# the most listings etsy will return from the batch listings endpoint in one request
+LISTINGS_BATCH_SIZE = 100
+
 
 class Etsy:
-    def __init__(self, credentials=None, debug=False) -> None:
+    def __init__(
+        self,
+        credentials=None,
+        debug=False,
+        timeout: Tuple[float, float] = API_TIMEOUT,
+        session: Optional[requests.Session] = None,
+    ) -> None:
         self.debug = debug
+        self.timeout = timeout
+        # www.etsy.com for oauth and api.etsy.com for everything else
+        self.session = (
+            session if session is not None else build_session(PREFETCH_PAGES, 2)
+        )
         self.shop_id = os.getenv("ETSY_SHOP_ID")
         self.v3_api_key = os.getenv("ETSY_V3_API_KEY")
 
@@ -31,6 +55,8 @@ class Etsy:
         self.challenge_verifier = os.getenv('ETSY_CHALLENGE_VERIFIER')
         self.redirect_uri = os.getenv('ETSY_REDIRECT_URI')
 
+        self.stock = StockResolver(self._get_listings_quantities)
+
     def _generate_challenge_verifier(self):
         # generate PKCE challenger verifier for etsy oauth which can be stored in env and re-used
         token_length = 44
@@ -62,7 +88,9 @@ class Etsy:
                 "code_challenge": code_challenge,
                 "code_challenge_method": "S256"
             }
-        raw_response = requests.get(connect_url, params=params)
+        raw_response = self.session.get(
+            connect_url, params=params, timeout=self.timeout
+        )
         return raw_response.url
 
     def request_access_token(self, authorization_code=None):
@@ -71,14 +99,15 @@ class Etsy:
         https://developers.etsy.com/documentation/essentials/authentication#step-3-request-an-access-token
         """
         url = "https://api.etsy.com/v3/public/oauth/token"
-        raw_response = requests.post(
+        raw_response = self.session.post(
             url, data={
                 "grant_type": "authorization_code",
                 "client_id": self.v3_api_key,
                 "redirect_uri": self.redirect_uri,
                 "code": authorization_code,
                 "code_verifier": self.challenge_verifier
-            }
+            },
+            timeout=self.timeout,
         )
         response = raw_response.json()
         print(response)
@@ -90,49 +119,124 @@ class Etsy:
         https://developers.etsy.com/documentation/essentials/authentication#requesting-a-refresh-oauth-token
         """
         url = "https://api.etsy.com/v3/public/oauth/token"
-        raw_response = requests.post(
+        raw_response = self.session.post(
             url, data={
                 "grant_type": "refresh_token",
                 "client_id": self.v3_api_key,
                 "refresh_token": self.credentials.refresh_token
-            }
+            },
+            timeout=self.timeout,
         )
         response = raw_response.json()
         print(response)
         return response
 
-    def _get_orders_since_timestamp(self, timestamp: int):
-        logger.info(f"getting orders since timestamp, timestamp {timestamp}")
+    def _request_receipts_page(self, timestamp: int, offset: int) -> dict:
+        logger.info(f"getting receipts page, timestamp {timestamp}, offset {offset}")
         url = f"https://api.etsy.com/v3/application/shops/{self.shop_id}/receipts"
-        raw_response = requests.get(
+        raw_response = self.session.get(
             url,
             params={
                 "client_id": self.v3_api_key,
                 "sort_on": "created",
                 # unix timestamp
                 "min_created": timestamp,
-                "limit": 100,
+                "limit": RECEIPTS_PAGE_SIZE,
+                "offset": offset,
                 "was_paid": "true",
                 "is_canceled": "false",
             },
             headers=self.headers,
+            timeout=self.timeout,
         )
-        response = raw_response.json()
-        orders = response.get('results', [])
-        return orders
+        return raw_response.json()
 
-    def get_sales_since_timestamp(self, timestamp: int):
+    def _iter_orders_since_timestamp(self, timestamp: int) -> Iterator[dict]:
+        """
+        Lazily walk every page of receipts since the timestamp, newest first.
+        The first page tells us the total count, after which the next few pages are
+        prefetched concurrently while earlier ones are being consumed. Stopping early
+        cancels whatever hasn't been fetched yet.
+        https://developers.etsy.com/documentation/reference/#operation/getShopReceipts
+        """
+        first_page = self._request_receipts_page(timestamp, 0)
+        # a receipt that comes in while we're paging shifts everything down by one, so
+        # it's possible to see the same receipt at the end of one page and start of the next
+        seen_receipt_ids = set()
+
+        def unseen(page: dict) -> Iterator[dict]:
+            for order in page.get("results", []):
+                receipt_id = order.get("receipt_id")
+                if receipt_id in seen_receipt_ids:
+                    continue
+                seen_receipt_ids.add(receipt_id)
+                yield order
+
+        yield from unseen(first_page)
+
+        offsets = iter(
+            range(RECEIPTS_PAGE_SIZE, first_page.get("count", 0), RECEIPTS_PAGE_SIZE)
+        )
+        executor = ThreadPoolExecutor(max_workers=PREFETCH_PAGES)
+        try:
+            in_flight = deque(
+                executor.submit(self._request_receipts_page, timestamp, offset)
+                for offset in islice(offsets, PREFETCH_PAGES)
+            )
+            while in_flight:
+                page = in_flight.popleft().result()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    in_flight.append(
+                        executor.submit(
+                            self._request_receipts_page, timestamp, next_offset
+                        )
+                    )
+                yield from unseen(page)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_listings_quantities(self, listing_ids: List[str]) -> Dict[str, int]:
+        """
+        How many of each listing are left, using the multi-listing endpoint so a poll
+        costs one request per LISTINGS_BATCH_SIZE distinct listings
+        https://developers.etsy.com/documentation/reference/#operation/getListingsByListingIds
+        """
+        url = "https://api.etsy.com/v3/application/listings/batch"
+        quantities = {}
+        for start in range(0, len(listing_ids), LISTINGS_BATCH_SIZE):
+            chunk = listing_ids[start : start + LISTINGS_BATCH_SIZE]
+            logger.info(f"getting listings batch of {len(chunk)}")
+            raw_response = self.session.get(
+                url,
+                params={"listing_ids": ",".join(chunk)},
+                headers=self.headers,
+                timeout=self.timeout,
+            )
+            response = raw_response.json()
+            for listing in response.get("results", []):
+                quantity = listing.get("quantity", 0)
+                if listing.get("state") == "sold_out":
+                    quantity = 0
+                quantities[str(listing["listing_id"])] = quantity
+        return quantities
+
+    def get_sales_since_timestamp(
+        self, timestamp: int, is_new: Optional[Callable[[Sale], bool]] = None
+    ):
         """
         Get all the receipts which contain "transactions" or in other words, orders and line items within them.
         Convert them into Sale objects
         https://developers.etsy.com/documentation/reference/#operation/getShopReceipts
+
+        Polls overlap the previous one, so is_new drops sales we've already seen before
+        they're taken off the cached stock
         """
         logger.info(f"getting sales since timestamp, timestamp {timestamp}")
-        # bump timestamp to avoid re-fetching previous order
-        orders = self._get_orders_since_timestamp(timestamp + 1)
+        orders = self._iter_orders_since_timestamp(timestamp)
         sales = []
         for order in orders:
-            order_id = order.get("id")
+            order_id = order.get("receipt_id")
             sale_time = order.get('created_timestamp')
             line_items = order.get("transactions", [])
             for item in line_items:
@@ -152,37 +256,32 @@ class Etsy:
                 sale = Sale(
                     listing_id=str(listing_id),
                     num_sold=num_sold,
-                    # TODO hardcode this for now since it seems like we need to make a new request to get the actual value
-                    quantity=10,
+                    # filled in from the listings below
+                    quantity=UNKNOWN_QUANTITY,
                     datetime=datetime.fromtimestamp(sale_time),
                     fallback_name=fallback_name,
-                    location=None
+                    location=None,
+                    order_id=str(order_id),
+                    line_item_id=str(item.get("transaction_id")),
                 )
+                if is_new and not is_new(sale):
+                    continue
                 sales.append(sale)
+
+        # take these sales off any stock cached before they were placed, then look up
+        # what's left
+        self.stock.record_sales(sales)
+        apply_stock(sales, self.stock.resolve(sale.listing_id for sale in sales))
         return sales
 
-    def get_num_sales(self, last_timestamp: int, prev_num_sales: int) -> int:
-        """
-        Get total number of sales by using previously stored sales and timestamp and getting any new sales since
-        then.
-        """
-        logger.info(
-            f"getting num sales, last_timestamp {last_timestamp}, prev_num_sales: {prev_num_sales}"
-        )
-        # bump timestamp to avoid re-fetching previous order
-        new_orders_response = self._get_orders_since_timestamp(last_timestamp + 1)
-        num_new_orders = 0
-        for order in new_orders_response:
-            line_items = order.get("transactions", [])
-            num_new_orders += len(line_items)
-        num_total_sales = prev_num_sales + num_new_orders
-        return num_total_sales
+    def close(self):
+        self.session.close()
 
 
 if __name__ == "__main__":
     load_dotenv()
     # do oauth
-    db = Wackabase()
+    db = open_wackabase("etsy")
     creds = db.get_etsy_creds()
     client = Etsy(credentials=creds, debug=True)
     # one week ago
@@ -0,0 +1,316 @@
+"""Append-only record of every sale we've seen, for exact incremental syncs"""
+
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+from wacksbywarby.db import SQLITE_BUSY_TIMEOUT_SECONDS, AnyWackabase, SqliteWackabase
+from wacksbywarby.models import Sale
+from wacksbywarby.outbox import sale_key
+
+logger = logging.getLogger("ledger")
+
+# polls re-fetch this far behind the waterline, so orders that landed in the same second
+# as the last one, or showed up in the api late, aren't skipped. the ledger drops repeats
+OVERLAP_SECONDS = 5 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sales (
+    key TEXT PRIMARY KEY,
+    provider TEXT NOT NULL,
+    order_id TEXT,
+    line_item_id TEXT,
+    listing_id TEXT NOT NULL,
+    num_sold INTEGER NOT NULL,
+    sold_at TEXT,
+    location TEXT,
+    fallback_name TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sales_by_time ON sales (provider, sold_at);
+CREATE INDEX IF NOT EXISTS sales_by_listing ON sales (listing_id);
+-- what each provider had counted before its first ledger row, and the waterline it
+-- was counted up to. the total is always this plus a row per sale, never a separate
+-- counter that could drift from the rows
+CREATE TABLE IF NOT EXISTS ledger_counts (
+    provider TEXT PRIMARY KEY,
+    baseline INTEGER NOT NULL,
+    started_at TEXT
+);
+"""
+
+
+class SalesLedger:
+    """
+    Every normalized sale, keyed by provider, order id and line item id. Rows are only
+    ever added, so whether a sale is new is a primary key lookup rather than a guess
+    from timestamps.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path),
+            timeout=SQLITE_BUSY_TIMEOUT_SECONDS,
+            check_same_thread=False,
+        )
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    def seed(
+        self, provider: str, waterline: Optional[datetime], num_sales: int
+    ) -> None:
+        """
+        Start a provider's ledger, before its first fetch. Everything at or before the
+        waterline was already announced and counted by the old timestamp based sync, so
+        until the first sales are recorded it's taken as seen, and num_sales is what the
+        ledger counts on from. Does nothing once a provider has been seeded.
+        """
+        with self._lock, self._conn:
+            seeded = self._conn.execute(
+                "INSERT OR IGNORE INTO ledger_counts VALUES (?, ?, ?)",
+                (provider, num_sales, waterline.isoformat() if waterline else None),
+            ).rowcount
+        if seeded:
+            logger.info(f"seeded {provider} ledger at {waterline}, {num_sales} sales")
+
+    def has(self, provider: str, sale: Sale) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM sales WHERE key = ?", (sale_key(provider, sale),)
+            ).fetchone()
+        return row is not None
+
+    def is_empty(self, provider: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM sales WHERE provider = ? LIMIT 1", (provider,)
+            ).fetchone()
+        return row is None
+
+    def _counted_up_to(self, provider: str) -> Optional[datetime]:
+        """The seeded waterline, while nothing has been recorded since"""
+        if not self.is_empty(provider):
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT started_at FROM ledger_counts WHERE provider = ?", (provider,)
+            ).fetchone()
+        return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+    def is_new(self, provider: str, sale: Sale) -> bool:
+        """Whether a sale is neither in the ledger nor already counted before it"""
+        counted_up_to = self._counted_up_to(provider)
+        if counted_up_to and sale.datetime and sale.datetime <= counted_up_to:
+            return False
+        return not self.has(provider, sale)
+
+    def unseen(self, provider: str, sales: List[Sale]) -> List[Sale]:
+        """
+        The new sales, in the order given, each line item once.
+
+        The first time a provider finds sales, the ones at or before the seeded
+        waterline are recorded straight away, so they stay seen once it's moved on.
+        They're already in the count, so it doesn't change.
+        """
+        counted_up_to = self._counted_up_to(provider)
+        if counted_up_to:
+            already_counted = [
+                sale
+                for sale in sales
+                if sale.datetime and sale.datetime <= counted_up_to
+            ]
+            logger.info(
+                f"seeding {provider} ledger with {len(already_counted)} earlier sales"
+            )
+            with self._lock, self._conn:
+                num_sales = self._num_sales(self._conn, provider)
+                self._record(self._conn, provider, already_counted, num_sales)
+        unseen, keys = [], set()
+        for sale in sales:
+            key = sale_key(provider, sale)
+            if key not in keys and not self.has(provider, sale):
+                unseen.append(sale)
+            keys.add(key)
+        return unseen
+
+    def num_sales(self, provider: str) -> int:
+        """
+        The total count, 0 if nothing has been counted yet. A row is a line item that
+        was announced, so backfills have to count the same way, e.g. not card fees.
+        """
+        with self._lock:
+            return self._num_sales(self._conn, provider)
+
+    @staticmethod
+    def _num_sales(conn: sqlite3.Connection, provider: str) -> int:
+        baseline = conn.execute(
+            "SELECT baseline FROM ledger_counts WHERE provider = ?", (provider,)
+        ).fetchone()
+        (num_rows,) = conn.execute(
+            "SELECT COUNT(*) FROM sales WHERE provider = ?", (provider,)
+        ).fetchone()
+        return (baseline[0] if baseline else 0) + num_rows
+
+    def record_poll(
+        self,
+        db: AnyWackabase,
+        provider: str,
+        sales: Iterable[Sale],
+        waterline: Optional[datetime],
+        num_sales: Optional[int] = None,
+    ) -> int:
+        """
+        Record a poll's new sales and move the waterline to match, returning the total
+        count. num_sales replaces the total, for when it had to be backfilled.
+
+        The sqlite db shares a file with the ledger, so the rows, count and waterline
+        commit in one transaction. With the text files the count is the ledger's, so a
+        crash before the waterline is written only leaves it behind, and the next poll's
+        overlap finds those sales already recorded.
+        """
+        if isinstance(db, SqliteWackabase) and db.path.resolve() == self.path.resolve():
+            with db.transaction() as conn:
+                total = self._record(conn, provider, sales, num_sales)
+                db.set_poll_state(conn, waterline, total)
+            return total
+        with self._lock, self._conn:
+            total = self._record(self._conn, provider, sales, num_sales)
+        if waterline:
+            db.write_poll_state(waterline, total)
+        else:
+            db.write_num_sales(total)
+        return total
+
+    def record(self, provider: str, sales: Iterable[Sale]) -> int:
+        """Add sales to the ledger, ignoring any already in it, returning how many were new"""
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._insert(self._conn, provider, sales)
+            return self._conn.total_changes - before
+
+    def _record(
+        self,
+        conn: sqlite3.Connection,
+        provider: str,
+        sales: Iterable[Sale],
+        num_sales: Optional[int],
+    ) -> int:
+        self._insert(conn, provider, sales)
+        if num_sales is None:
+            return self._num_sales(conn, provider)
+        # a backfilled total already includes these sales
+        (num_rows,) = conn.execute(
+            "SELECT COUNT(*) FROM sales WHERE provider = ?", (provider,)
+        ).fetchone()
+        conn.execute(
+            "INSERT INTO ledger_counts (provider, baseline) VALUES (?, ?) "
+            "ON CONFLICT (provider) DO UPDATE SET baseline = excluded.baseline",
+            (provider, num_sales - num_rows),
+        )
+        return num_sales
+
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, provider: str, sales: Iterable[Sale]):
+        now = time.time()
+        rows = [
+            (
+                sale_key(provider, sale),
+                provider,
+                sale.order_id,
+                sale.line_item_id,
+                str(sale.listing_id),
+                sale.num_sold,
+                sale.datetime.isoformat() if sale.datetime else None,
+                sale.location,
+                sale.fallback_name,
+                now,
+            )
+            for sale in sales
+        ]
+        conn.executemany(
+            "INSERT OR IGNORE INTO sales VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+    def copy_from(self, path: Union[str, Path], provider: str) -> int:
+        """
+        Copy a provider's sales and count from another ledger file, e.g. a text file
+        db's when moving to the shared sqlite file, returning how many sales were new
+        """
+        with self._lock:
+            self._conn.execute("ATTACH DATABASE ? AS other", (str(path),))
+            try:
+                with self._conn:
+                    before = self._conn.total_changes
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO sales "
+                        "SELECT * FROM other.sales WHERE provider = ?",
+                        (provider,),
+                    )
+                    num_sales = self._conn.total_changes - before
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO ledger_counts "
+                        "SELECT * FROM other.ledger_counts WHERE provider = ?",
+                        (provider,),
+                    )
+            finally:
+                self._conn.execute("DETACH DATABASE other")
+        return num_sales
+
+    def find(
+        self,
+        provider: Optional[str] = None,
+        listing_id: Optional[str] = None,
+        since: Optional[datetime] = None,
+    ) -> List[Sale]:
+        """Recorded sales, oldest first, optionally for one provider, listing or period"""
+        clauses, params = [], []
+        if provider:
+            clauses.append("provider = ?")
+            params.append(provider)
+        if listing_id:
+            clauses.append("listing_id = ?")
+            params.append(str(listing_id))
+        if since:
+            clauses.append("sold_at >= ?")
+            params.append(since.isoformat())
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT listing_id, num_sold, sold_at, location, fallback_name, "
+                f"order_id, line_item_id FROM sales {where} ORDER BY sold_at",
+                params,
+            ).fetchall()
+        return [
+            Sale(
+                listing_id=listing_id,
+                # stock isn't part of the record
+                quantity=-1,
+                num_sold=num_sold,
+                datetime=datetime.fromisoformat(sold_at) if sold_at else None,
+                location=location,
+                fallback_name=fallback_name,
+                order_id=order_id,
+                line_item_id=line_item_id,
+            )
+            for (
+                listing_id,
+                num_sold,
+                sold_at,
+                location,
+                fallback_name,
+                order_id,
+                line_item_id,
+            ) in rows
+        ]
+
+    def close(self):
+        self._conn.close()
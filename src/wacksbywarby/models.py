@@ -1,7 +1,7 @@
 import json
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from datetime import datetime
-from typing import List, Optional
+from typing import Optional, Tuple
 
 from wacks4square.constants import DATETIME_FMT as SQUARE_DATETIME_FMT
 
@@ -22,6 +22,22 @@ class Sale:
     datetime: Optional[datetime]
     location: Optional[str]
     fallback_name: Optional[str]
+    # identify the line item within the provider's order, used to dedupe announcements
+    order_id: Optional[str] = None
+    line_item_id: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        as_dict = asdict(self)
+        if self.datetime:
+            as_dict["datetime"] = self.datetime.isoformat()
+        return as_dict
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        data = dict(data)
+        if data.get("datetime"):
+            data["datetime"] = datetime.fromisoformat(data["datetime"])
+        return cls(**data)
 
 
 @dataclass
@@ -29,10 +45,10 @@ class Shift4ShopSale(Sale):
     datetime: datetime
 
 
-@dataclass
+@dataclass(frozen=True)
 class Werby:
     name: str
-    images: List[str]
+    images: Tuple[str, ...]
     color: Optional[str]
 
 
@@ -0,0 +1,81 @@
+"""Durable queue of sales waiting to be announced"""
+
+import logging
+import time
+from typing import Iterable, List, Tuple
+
+from wacksbywarby.db import Wackabase
+from wacksbywarby.models import Sale
+from wacksbywarby.werbies import IdType
+
+logger = logging.getLogger("outbox")
+
+# how long to remember sales that were already announced so re-fetching them is a no-op
+SENT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+
+def sale_key(provider: IdType, sale: Sale) -> str:
+    """Idempotency key for a single line item of an order"""
+    if sale.order_id is None:
+        # not much to go on, but this is as unique as the sale gets
+        return f"{provider}:{sale.listing_id}:{sale.datetime}"
+    return f"{provider}:{sale.order_id}:{sale.line_item_id}"
+
+
+class Outbox:
+    """
+    Every sale is recorded here, keyed by provider + order id + line item, before it is
+    announced, and only marked sent once discord accepted the message it was in. Sales
+    that were already recorded are ignored, so re-fetching a window after a crash never
+    announces anything twice, and anything discord didn't take is retried on the next flush.
+    """
+
+    def __init__(self, db: Wackabase, provider: IdType) -> None:
+        self.db = db
+        self.provider = provider
+        self.entries: dict = db.get_outbox()
+
+    def enqueue(self, sales: Iterable[Sale]) -> List[Sale]:
+        """Record sales to be announced, returning the ones we hadn't seen before"""
+        new_sales = []
+        now = time.time()
+        for sale in sales:
+            key = sale_key(self.provider, sale)
+            if key in self.entries:
+                logger.info("already have %s in the outbox, skipping", key)
+                continue
+            self.entries[key] = {
+                "sale": sale.to_dict(),
+                "queued_at": now,
+                "sent_at": None,
+            }
+            new_sales.append(sale)
+        if new_sales:
+            self._save()
+        return new_sales
+
+    def pending(self) -> List[Tuple[str, Sale]]:
+        """Sales that haven't been announced yet, in the order they were recorded"""
+        return [
+            (key, Sale.from_dict(entry["sale"]))
+            for key, entry in self.entries.items()
+            if entry["sent_at"] is None
+        ]
+
+    def mark_sent(self, keys: Iterable[str]):
+        now = time.time()
+        for key in keys:
+            self.entries[key]["sent_at"] = now
+        self._prune(now)
+        self._save()
+
+    def _prune(self, now: float):
+        cutoff = now - SENT_RETENTION_SECONDS
+        self.entries = {
+            key: entry
+            for key, entry in self.entries.items()
+            if entry["sent_at"] is None or entry["sent_at"] > cutoff
+        }
+
+    def _save(self):
+        self.db.write_outbox(self.entries)
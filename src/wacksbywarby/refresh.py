@@ -5,7 +5,7 @@ from datetime import datetime
 from dotenv import load_dotenv
 
 from wacksbywarby.etsy import Etsy
-from wacksbywarby.db import Wackabase
+from wacksbywarby.db import Wackabase, open_wackabase
 from wacksbywarby.models import EtsyCredentials
 
 load_dotenv()
@@ -46,6 +46,5 @@ def main(db: Wackabase):
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 
-    db = Wackabase()
-
-    main(db)
+    with open_wackabase("etsy") as db:
+        main(db)
@@ -0,0 +1,328 @@
+"""
+Poll every provider from one process. Each provider keeps its own data directory and
+lock, so this can run alongside the per-provider cron entry points, and everything is
+announced through one shared discord client.
+"""
+
+import argparse
+import logging
+import random
+import signal
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+from filelock import FileLock, Timeout
+
+from wacks4shop import wack as wacks4shop
+from wacks4square import constants as wacks4square_constants
+from wacks4square import wack as wacks4square
+from wacksbywarby import wack as wacksbywarby
+from wacksbywarby.cadence import Cadence
+from wacksbywarby.constants import WACK_ERROR_SENTINEL
+from wacksbywarby.db import DATA_DIR, Wackabase, open_wackabase
+from wacksbywarby.discord import Discord
+from wacksbywarby.etsy import Etsy
+from wacksbywarby.models import Sale
+from wacksbywarby.werbies import IdType
+
+load_dotenv()
+
+logger = logging.getLogger("runner")
+
+# how long a poll waits for a cron run of the same provider to finish
+LOCK_TIMEOUT_SECONDS = 5
+# in daemon mode, how long to wait after a provider's poll finishes before the next one,
+# unless the provider's cadence says otherwise
+POLL_INTERVAL_SECONDS = 30.0
+# the quickest each provider is polled however busy it is. a poll is a few requests, so
+# these keep well inside etsy's 10k requests a day, square's per-second limits and
+# shift4shop's slower api (one request per status at a time when fetching by status)
+ETSY_FLOOR_SECONDS = 15.0
+SQUARE_FLOOR_SECONDS = 10.0
+SHIFT4SHOP_FLOOR_SECONDS = 20.0
+# each wait is randomly up to this fraction longer or shorter, so providers drift apart
+# instead of hitting their apis at the same moment every time
+POLL_JITTER = 0.1
+
+
+@dataclass
+class Provider:
+    name: IdType
+    database_dir: str
+    lockfile: str
+    # builds a client, reading whatever credentials it needs from the db
+    make_client: Callable[[Wackabase, bool], Any]
+    # one poll: fetch and announce new sales with the client, returning the sales
+    poll: Callable[[Wackabase, bool, Any, Discord], Optional[List[Sale]]]
+    # adapts the daemon's poll interval to how busy the provider is
+    cadence: Optional[Cadence] = None
+    # "etsy" or "square", the client is rebuilt when these creds change, e.g. after
+    # refresh.py rotates a token
+    creds: Optional[str] = None
+    client: Any = None
+    creds_stamp: Optional[int] = None
+
+    def close_client(self):
+        """Drop the client, closing its connections"""
+        close = getattr(self.client, "close", None)
+        if close:
+            close()
+        self.client = None
+
+
+def _poll_etsy(db: Wackabase, dry: bool, client, discord: Discord) -> List[Sale]:
+    sales: List[Sale] = []
+    wacksbywarby.main(
+        db, dry=dry, client=client, discord=discord, on_sales=sales.extend
+    )
+    return sales
+
+
+def _poll_square(db: Wackabase, dry: bool, client, discord: Discord) -> List[Sale]:
+    sales: List[Sale] = []
+    wacks4square.main(
+        db, dry=dry, client=client, discord=discord, on_sales=sales.extend
+    )
+    return sales
+
+
+def _poll_shift4shop(db: Wackabase, dry: bool, client, discord: Discord) -> List[Sale]:
+    sales: List[Sale] = []
+    waterline = wacks4shop.main(
+        db, dry=dry, client=client, discord=discord, on_sales=sales.extend
+    )
+    if not waterline:
+        logger.error("No timestamp, what's going on?")
+    return sales
+
+
+def default_providers(base_interval: float = POLL_INTERVAL_SECONDS) -> List[Provider]:
+    return [
+        Provider(
+            name="etsy",
+            database_dir=DATA_DIR,
+            lockfile=wacksbywarby.LOCKFILE,
+            creds="etsy",
+            make_client=lambda db, dry: Etsy(
+                credentials=db.get_etsy_creds(), debug=dry
+            ),
+            poll=_poll_etsy,
+            cadence=Cadence(base_interval, floor=ETSY_FLOOR_SECONDS),
+        ),
+        Provider(
+            name="square",
+            database_dir=wacks4square_constants.DATABASE_DIR,
+            lockfile=wacks4square_constants.LOCKFILE,
+            creds="square",
+            make_client=lambda db, dry: wacks4square.make_client(db, dry=dry),
+            poll=_poll_square,
+            cadence=Cadence(base_interval, floor=SQUARE_FLOOR_SECONDS),
+        ),
+        Provider(
+            name="shift4shop",
+            database_dir=wacks4shop.DATABASE_DIR,
+            lockfile=wacks4shop.LOCKFILE,
+            make_client=lambda db, dry: wacks4shop.make_client(dry=dry),
+            poll=_poll_shift4shop,
+            cadence=Cadence(base_interval, floor=SHIFT4SHOP_FLOOR_SECONDS),
+        ),
+    ]
+
+
+class Runner:
+    """
+    Polls providers concurrently, so a poll takes as long as the slowest provider
+    rather than all of them added up, and one failing provider doesn't stop the rest.
+    Clients are kept between polls and rebuilt when their credentials file changes or
+    after a failed poll.
+
+    run_forever() keeps polling on a schedule until request_stop() is called, never
+    starting a provider's next poll before its last one finished.
+    """
+
+    def __init__(
+        self,
+        providers: List[Provider],
+        discord: Discord,
+        dry=False,
+        lock_timeout: float = LOCK_TIMEOUT_SECONDS,
+    ) -> None:
+        self.providers = providers
+        self.discord = discord
+        self.dry = dry
+        self.lock_timeout = lock_timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(len(providers), 1), thread_name_prefix="poll"
+        )
+        self.stop_event = threading.Event()
+        # set whenever a poll finishes or we're asked to stop, so the scheduler wakes up
+        self._wake = threading.Event()
+
+    def poll(self, provider: Provider) -> bool:
+        """Poll a single provider, returning whether it succeeded"""
+        try:
+            with FileLock(provider.lockfile, timeout=self.lock_timeout):
+                # create the database folder if it doesn't exist
+                Path(provider.database_dir).mkdir(parents=True, exist_ok=True)
+                with open_wackabase(provider.name, provider.database_dir) as db:
+                    creds_stamp = (
+                        db.get_creds_stamp(provider.creds) if provider.creds else None
+                    )
+                    if provider.client is None or creds_stamp != provider.creds_stamp:
+                        provider.close_client()
+                        provider.client = provider.make_client(db, self.dry)
+                        provider.creds_stamp = creds_stamp
+                    sales = provider.poll(db, self.dry, provider.client, self.discord)
+                    db.write_success()
+                self._record(provider, sales or [])
+                return True
+        except Timeout:
+            logger.info(f"Could not acquire {provider.name} lock, skipping this poll")
+            return False
+        except Exception as e:
+            logger.error("%s %s poll failed: %s", WACK_ERROR_SENTINEL, provider.name, e)
+            provider.close_client()
+            # back off like an idle poll so an outage isn't hammered
+            self._record(provider, [])
+            return False
+
+    @staticmethod
+    def _record(provider: Provider, sales: List[Sale]):
+        if provider.cadence:
+            provider.cadence.record(sales)
+
+    def poll_all(self) -> Dict[str, bool]:
+        """Poll every provider at once, returning whether each one succeeded"""
+        results = self.executor.map(self.poll, self.providers)
+        return {
+            provider.name: succeeded
+            for provider, succeeded in zip(self.providers, results)
+        }
+
+    def run_forever(
+        self, interval: float = POLL_INTERVAL_SECONDS, jitter: float = POLL_JITTER
+    ):
+        """Poll every provider on a schedule until request_stop() is called"""
+        logger.info(f"polling {[p.name for p in self.providers]} every ~{interval}s")
+        next_poll_at = {provider.name: time.monotonic() for provider in self.providers}
+        in_flight: Set[str] = set()
+        # reentrant since a poll that's already done runs its callback on this thread
+        lock = threading.RLock()
+
+        def finished(provider: Provider, future: Future):
+            with lock:
+                in_flight.discard(provider.name)
+                next_poll_at[provider.name] = time.monotonic() + self._delay(
+                    provider, interval, jitter
+                )
+            self._wake.set()
+
+        while not self.stop_event.is_set():
+            self._wake.clear()
+            with lock:
+                now = time.monotonic()
+                for provider in self.providers:
+                    if provider.name in in_flight or next_poll_at[provider.name] > now:
+                        continue
+                    in_flight.add(provider.name)
+                    future = self.executor.submit(self.poll, provider)
+                    future.add_done_callback(
+                        lambda future, provider=provider: finished(provider, future)
+                    )
+                waiting = [
+                    next_poll_at[p.name]
+                    for p in self.providers
+                    if p.name not in in_flight
+                ]
+            timeout = max(min(waiting) - time.monotonic(), 0) if waiting else None
+            self._wake.wait(timeout)
+        logger.info("stopping, waiting for polls in flight to finish")
+
+    @staticmethod
+    def _delay(provider: Provider, interval: float, jitter: float) -> float:
+        cadence = provider.cadence
+        if cadence:
+            interval = cadence.next_interval()
+        delay = interval * random.uniform(1 - jitter, 1 + jitter)
+        if cadence:
+            # jitter never takes a provider under its floor
+            delay = max(delay, cadence.floor)
+        logger.debug(f"next {provider.name} poll in {delay:.1f}s")
+        return delay
+
+    def request_stop(self):
+        self.stop_event.set()
+        self._wake.set()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for provider in self.providers:
+            provider.close_client()
+        self.discord.close()
+
+
+def build_runner(
+    names: Optional[List[str]] = None,
+    dry=False,
+    base_interval: float = POLL_INTERVAL_SECONDS,
+) -> Runner:
+    providers = [
+        provider
+        for provider in default_providers(base_interval)
+        if names is None or provider.name in names
+    ]
+    return Runner(providers, Discord(debug=dry), dry=dry)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wacks for every provider!!")
+    parser.add_argument(
+        "--dry",
+        action="store_true",
+        required=False,
+        help="run as dry run",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        required=False,
+        help="keep running and poll on a schedule instead of polling once",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=POLL_INTERVAL_SECONDS,
+        help=(
+            "seconds between polls of each provider in daemon mode while it's neither "
+            "busy nor idle, polls speed up while sales are coming in and back off when "
+            "nothing is"
+        ),
+    )
+    parser.add_argument(
+        "--providers",
+        nargs="+",
+        choices=["etsy", "square", "shift4shop"],
+        help="only poll these providers",
+    )
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(threadName)s %(message)s"
+    )
+
+    args = parser.parse_args()
+    runner = build_runner(args.providers, dry=args.dry, base_interval=args.interval)
+    try:
+        if args.daemon:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda signum, frame: runner.request_stop())
+            runner.run_forever(interval=args.interval)
+        else:
+            results = runner.poll_all()
+            logger.info(f"done! {results}")
+    finally:
+        runner.close()
+        logger.info("done!")
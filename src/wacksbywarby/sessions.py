@@ -0,0 +1,19 @@
+"""Keep-alive requests sessions for the apis we call"""
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds for the provider apis. big order searches can be
+# slow, but a poll that never hears back holds its provider's lock forever
+API_TIMEOUT = (3.05, 60)
+
+
+def build_session(pool_size: int, num_hosts: int = 1) -> requests.Session:
+    """
+    A keep-alive session so repeated and concurrent requests reuse TLS connections,
+    holding on to up to pool_size connections for each of num_hosts hosts
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=num_hosts, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return session
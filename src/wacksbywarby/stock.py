@@ -0,0 +1,113 @@
+"""Look up how many of a listing are left, for the sold out footer"""
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from wacksbywarby.models import Sale
+
+logger = logging.getLogger("stock")
+
+# what we report when a provider can't tell us the stock, high enough to never look sold out
+UNKNOWN_QUANTITY = 10
+STOCK_TTL_SECONDS = 60
+
+FetchQuantities = Callable[[List[str]], Dict[str, int]]
+
+
+class StockResolver:
+    """
+    Caches each listing's stock for a short ttl. Everything a poll needs that isn't
+    cached is fetched with a single call to fetch_quantities, which is expected to
+    batch the ids into as few requests as the provider's API allows.
+    """
+
+    def __init__(
+        self, fetch_quantities: FetchQuantities, ttl: float = STOCK_TTL_SECONDS
+    ) -> None:
+        self.fetch_quantities = fetch_quantities
+        self.ttl = ttl
+        # listing id -> (quantity, expires at, unix time it was fetched)
+        self._cache: Dict[str, Tuple[int, float, float]] = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, listing_ids: Iterable[str]):
+        with self._lock:
+            for listing_id in listing_ids:
+                self._cache.pop(listing_id, None)
+
+    def invalidate_before(self, sold_at: Dict[str, float]):
+        """
+        Drop stock that was fetched before each listing last sold (unix seconds), since
+        it doesn't have that sale taken off yet. Stock fetched since already does, so
+        seeing the same sale again, e.g. from a webhook and then a poll, costs nothing.
+        """
+        with self._lock:
+            for listing_id, sold_at_unix in sold_at.items():
+                cached = self._cache.get(listing_id)
+                if cached and cached[2] < sold_at_unix:
+                    del self._cache[listing_id]
+
+    def record_sales(self, sales: Iterable[Sale]):
+        """
+        Knock sold items off of cached stock instead of fetching it again. Like
+        invalidate_before, only stock fetched before the sale is changed, stock fetched
+        since already has it taken off. Naive sale datetimes are taken as local time,
+        and stock for a sale without one is fetched again.
+        """
+        with self._lock:
+            for sale in sales:
+                cached = self._cache.get(sale.listing_id)
+                if not cached:
+                    continue
+                quantity, expires_at, fetched_at = cached
+                if sale.datetime is None:
+                    del self._cache[sale.listing_id]
+                elif fetched_at < sale.datetime.timestamp():
+                    self._cache[sale.listing_id] = (
+                        max(quantity - sale.num_sold, 0),
+                        expires_at,
+                        fetched_at,
+                    )
+
+    def resolve(self, listing_ids: Iterable[str]) -> Dict[str, int]:
+        """Stock for each listing id, ids the provider doesn't know about are left out"""
+        now = time.monotonic()
+        quantities: Dict[str, int] = {}
+        missing: List[str] = []
+        with self._lock:
+            for listing_id in set(listing_ids):
+                cached = self._cache.get(listing_id)
+                if cached and cached[1] > now:
+                    quantities[listing_id] = cached[0]
+                else:
+                    missing.append(listing_id)
+        if missing:
+            logger.info(f"fetching stock for {len(missing)} listings")
+            try:
+                fetched = self.fetch_quantities(missing)
+            except Exception as e:
+                logger.error(f"could not fetch stock, assuming it's not sold out: {e}")
+                fetched = {}
+            expires_at = time.monotonic() + self.ttl
+            fetched_at = time.time()
+            with self._lock:
+                for listing_id, quantity in fetched.items():
+                    self._cache[listing_id] = (quantity, expires_at, fetched_at)
+            quantities.update(fetched)
+        return quantities
+
+
+def apply_stock(sales: List[Sale], quantities: Dict[str, int]):
+    """
+    Fill in each sale's quantity from current stock. sales are newest first, so the
+    stock left after an older sale is the current stock plus whatever sold since.
+    """
+    sold_since: Dict[str, int] = {}
+    for sale in sales:
+        if sale.listing_id not in quantities:
+            sale.quantity = UNKNOWN_QUANTITY
+            continue
+        sale.quantity = quantities[sale.listing_id] + sold_since.get(sale.listing_id, 0)
+        sold_since[sale.listing_id] = sold_since.get(sale.listing_id, 0) + sale.num_sold
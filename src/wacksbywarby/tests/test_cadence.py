@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from wacksbywarby.cadence import Cadence
+from wacksbywarby.models import Sale
+
+
+def sale_at(when: datetime) -> Sale:
+    return Sale(
+        listing_id="NYX_TIN",
+        quantity=3,
+        num_sold=1,
+        datetime=when,
+        location=None,
+        fallback_name="Nyx",
+    )
+
+
+def test_backs_off_to_the_ceiling_when_idle():
+    cadence = Cadence(base=30, floor=10, ceiling=200)
+    assert cadence.next_interval() == 30
+    intervals = []
+    for _ in range(5):
+        cadence.record([], polled_at=0)
+        intervals.append(cadence.next_interval())
+    assert intervals == [30, 60, 120, 200, 200]
+
+
+def test_speeds_up_while_sales_are_flowing_but_not_past_the_floor():
+    cadence = Cadence(base=30, floor=10, ceiling=200, window=600)
+    for _ in range(3):
+        cadence.record([], polled_at=0)
+    assert cadence.next_interval() == 120
+
+    # a convention rush, a sale every 20s for the last 10 minutes
+    start = datetime(2023, 7, 7, 12)
+    sales = [sale_at(start + timedelta(seconds=20 * i)) for i in range(30)]
+    cadence.record(sales, polled_at=1000)
+    assert cadence.next_interval() == 20
+
+    # even faster than that is capped by the floor
+    cadence.record([sale_at(start)] * 60, polled_at=1000)
+    assert cadence.next_interval() == 10
+
+    # once the rush is out of the window it starts backing off again
+    cadence.record([], polled_at=1000 + 601)
+    assert cadence.next_interval() == 30
+
+
+def test_backs_off_gradually_after_a_burst():
+    cadence = Cadence(base=30, floor=10, ceiling=900, window=600)
+    cadence.record([sale_at(datetime(2023, 7, 7, 12))], polled_at=0)
+    # quiet polls while the sale is still in the window don't count as idle
+    for polled_at in range(30, 600, 30):
+        cadence.record([], polled_at=polled_at)
+        assert cadence.next_interval() == 30
+
+    intervals = []
+    polled_at = 630
+    for _ in range(6):
+        cadence.record([], polled_at=polled_at)
+        interval = cadence.next_interval()
+        intervals.append(interval)
+        polled_at += interval
+    assert intervals == [30, 60, 120, 240, 480, 900]
@@ -0,0 +1,108 @@
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from wacksbywarby import db as wackabase
+from wacksbywarby.db import SqliteWackabase, Wackabase, migrate, open_wackabase
+from wacksbywarby.ledger import SalesLedger
+from wacksbywarby.models import Sale, SquareCredentials
+
+SQUARE_TOKEN = '{"access_token": "xxx", "refresh_token": "yyy", "short_lived": false, "expires_at": "2023-03-07T04:32:14Z", "merchant_id": "zzz", "token_type": "bearer"}'
+
+
+def test_providers_share_one_file(tmp_path: Path):
+    path = tmp_path / "wacks.sqlite3"
+    etsy = SqliteWackabase(path, "etsy")
+    square = SqliteWackabase(path, "square")
+
+    assert etsy.get_timestamp() is None
+    assert etsy.get_last_num_sales() == 0
+    etsy.write_poll_state(datetime(2023, 7, 7, 12, 30), 150)
+    square.write_num_sales(7)
+    square.write_success()
+
+    assert etsy.get_timestamp() == "07/07/2023 12:30:00"
+    assert etsy.get_last_num_sales() == 150
+    assert etsy.get_last_success() == 0
+    assert square.get_timestamp() is None
+    assert square.get_last_num_sales() == 7
+    assert square.get_last_success() > 0
+
+    # and it's all still there for the next run
+    assert SqliteWackabase(path, "etsy").get_last_num_sales() == 150
+
+
+def test_creds_and_outbox(tmp_path: Path):
+    db = SqliteWackabase(tmp_path / "wacks.sqlite3", "square")
+    assert db.get_creds_stamp("square") is None
+    db.write_square_creds(SquareCredentials.from_string(SQUARE_TOKEN))
+    stamp = db.get_creds_stamp("square")
+    assert db.get_square_creds().to_string() == SQUARE_TOKEN
+    db.write_square_creds(SquareCredentials.from_string(SQUARE_TOKEN))
+    assert db.get_creds_stamp("square") != stamp
+
+    entries = {f"square:{i}:1": {"sale": {}, "sent_at": None} for i in (3, 1, 2)}
+    db.write_outbox(entries)
+    assert list(db.get_outbox()) == list(entries)
+    assert SqliteWackabase(tmp_path / "wacks.sqlite3", "etsy").get_outbox() == {}
+
+
+def test_migrates_text_file_dbs_once(tmp_path: Path, monkeypatch):
+    etsy_dir = tmp_path / "data"
+    square_dir = etsy_dir / "wack4square"
+    square_dir.mkdir(parents=True)
+    monkeypatch.setattr(
+        wackabase,
+        "PROVIDER_DATA_DIRS",
+        {"etsy": str(etsy_dir), "square": str(square_dir), "shift4shop": "nope"},
+    )
+    old_square = Wackabase(str(square_dir))
+    old_square.write_poll_state(datetime(2023, 7, 7), 42)
+    old_square.write_square_creds(SquareCredentials.from_string(SQUARE_TOKEN))
+    old_ledger = SalesLedger(old_square.ledger_path)
+    old_ledger.seed("square", datetime(2023, 7, 7), 41)
+    sale = Sale(
+        listing_id="NYX",
+        quantity=3,
+        num_sold=1,
+        datetime=datetime(2023, 7, 7),
+        location=None,
+        fallback_name="Nyx",
+        order_id="1",
+        line_item_id="a",
+    )
+    old_ledger.record("square", [sale])
+    old_ledger.close()
+    Wackabase(str(etsy_dir)).write_poll_state(datetime(2023, 7, 8), 300)
+
+    path = str(tmp_path / "wacks.sqlite3")
+    assert list(migrate(path)) == ["etsy", "square"]
+    monkeypatch.setenv("WACKS_SQLITE_PATH", path)
+    square = open_wackabase("square", str(square_dir))
+    assert square.get_timestamp() == "07/07/2023 00:00:00"
+    assert square.get_last_num_sales() == 42
+    assert square.get_square_creds().to_string() == SQUARE_TOKEN
+    # the ledger comes along, so the overlap still knows what was announced
+    ledger = SalesLedger(square.ledger_path)
+    assert ledger.has("square", sale)
+    assert ledger.num_sales("square") == 42
+    assert ledger.is_new("square", sale) is False
+    ledger.close()
+    assert open_wackabase("etsy").get_last_num_sales() == 300
+
+    # running it again doesn't clobber anything
+    square.write_num_sales(43)
+    assert list(migrate(path)) == []
+    assert square.get_last_num_sales() == 43
+
+
+def test_closes_as_a_context_manager(tmp_path: Path):
+    with SqliteWackabase(tmp_path / "wacks.sqlite3", "etsy") as db:
+        db.write_num_sales(3)
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.get_last_num_sales()
+    with Wackabase(str(tmp_path)) as text_db:
+        text_db.write_num_sales(4)
+    assert text_db.get_last_num_sales() == 4
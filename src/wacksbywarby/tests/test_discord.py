@@ -0,0 +1,102 @@
+from typing import List
+
+import pytest
+
+from wacksbywarby import discord as discord_module
+from wacksbywarby.discord import Discord, RateLimitBucket, embed_length, pack_embeds
+
+# grab the real request func before conftest swaps it out for a no-op
+make_request = Discord._make_request
+
+
+class FakeResponse:
+    def __init__(self, status_code=204, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def json(self):
+        if self.body is None:
+            raise ValueError("no body")
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, responses: List[FakeResponse]):
+        self.responses = responses
+        self.payloads: list = []
+
+    def post(self, url, json=None, timeout=None):
+        self.payloads.append(json)
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept: List[float] = []
+    monkeypatch.setattr(discord_module.time, "sleep", slept.append)
+    return slept
+
+
+def test_no_waiting_while_bucket_has_room(sleeps):
+    responses = [
+        FakeResponse(
+            headers={"X-RateLimit-Remaining": "4", "X-RateLimit-Reset-After": "2"}
+        )
+        for _ in range(3)
+    ]
+    discord = Discord(session=FakeSession(responses))
+    for _ in range(3):
+        make_request(discord, {"content": "hi"})
+    assert sleeps == []
+
+
+def test_waits_for_empty_bucket(sleeps):
+    bucket = RateLimitBucket()
+    bucket.update(
+        FakeResponse(
+            headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "1.5"}
+        )
+    )
+    bucket.wait()
+    assert len(sleeps) == 1
+    assert 0 < sleeps[0] <= 1.5
+    # once the reset has passed the next request goes straight through
+    bucket.wait()
+    assert len(sleeps) == 1
+
+
+def test_throttled_payload_is_retried(sleeps):
+    session = FakeSession(
+        [
+            FakeResponse(429, body={"retry_after": 0.25, "global": False}),
+            FakeResponse(204),
+        ]
+    )
+    discord = Discord(session=session)
+    make_request(discord, {"content": "sale!"})
+    assert sleeps == [0.25]
+    assert session.payloads == [{"content": "sale!"}, {"content": "sale!"}]
+
+
+def test_pack_embeds_respects_embed_count():
+    embeds = [{"title": f"sale {i}"} for i in range(23)]
+    messages = pack_embeds(embeds)
+    assert [len(message) for message in messages] == [10, 10, 3]
+    assert [embed for message in messages for embed in message] == embeds
+
+
+def test_pack_embeds_respects_total_characters():
+    # each embed is 2200 characters, so only two fit under 6000
+    embeds = [{"title": "t" * 200, "footer": {"text": "f" * 2000}} for _ in range(5)]
+    messages = pack_embeds(embeds)
+    assert [len(message) for message in messages] == [2, 2, 1]
+    for message in messages:
+        assert sum(embed_length(embed) for embed in message) <= 6000
+
+
+def test_pack_embeds_truncates_long_fields():
+    [[embed]] = pack_embeds([{"title": "a" * 300, "footer": {"text": "b" * 3000}}])
+    assert len(embed["title"]) == 256
+    assert embed["title"].endswith("…")
+    assert len(embed["footer"]["text"]) == 2048
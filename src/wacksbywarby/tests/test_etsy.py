@@ -0,0 +1,85 @@
+from typing import List
+
+import pytest
+
+from wacksbywarby.etsy import RECEIPTS_PAGE_SIZE, Etsy
+from wacksbywarby.models import EtsyCredentials
+
+
+def make_receipt(receipt_id: int) -> dict:
+    return {
+        "receipt_id": receipt_id,
+        "created_timestamp": 1684103388 - receipt_id,
+        "transactions": [
+            {"listing_id": 944640080, "transaction_id": receipt_id, "quantity": 1}
+        ],
+    }
+
+
+@pytest.fixture
+def etsy(monkeypatch):
+    """An Etsy client whose shop has 250 receipts"""
+    receipts = [make_receipt(i) for i in range(250)]
+    requested_offsets: List[int] = []
+
+    def request_page(self, timestamp, offset):
+        requested_offsets.append(offset)
+        return {
+            "count": len(receipts),
+            "results": receipts[offset : offset + RECEIPTS_PAGE_SIZE],
+        }
+
+    monkeypatch.setattr(Etsy, "_request_receipts_page", request_page)
+    creds = EtsyCredentials(
+        access_token="xxx",
+        refresh_token="yyy",
+        expires_in=3600,
+        expires_at=0,
+        token_type="Bearer",
+    )
+    client = Etsy(credentials=creds)
+    client.requested_offsets = requested_offsets  # type: ignore
+    return client
+
+
+def test_walks_every_page(etsy: Etsy):
+    receipts = list(etsy._iter_orders_since_timestamp(0))
+    assert [receipt["receipt_id"] for receipt in receipts] == list(range(250))
+    assert sorted(etsy.requested_offsets) == [0, 100, 200]  # type: ignore
+
+
+def test_can_stop_early(etsy: Etsy):
+    receipts = etsy._iter_orders_since_timestamp(0)
+    first = [next(receipts) for _ in range(3)]
+    receipts.close()
+    assert [receipt["receipt_id"] for receipt in first] == [0, 1, 2]
+
+
+def test_sales_get_stock_from_listings_batch(etsy: Etsy, monkeypatch):
+    requested = []
+
+    class FakeResponse:
+        def __init__(self, listing_ids):
+            self.listing_ids = listing_ids
+
+        def json(self):
+            return {
+                "results": [
+                    {"listing_id": int(i), "quantity": 1, "state": "sold_out"}
+                    for i in self.listing_ids
+                ]
+            }
+
+    def fake_get(url, params=None, headers=None, timeout=None):
+        assert timeout == etsy.timeout
+        listing_ids = params["listing_ids"].split(",")
+        requested.append(listing_ids)
+        return FakeResponse(listing_ids)
+
+    monkeypatch.setattr(etsy.session, "get", fake_get)
+    sales = etsy.get_sales_since_timestamp(0)
+    assert requested == [["944640080"]]
+    # only the newest sale emptied the listing
+    assert sales[0].quantity == 0
+    assert sales[1].quantity == 1
+    assert sales[-1].quantity == len(sales) - 1
@@ -0,0 +1,138 @@
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from wacks4shop import wack as wacks4shop
+from wacksbywarby.db import SqliteWackabase, Wackabase
+from wacksbywarby.discord import Discord
+from wacksbywarby.ledger import SalesLedger
+from wacksbywarby.models import Sale, Shift4ShopSale
+
+
+def make_sale(order_id: str, line_item_id: str, when: datetime, listing_id="123"):
+    return Sale(
+        listing_id=listing_id,
+        quantity=3,
+        num_sold=1,
+        datetime=when,
+        location=None,
+        fallback_name="Nyx",
+        order_id=order_id,
+        line_item_id=line_item_id,
+    )
+
+
+def test_records_each_line_item_once(tmp_path: Path):
+    ledger = SalesLedger(tmp_path / "ledger.sqlite3")
+    first = make_sale("1", "a", datetime(2023, 7, 7, 12))
+    second = make_sale("1", "b", datetime(2023, 7, 7, 12), listing_id="456")
+    assert ledger.is_empty("etsy")
+
+    assert ledger.record("etsy", [first, first]) == 1
+    assert ledger.has("etsy", first)
+    assert not ledger.has("square", first)
+    assert ledger.unseen("etsy", [first, second, second]) == [second]
+    assert ledger.record("etsy", [first, second]) == 1
+
+    # and it's all still there for the next run
+    reopened = SalesLedger(tmp_path / "ledger.sqlite3")
+    assert [sale.line_item_id for sale in reopened.find(provider="etsy")] == ["a", "b"]
+    assert [sale.order_id for sale in reopened.find(listing_id="456")] == ["1"]
+    assert reopened.find(since=datetime(2023, 7, 8)) == []
+
+
+def test_first_use_skips_sales_already_counted(tmp_path: Path):
+    ledger = SalesLedger(tmp_path / "ledger.sqlite3")
+    waterline = datetime(2023, 7, 7, 12)
+    announced = make_sale("1", "a", waterline)
+    new = make_sale("2", "a", datetime(2023, 7, 7, 12, 1))
+    ledger.seed("square", waterline, 10)
+
+    # before anything is fetched, so stock isn't taken off for the overlap again
+    assert not ledger.is_new("square", announced)
+    assert ledger.is_new("square", new)
+    assert ledger.unseen("square", [new, announced]) == [new]
+    assert ledger.has("square", announced)
+    assert not ledger.has("square", new)
+    assert ledger.num_sales("square") == 10
+
+
+def test_count_comes_from_the_ledger(tmp_path: Path):
+    db = Wackabase(str(tmp_path))
+    ledger = SalesLedger(db.ledger_path)
+    ledger.seed("etsy", datetime(2023, 7, 7, 12), 10)
+    sales = [make_sale("2", "a", datetime(2023, 7, 7, 13))]
+
+    assert ledger.record_poll(db, "etsy", sales, datetime(2023, 7, 7, 13)) == 11
+    assert db.get_timestamp() == "07/07/2023 13:00:00"
+    # a crash before the waterline is written doesn't count the sales again
+    db.write_num_sales(0)
+    assert ledger.record_poll(db, "etsy", sales, None) == 11
+    # and a backfilled total takes over
+    assert ledger.record_poll(db, "etsy", [], None, num_sales=20) == 20
+    assert ledger.num_sales("etsy") == 20
+
+
+def test_sales_and_poll_state_commit_together(tmp_path: Path):
+    db = SqliteWackabase(tmp_path / "wacks.sqlite3", "square")
+    ledger = SalesLedger(db.ledger_path)
+    ledger.seed("square", datetime(2023, 7, 7, 12), 10)
+    sales = [make_sale("2", "a", datetime(2023, 7, 7, 13))]
+
+    def crash(conn, timestamp, num_sales):
+        raise RuntimeError("crashed")
+
+    db.set_poll_state = crash  # type: ignore
+    with pytest.raises(RuntimeError):
+        ledger.record_poll(db, "square", sales, datetime(2023, 7, 7, 13))
+    assert not ledger.has("square", sales[0])
+    assert ledger.num_sales("square") == 10
+
+    del db.set_poll_state
+    assert ledger.record_poll(db, "square", sales, datetime(2023, 7, 7, 13)) == 11
+    assert db.get_last_num_sales() == 11
+    assert db.get_timestamp() == "07/07/2023 13:00:00"
+
+
+class FakeShift4Shop:
+    catalog = None
+
+    def __init__(self, orders: List[Shift4ShopSale]) -> None:
+        self.orders = orders
+        self.queried_from: List[str] = []
+
+    def determine_sales(self, timestamp):
+        self.queried_from.append(timestamp)
+        newest = max(sale.datetime for sale in self.orders)
+        return list(self.orders), newest.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def test_overlapping_polls_announce_each_sale_once(tmp_path: Path):
+    db = Wackabase(str(tmp_path))
+    db.write_poll_state(datetime(2023, 7, 7, 12), 10)
+    # the first poll seeds the ledger with the order the waterline came from
+    at_waterline = Shift4ShopSale(**vars(make_sale("1", "0", datetime(2023, 7, 7, 12))))
+    client = FakeShift4Shop([at_waterline])
+    discord = Discord(debug=True)
+    found: List[Sale] = []
+
+    wacks4shop.main(db, client=client, discord=discord, on_sales=found.extend)  # type: ignore
+    assert client.queried_from == ["07/07/2023 11:55:00"]
+    assert found == []
+
+    # an order in the same second as the waterline used to be skipped
+    same_second = Shift4ShopSale(**vars(make_sale("2", "0", datetime(2023, 7, 7, 12))))
+    client.orders.append(same_second)
+    waterline = wacks4shop.main(
+        db, client=client, discord=discord, on_sales=found.extend  # type: ignore
+    )
+    assert [sale.order_id for sale in found] == ["2"]
+    assert db.get_last_num_sales() == 11
+    assert waterline == "2023-07-07T12:00:00"
+
+    # polling the same window again finds nothing new
+    wacks4shop.main(db, client=client, discord=discord, on_sales=found.extend)  # type: ignore
+    assert len(found) == 1
+    assert db.get_last_num_sales() == 11
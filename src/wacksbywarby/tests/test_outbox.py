@@ -0,0 +1,68 @@
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from wacksbywarby.db import Wackabase
+from wacksbywarby.discord import Discord, DiscordError
+from wacksbywarby.models import Sale
+from wacksbywarby.outbox import Outbox
+from wacksbywarby.wack import flush_outbox
+
+
+def make_sale(order_id: str, line_item_id: str) -> Sale:
+    return Sale(
+        listing_id="944640080",
+        quantity=10,
+        num_sold=1,
+        datetime=datetime(2023, 7, 7, 12, 0, 0),
+        location=None,
+        fallback_name="Nyx",
+        order_id=order_id,
+        line_item_id=line_item_id,
+    )
+
+
+@pytest.fixture
+def db(tmp_path: Path) -> Wackabase:
+    return Wackabase(str(tmp_path))
+
+
+def test_enqueue_dedupes_line_items(db: Wackabase):
+    outbox = Outbox(db, provider="etsy")
+    assert len(outbox.enqueue([make_sale("1", "a"), make_sale("1", "b")])) == 2
+    # the same window fetched again after a crash
+    reopened = Outbox(db, provider="etsy")
+    assert reopened.enqueue([make_sale("1", "b"), make_sale("2", "a")]) == [
+        make_sale("2", "a")
+    ]
+    assert [sale for _, sale in reopened.pending()] == [
+        make_sale("1", "a"),
+        make_sale("1", "b"),
+        make_sale("2", "a"),
+    ]
+
+
+def test_flush_marks_sent(db: Wackabase):
+    outbox = Outbox(db, provider="etsy")
+    outbox.enqueue([make_sale("1", "a"), make_sale("2", "a")])
+    assert flush_outbox(Discord(), outbox, 10) == 2
+    assert Outbox(db, provider="etsy").pending() == []
+    assert flush_outbox(Discord(), outbox, 10) == 0
+
+
+def test_flush_keeps_unsent_sales(db: Wackabase, monkeypatch):
+    sent = []
+
+    def send_message(self, embeds):
+        if sent:
+            raise DiscordError("nope")
+        sent.append(embeds)
+
+    monkeypatch.setattr(Discord, "send_message", send_message)
+    outbox = Outbox(db, provider="etsy")
+    outbox.enqueue([make_sale(str(order_id), "a") for order_id in range(12)])
+    # the first message holds 10 sales, the second one fails
+    assert flush_outbox(Discord(), outbox, 10) == 10
+    pending = Outbox(db, provider="etsy").pending()
+    assert [sale.order_id for _, sale in pending] == ["10", "11"]
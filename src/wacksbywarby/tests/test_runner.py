@@ -0,0 +1,113 @@
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from filelock import FileLock
+
+from wacksbywarby.discord import Discord
+from wacksbywarby.runner import Provider, Runner
+
+
+class FakeClient:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_provider(
+    tmp_path: Path, name: str, poll, clients: List[FakeClient]
+) -> Provider:
+    def make_client(db, dry):
+        client = FakeClient()
+        clients.append(client)
+        return client
+
+    return Provider(
+        name=name,  # type: ignore
+        database_dir=str(tmp_path / name),
+        lockfile=str(tmp_path / f"{name}.lock"),
+        make_client=make_client,
+        poll=poll,
+    )
+
+
+def test_polls_concurrently_and_isolates_failures(tmp_path: Path):
+    clients: List[FakeClient] = []
+
+    def slow_poll(db, dry, client, discord):
+        time.sleep(0.3)
+
+    def broken_poll(db, dry, client, discord):
+        raise RuntimeError("square is down")
+
+    providers = [
+        make_provider(tmp_path, "etsy", slow_poll, clients),
+        make_provider(tmp_path, "shift4shop", slow_poll, clients),
+        make_provider(tmp_path, "square", broken_poll, clients),
+    ]
+    runner = Runner(providers, Discord(debug=True))
+
+    started = time.monotonic()
+    results = runner.poll_all()
+    elapsed = time.monotonic() - started
+
+    assert results == {"etsy": True, "shift4shop": True, "square": False}
+    assert elapsed < 0.55
+    assert (tmp_path / "etsy" / "last_success.txt").exists()
+    assert not (tmp_path / "square" / "last_success.txt").exists()
+
+    # healthy clients are reused, the broken one is rebuilt next poll
+    runner.poll_all()
+    assert len(clients) == 4
+    # and the broken one's connections are closed when it's dropped
+    assert sum(client.closed for client in clients) == 2
+    runner.close()
+    assert all(client.closed for client in clients)
+
+
+def test_skips_a_provider_whose_lock_is_held(tmp_path: Path):
+    polled: List[str] = []
+    provider = make_provider(tmp_path, "etsy", lambda *args: polled.append("etsy"), [])
+    runner = Runner([provider], Discord(debug=True), lock_timeout=0.1)
+    with FileLock(provider.lockfile):
+        assert runner.poll_all() == {"etsy": False}
+    assert polled == []
+    runner.close()
+
+
+def test_daemon_never_overlaps_polls_and_stops_cleanly(tmp_path: Path):
+    running = {"etsy": 0, "square": 0}
+    overlaps: List[str] = []
+    polls: List[str] = []
+
+    def poll_for(name: str, duration: float):
+        def poll(db, dry, client, discord):
+            running[name] += 1
+            if running[name] > 1:
+                overlaps.append(name)
+            polls.append(name)
+            time.sleep(duration)
+            running[name] -= 1
+
+        return poll
+
+    providers = [
+        make_provider(tmp_path, "etsy", poll_for("etsy", 0.05), []),
+        # slower than the interval, so it's always due while still running
+        make_provider(tmp_path, "square", poll_for("square", 0.15), []),
+    ]
+    runner = Runner(providers, Discord(debug=True))
+    daemon = threading.Thread(
+        target=runner.run_forever, kwargs={"interval": 0.01, "jitter": 0.5}
+    )
+    daemon.start()
+    time.sleep(0.5)
+    runner.request_stop()
+    daemon.join(timeout=1)
+    runner.close()
+
+    assert not daemon.is_alive()
+    assert overlaps == []
+    assert polls.count("etsy") > polls.count("square") >= 2
@@ -0,0 +1,80 @@
+import time
+from datetime import datetime
+from typing import Dict, List
+
+from wacksbywarby.models import Sale
+from wacksbywarby.stock import UNKNOWN_QUANTITY, StockResolver, apply_stock
+
+
+def make_sale(
+    listing_id: str, num_sold: int = 1, when: datetime = datetime(2023, 7, 7)
+) -> Sale:
+    return Sale(
+        listing_id=listing_id,
+        quantity=UNKNOWN_QUANTITY,
+        num_sold=num_sold,
+        datetime=when,
+        location=None,
+        fallback_name=None,
+    )
+
+
+class FakeInventory:
+    def __init__(self, stock: Dict[str, int]):
+        self.stock = stock
+        self.requests: List[List[str]] = []
+
+    def fetch(self, listing_ids: List[str]) -> Dict[str, int]:
+        self.requests.append(sorted(listing_ids))
+        return {i: self.stock[i] for i in listing_ids if i in self.stock}
+
+
+def test_resolve_batches_and_caches():
+    inventory = FakeInventory({"a": 3, "b": 0})
+    resolver = StockResolver(inventory.fetch)
+    assert resolver.resolve(["a", "b", "a", "c"]) == {"a": 3, "b": 0}
+    assert resolver.resolve(["a", "b"]) == {"a": 3, "b": 0}
+    assert inventory.requests == [["a", "b", "c"]]
+
+    inventory.stock["a"] = 2
+    resolver.invalidate(["a"])
+    assert resolver.resolve(["a", "b"]) == {"a": 2, "b": 0}
+    assert inventory.requests[-1] == ["a"]
+
+
+def test_record_sales_updates_cache():
+    inventory = FakeInventory({"a": 3, "b": 3})
+    resolver = StockResolver(inventory.fetch)
+    resolver.resolve(["a", "b"])
+    sold = datetime.fromtimestamp(time.time() + 60)
+    resolver.record_sales(
+        [make_sale("a", num_sold=2, when=sold), make_sale("a", when=sold)]
+    )
+    # b's stock was fetched after this sale, so it already counts it
+    resolver.record_sales([make_sale("b")])
+    assert resolver.resolve(["a", "b"]) == {"a": 0, "b": 3}
+    assert len(inventory.requests) == 1
+
+
+def test_resolve_survives_fetch_errors():
+    def broken(listing_ids):
+        raise RuntimeError("nope")
+
+    assert StockResolver(broken).resolve(["a"]) == {}
+
+
+def test_apply_stock_only_newest_sale_sells_out():
+    # newest first
+    sales = [make_sale("a"), make_sale("b"), make_sale("a", num_sold=2), make_sale("c")]
+    apply_stock(sales, {"a": 0, "b": 4})
+    assert [sale.quantity for sale in sales] == [0, 4, 1, UNKNOWN_QUANTITY]
+
+
+def test_invalidate_before_keeps_stock_fetched_after_the_sale():
+    inventory = FakeInventory({"a": 3, "b": 1})
+    resolver = StockResolver(inventory.fetch)
+    resolver.resolve(["a", "b"])
+    fetched_at = time.time()
+    resolver.invalidate_before({"a": fetched_at - 60, "b": fetched_at + 60})
+    assert resolver.resolve(["a", "b"]) == {"a": 3, "b": 1}
+    assert inventory.requests[-1] == ["b"]
@@ -0,0 +1,75 @@
+from datetime import datetime
+from typing import List
+
+import pytest
+
+from wacksbywarby.discord import Discord
+from wacksbywarby.models import Sale, Werby
+from wacksbywarby.wack import _digest_threshold, announce_new_sales
+from wacksbywarby.werbies import Werbies
+
+NYX = Werby(name="Nyx (4oz Tin Candle)", images=("nyx.jpg",), color="#7565B2")
+
+
+def make_sale(listing_id="NYX_TIN", num_sold=1, quantity=10, location="Connecticon"):
+    return Sale(
+        listing_id=listing_id,
+        quantity=quantity,
+        num_sold=num_sold,
+        datetime=datetime(2023, 7, 7),
+        location=location,
+        fallback_name="Mystery",
+    )
+
+
+@pytest.fixture
+def sent_messages(monkeypatch) -> List[list]:
+    sent: List[list] = []
+    monkeypatch.setattr(
+        Discord, "send_message", lambda self, embeds: sent.append(embeds)
+    )
+    monkeypatch.setattr(
+        Werbies,
+        "get_embed_data_many",
+        lambda ids, id_type: {i: NYX if i == "NYX_TIN" else None for i in ids},
+    )
+    return sent
+
+
+def titles(sent_messages: List[list]) -> List[str]:
+    return [embed["title"] for message in sent_messages for embed in message]
+
+
+def test_announce_each_sale(sent_messages):
+    sales = [make_sale(), make_sale(num_sold=2), make_sale(listing_id="OTHER")]
+    announce_new_sales(Discord(), sales, 100, id_type="square", digest_threshold=None)
+    assert titles(sent_messages) == [
+        "🚨 New Nyx (4oz Tin Candle) Sale! [@Connecticon]🚨",
+        "🚨 New Nyx (4oz Tin Candle) Sale! (2 of 'em) [@Connecticon]🚨",
+        "🚨 New Mystery Sale! [@Connecticon]🚨",
+        "[square] 100 total sales. Great job Werby! 🎉",
+    ]
+
+
+def test_announce_digest_over_threshold(sent_messages):
+    sales = [make_sale() for _ in range(6)] + [
+        make_sale(location="Backup"),
+        make_sale(listing_id="OTHER"),
+        make_sale(quantity=0),
+    ]
+    announce_new_sales(Discord(), sales, 100, id_type="square", digest_threshold=5)
+    assert len(sent_messages) == 1
+    assert titles(sent_messages) == [
+        "🚨 Nyx (4oz Tin Candle) ×7 [@Connecticon]🚨",
+        "🚨 Nyx (4oz Tin Candle) ×1 [@Backup]🚨",
+        "🚨 Mystery ×1 [@Connecticon]🚨",
+        "[square] 100 total sales. Great job Werby! 🎉",
+    ]
+    assert sent_messages[0][0]["footer"]["text"].startswith("🙀")
+
+
+def test_bad_digest_threshold_disables_digests(monkeypatch):
+    monkeypatch.setenv("WACKS_DIGEST_THRESHOLD", "25")
+    assert _digest_threshold() == 25
+    monkeypatch.setenv("WACKS_DIGEST_THRESHOLD", "lots")
+    assert _digest_threshold() is None
@@ -0,0 +1,108 @@
+import json
+import urllib.error
+import urllib.request
+from typing import Dict, List
+
+import pytest
+
+from wacksbywarby.models import Sale
+from wacksbywarby.webhooks import (
+    SQUARE_SIGNATURE_HEADER,
+    WebhookServer,
+    shift4shop_route,
+    square_route,
+    square_signature,
+)
+
+SIGNATURE_KEY = "square-key"
+NOTIFICATION_URL = "https://wacks.example.com/webhooks/square"
+
+
+def sale(order_id: str) -> Sale:
+    return Sale(
+        listing_id="NYX_TIN",
+        quantity=3,
+        num_sold=1,
+        datetime=None,
+        location=None,
+        fallback_name="Nyx",
+        order_id=order_id,
+        line_item_id="1",
+    )
+
+
+@pytest.fixture
+def server():
+    received: Dict[str, List[Sale]] = {}
+    routes = {
+        "/webhooks/square": square_route(
+            SIGNATURE_KEY, NOTIFICATION_URL, lambda order_id: [sale(order_id)]
+        ),
+        "/webhooks/shift4shop": shift4shop_route(
+            "s3cret", lambda orders: [sale(str(o["OrderID"])) for o in orders]
+        ),
+    }
+    server = WebhookServer(
+        routes, lambda provider, sales: received.update({provider: sales}), port=0
+    )
+    server.received = received
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def post(server: WebhookServer, path: str, body: bytes, headers=None) -> int:
+    host, port = server.address
+    request = urllib.request.Request(
+        f"http://{host}:{port}{path}", data=body, headers=headers or {}, method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def square_event(state: str) -> bytes:
+    return json.dumps(
+        {
+            "type": "order.updated",
+            "data": {
+                "object": {"order_updated": {"order_id": "ORDER", "state": state}}
+            },
+        }
+    ).encode()
+
+
+def test_square_webhook_is_verified_and_announced(server):
+    body = square_event("COMPLETED")
+    signature = square_signature(SIGNATURE_KEY, NOTIFICATION_URL, body)
+
+    assert (
+        post(server, "/webhooks/square", body, {SQUARE_SIGNATURE_HEADER: "nope"}) == 401
+    )
+    assert server.received == {}
+
+    assert (
+        post(server, "/webhooks/square", body, {SQUARE_SIGNATURE_HEADER: signature})
+        == 200
+    )
+    assert [s.order_id for s in server.received["square"]] == ["ORDER"]
+
+
+def test_square_webhook_ignores_open_orders(server):
+    body = square_event("OPEN")
+    signature = square_signature(SIGNATURE_KEY, NOTIFICATION_URL, body)
+    assert (
+        post(server, "/webhooks/square", body, {SQUARE_SIGNATURE_HEADER: signature})
+        == 200
+    )
+    assert server.received == {}
+
+
+def test_shift4shop_webhook_needs_the_token(server):
+    body = json.dumps([{"OrderID": 42}]).encode()
+    assert post(server, "/webhooks/shift4shop?token=wrong", body) == 401
+    assert post(server, "/webhooks/shift4shop?token=s3cret", body) == 200
+    assert [s.order_id for s in server.received["shift4shop"]] == ["42"]
+    assert post(server, "/webhooks/etsy", body) == 404
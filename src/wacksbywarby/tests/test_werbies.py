@@ -0,0 +1,89 @@
+import dataclasses
+import json
+from pathlib import Path
+
+import pytest
+
+from wacksbywarby.werbies import WerbiesCatalog
+
+
+@pytest.fixture
+def werbies_file(tmp_path: Path) -> Path:
+    path = tmp_path / "werbies.json"
+    path.write_text(
+        json.dumps(
+            {
+                "944640080": {
+                    "name": "Nyx",
+                    "images": ["nyx.jpg"],
+                    "color": "#7565B2",
+                    "shift4shop_id": 20,
+                    "square_data": [
+                        {"id": "NYX_TIN", "variation": "4oz Tin Candle"},
+                        {"id": "NYX_REGULAR", "variation": "Regular"},
+                    ],
+                },
+                "940044573": {"name": "Zagreus", "images": ["zag.gif"]},
+            }
+        )
+    )
+    return path
+
+
+def test_catalog_lookups(werbies_file: Path):
+    """Can find a werby by each provider's id"""
+    catalog = WerbiesCatalog(str(werbies_file))
+    assert catalog.get("944640080", id_type="etsy").name == "Nyx"
+    assert catalog.get("940044573", id_type="etsy").color is None
+    assert catalog.get(20, id_type="shift4shop").name == "Nyx"
+    assert catalog.get("20", id_type="shift4shop").name == "Nyx"
+    assert catalog.get("NYX_TIN", id_type="square").name == "Nyx (4oz Tin Candle)"
+    assert catalog.get("NYX_REGULAR", id_type="square").name == "Nyx"
+    assert catalog.get("nope", id_type="square") is None
+
+
+def test_catalog_results_are_immutable(werbies_file: Path):
+    """Looking up a variation doesn't rename the werby for later lookups"""
+    catalog = WerbiesCatalog(str(werbies_file))
+    werby = catalog.get("NYX_TIN", id_type="square")
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        werby.name = "changed"  # type: ignore
+    assert catalog.get("944640080", id_type="etsy").name == "Nyx"
+
+
+def test_catalog_missing_file(tmp_path: Path):
+    catalog = WerbiesCatalog(str(tmp_path / "missing.json"))
+    assert catalog.get("944640080") is None
+
+
+def test_catalog_reloads_changed_file(werbies_file: Path):
+    """Picks up edits to werbies.json and keeps the last good data on a bad edit"""
+    catalog = WerbiesCatalog(str(werbies_file), check_interval=0)
+    data = json.loads(werbies_file.read_text())
+    data["123"] = {"name": "Hypnos", "images": ["hypnos.png"]}
+    werbies_file.write_text(json.dumps(data))
+    assert catalog.get("123").name == "Hypnos"
+
+    werbies_file.write_text("{ oops this is not json")
+    assert catalog.reload() is False
+    assert catalog.get("123").name == "Hypnos"
+    assert catalog.get("NYX_TIN", id_type="square").name == "Nyx (4oz Tin Candle)"
+
+
+def test_catalog_skips_unchanged_file(werbies_file: Path, mocker):
+    catalog = WerbiesCatalog(str(werbies_file), check_interval=0)
+    read = mocker.spy(catalog, "_build_indexes")
+    assert catalog.reload() is False
+    read.assert_not_called()
+
+
+def test_catalog_get_many(werbies_file: Path):
+    catalog = WerbiesCatalog(str(werbies_file))
+    found = catalog.get_many(
+        ["NYX_TIN", "NYX_TIN", "nope", "NYX_REGULAR"], id_type="square"
+    )
+    assert found == {
+        "NYX_TIN": catalog.get("NYX_TIN", id_type="square"),
+        "NYX_REGULAR": catalog.get("NYX_REGULAR", id_type="square"),
+        "nope": None,
+    }
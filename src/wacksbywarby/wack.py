@@ -1,23 +1,28 @@
 import argparse
 import logging
+import os
 import random
-import time
 from datetime import datetime
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 from dataclasses import asdict
 
+import requests
 from dotenv import load_dotenv
+from filelock import FileLock, Timeout
 
 from wacksbywarby.constants import WACK_ERROR_SENTINEL, SHIFT4SHOP_TIME_FORMAT
-from wacksbywarby.db import Wackabase
-from wacksbywarby.discord import Discord
+from wacksbywarby.db import Wackabase, open_wackabase
+from wacksbywarby.discord import Discord, DiscordError, pack_embeds
 from wacksbywarby.etsy import Etsy
+from wacksbywarby.ledger import OVERLAP_SECONDS, SalesLedger
 from wacksbywarby.models import (
     DiscordEmbed,
     DiscordFooter,
     DiscordImage,
     Sale,
+    Werby,
 )
+from wacksbywarby.outbox import Outbox
 from wacksbywarby.scraper import get_num_sales as get_scraper_num_sales
 from wacksbywarby.werbies import IdType, Werbies
 
@@ -26,73 +31,189 @@ load_dotenv()
 logger = logging.getLogger("wacksbywarby")
 
 PARTY_NUM = 200
+LOCKFILE = "wacksbywarby.lock"
+
+
+def _digest_threshold() -> Optional[int]:
+    """WACKS_DIGEST_THRESHOLD, or None (no digests) if it's unset or not a number"""
+    value = os.getenv("WACKS_DIGEST_THRESHOLD")
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logger.error(
+            "%s WACKS_DIGEST_THRESHOLD should be a number, got %r, not sending digests",
+            WACK_ERROR_SENTINEL,
+            value,
+        )
+        return None
+
+
+# opt-in: when a poll has more sales than this, announce them as a digest
+DIGEST_THRESHOLD = _digest_threshold()
+
+
+def _sale_embed(
+    title: str, embed_data: Optional[Werby], sold_out: bool
+) -> DiscordEmbed:
+    if embed_data:
+        image_url = random.choice(embed_data.images)
+        color = None
+        if embed_data.color:
+            # discord wants a decimal number for color
+            color = int(embed_data.color.strip("#"), 16)
+    else:
+        image_url = ""
+        color = None
+    embed = DiscordEmbed(
+        title=title,
+        image=DiscordImage(url=image_url),
+        color=color,
+        footer=None,
+    )
+
+    if sold_out:
+        embed.footer = DiscordFooter(
+            text="🙀 Hey this is sold out now! Werby we need you back at work!"
+        )
+
+    logger.info("msg %s %s", title, image_url)
+    return embed
+
+
+def _sale_name(sale: Sale, embed_data: Optional[Werby]) -> str:
+    if embed_data:
+        return embed_data.name
+    # if there was any fallback info available about the sale use it, otherwise default to unknown
+    return sale.fallback_name if sale.fallback_name else "Unknown"
+
+
+def _build_sale_embeds(
+    sales: List[Sale], id_to_embed_data: Dict[str, Optional[Werby]]
+) -> List[Tuple[DiscordEmbed, List[Sale]]]:
+    """One embed per sale"""
+    embeds = []
+    for sale in sales:
+        embed_data = id_to_embed_data[str(sale.listing_id)]
+        name = _sale_name(sale, embed_data)
+        quantity_message = f" ({sale.num_sold:.0f} of 'em)" if sale.num_sold > 1 else ""
+        location = f" [@{sale.location}]" if sale.location else ""
+        message = f"🚨 New {name} Sale!{quantity_message}{location}🚨"
+        logger.info("listing id %s", sale.listing_id)
+        embed = _sale_embed(message, embed_data, sold_out=sale.quantity == 0)
+        embeds.append((embed, [sale]))
+    return embeds
+
+
+def _build_digest_embeds(
+    sales: List[Sale], id_to_embed_data: Dict[str, Optional[Werby]]
+) -> List[Tuple[DiscordEmbed, List[Sale]]]:
+    """
+    One embed per werby, variation and location, e.g. "Nyx (4oz Tin Candle) ×7 [@Connecticon]",
+    in the order each was first sold
+    """
+    # (listing id, name, location) -> sales. the name is part of the key so one-off
+    # custom items that share a listing id aren't lumped together
+    groups: Dict[Tuple[str, str, Optional[str]], List[Sale]] = {}
+    for sale in sales:
+        name = _sale_name(sale, id_to_embed_data[str(sale.listing_id)])
+        groups.setdefault((str(sale.listing_id), name, sale.location), []).append(sale)
+
+    embeds = []
+    for (listing_id, name, sale_location), grouped_sales in groups.items():
+        num_sold = sum(sale.num_sold for sale in grouped_sales)
+        location = f" [@{sale_location}]" if sale_location else ""
+        message = f"🚨 {name} ×{num_sold:.0f}{location}🚨"
+        # sales are oldest to newest so the last one has the most recent stock
+        sold_out = grouped_sales[-1].quantity == 0
+        logger.info("listing id %s", listing_id)
+        embed = _sale_embed(message, id_to_embed_data[listing_id], sold_out)
+        embeds.append((embed, grouped_sales))
+    return embeds
 
 
 def announce_new_sales(
-    discord: Discord, sales: List[Sale], num_total_sales: int, id_type: IdType = "etsy"
+    discord: Discord,
+    sales: List[Sale],
+    num_total_sales: int,
+    id_type: IdType = "etsy",
+    digest_threshold: Optional[int] = DIGEST_THRESHOLD,
+    on_sent: Optional[Callable[[List[Sale]], None]] = None,
 ):
     """
     Format each sale as a Discord embed and post the message
+
+    If there are more than digest_threshold sales, sales of the same werby at the same
+    location are rolled up into a single embed instead so big bursts stay a handful of messages
+
+    on_sent is called with the sales in each message once discord has accepted it
     """
-    embeds = []
+    # a receipt often has the same werby several times, so resolve each unique id once
+    id_to_embed_data = Werbies.get_embed_data_many(
+        [sale.listing_id for sale in sales], id_type=id_type
+    )
     # figure out the images and name to show with the discord message
-    for sale in sales:
-        embed_data = Werbies.get_embed_data(sale.listing_id, id_type=id_type)
-        if embed_data:
-            image_urls = embed_data.images
-            image_url = random.choice(image_urls)
-            name = embed_data.name
-            color = None
-            if embed_data.color:
-                # discord wants a decimal number for color
-                color = int(embed_data.color.strip("#"), 16)
-        else:
-            # if there was any fallback info available about the sale use it, otherwise default to unknown
-            name = sale.fallback_name if sale.fallback_name else "Unknown"
-            image_url = ""
-            color = None
-        # format and send the discord message
-        sold_out = sale.quantity == 0
-        quantity_message = f" ({sale.num_sold:.0f} of 'em)" if sale.num_sold > 1 else ""
-        location = f" [@{sale.location}]" if sale.location else ""
-        message = f"🚨 New {name} Sale!{quantity_message}{location}🚨"
-        embed = DiscordEmbed(
-            title=message,
-            image=DiscordImage(url=image_url),
-            color=color,
+    if digest_threshold is not None and len(sales) > digest_threshold:
+        logger.info("%s sales, announcing as a digest", len(sales))
+        embeds = _build_digest_embeds(sales, id_to_embed_data)
+    else:
+        embeds = _build_sale_embeds(sales, id_to_embed_data)
+
+    if embeds:
+        total_embed = DiscordEmbed(
+            title=f"[{id_type}] {num_total_sales} total sales. Great job Werby! 🎉",
+            color=15277667,  # LUMINOUS_VIVID_PINK
             footer=None,
+            image=None,
         )
+        embeds.append((total_embed, []))
+        # pack sales into as few messages as discord's embed limits allow and send them separately
+        messages = pack_embeds([asdict(embed) for embed, _ in embeds])
+        with discord.lock:
+            for embeds_as_dict in messages:
+                # discord.py paces these against the webhook's rate limit bucket
+                discord.send_message(embeds_as_dict)
+                sent = embeds[: len(embeds_as_dict)]
+                embeds = embeds[len(embeds_as_dict) :]
+                if on_sent:
+                    on_sent([sale for _, embed_sales in sent for sale in embed_sales])
 
-        if sold_out:
-            embed.footer = DiscordFooter(
-                text="🙀 Hey this is sold out now! Werby we need you back at work!"
-            )
 
-        logger.info("listing id %s", sale.listing_id)
-        logger.info("msg %s %s", message, image_url)
-        embeds.append(embed)
+def flush_outbox(discord: Discord, outbox: Outbox, num_total_sales: int) -> int:
+    """
+    Announce everything still pending in the outbox, marking sales as sent message by
+    message. If discord fails part way, whatever is left stays pending for the next run.
+    Returns the number of sales announced.
+    """
+    pending = outbox.pending()
+    if not pending:
+        return 0
+    key_by_sale = {id(sale): key for key, sale in pending}
+    num_sent = 0
 
-    def batch(iterable, n=1):
-        l = len(iterable)
-        for ndx in range(0, l, n):
-            yield iterable[ndx:min(ndx + n, l)]
+    def mark_sent(sales: List[Sale]):
+        nonlocal num_sent
+        if sales:
+            outbox.mark_sent(key_by_sale[id(sale)] for sale in sales)
+            num_sent += len(sales)
 
-    if embeds:
-        embeds.append(
-            DiscordEmbed(
-                title=f"[{id_type}] {num_total_sales} total sales. Great job Werby! 🎉",
-                color=15277667,  # LUMINOUS_VIVID_PINK
-                footer=None,
-                image=None,
-            )
+    try:
+        announce_new_sales(
+            discord,
+            [sale for _, sale in pending],
+            num_total_sales,
+            id_type=outbox.provider,
+            on_sent=mark_sent,
+        )
+    except (DiscordError, requests.RequestException) as e:
+        logger.error(
+            "%s could not announce %s sales, leaving them in the outbox: %s",
+            WACK_ERROR_SENTINEL,
+            len(pending) - num_sent,
+            e,
         )
-        # batch sales into groups of 10 which is discord's embed limit and send them as separate messages
-        batched_embeds = batch(embeds, 10)
-        for single_batch_embeds in batched_embeds:
-            embeds_as_dict = [asdict(embed) for embed in single_batch_embeds]
-            discord.send_message(embeds_as_dict)
-            # try to avoid getting throttled by etsy api
-            time.sleep(0.5)
+    return num_sent
 
 
 def await_pizza_party(discord, num_sales):
@@ -101,47 +222,75 @@ def await_pizza_party(discord, num_sales):
         discord.send_party_message()
 
 
-def main(db: Wackabase, dry=False):
+def main(
+    db: Wackabase,
+    dry=False,
+    client: Optional[Etsy] = None,
+    discord: Optional[Discord] = None,
+    on_sales: Optional[Callable[[List[Sale]], None]] = None,
+):
+    """
+    Poll etsy for new sales and announce them. A long running caller can pass in its
+    own client and discord to reuse them across polls, and on_sales to hear about the
+    new sales each poll found.
+    """
     try:
         logger.info("TIME TO WACK")
         logger.info("Dry run: %s", dry)
-        creds = db.get_etsy_creds()
-        client = Etsy(credentials=creds, debug=dry)
-        discord = Discord(debug=dry)
+        if client is None:
+            client = Etsy(credentials=db.get_etsy_creds(), debug=dry)
+        if discord is None:
+            discord = Discord(debug=dry)
+        outbox = Outbox(db, provider="etsy")
 
         last_timestamp = db.get_timestamp()
         if not last_timestamp:
             logger.error('No timestamp found for etsy')
             return
-        last_timestamp_in_unix_seconds = int(datetime.strptime(
-            last_timestamp, SHIFT4SHOP_TIME_FORMAT
-        ).timestamp())
-        sales = client.get_sales_since_timestamp(timestamp=last_timestamp_in_unix_seconds)
-        if not sales:
-            return
+        waterline = datetime.strptime(last_timestamp, SHIFT4SHOP_TIME_FORMAT)
+        last_timestamp_in_unix_seconds = int(waterline.timestamp())
+        ledger = SalesLedger(db.ledger_path)
+        try:
+            # before fetching, so the first poll after an upgrade doesn't take the
+            # overlap's sales for new ones and knock them off the stock again
+            ledger.seed("etsy", waterline, db.get_last_num_sales())
+            # look back a little past the waterline, the ledger drops what we've seen
+            fetched = client.get_sales_since_timestamp(
+                timestamp=last_timestamp_in_unix_seconds - OVERLAP_SECONDS,
+                is_new=lambda sale: ledger.is_new("etsy", sale),
+            )
+            sales = ledger.unseen("etsy", fetched)
+            if not sales:
+                # retry anything a previous run couldn't get out
+                flush_outbox(discord, outbox, ledger.num_sales("etsy"))
+                return
 
-        logger.info(f"last timestamp was {last_timestamp}")
+            logger.info(f"last timestamp was {last_timestamp}")
+            if on_sales:
+                on_sales(sales)
 
-        last_num_sales = db.get_last_num_sales()
-        if last_num_sales:
-            current_num_sales = client.get_num_sales(
-                last_timestamp=last_timestamp_in_unix_seconds, prev_num_sales=last_num_sales
-            )
-        else:
             # backfill using fallback
-            current_num_sales = get_scraper_num_sales()
+            backfilled = None if ledger.num_sales("etsy") else get_scraper_num_sales()
 
-        logger.info(f"current num sales: {current_num_sales}")
+            # sales are sorted by timestamp desc, so flip it in order to announce them from oldest to newest.
+            # queued first, the outbox drops them if a crash has them queued again
+            outbox.enqueue(reversed(sales))
 
-        # sales are sorted by timestamp desc, so flip it in order to announce them from oldest to newest
-        announce_new_sales(discord, list(reversed(sales)), current_num_sales, id_type="etsy")
-        await_pizza_party(discord, current_num_sales)
+            # the waterline only moves forward, a late sale inside the overlap doesn't pull it back
+            latest_sale_timestamp = max(
+                (sale.datetime for sale in sales if sale.datetime), default=None
+            )
+            if latest_sale_timestamp and latest_sale_timestamp <= waterline:
+                latest_sale_timestamp = None
+            current_num_sales = ledger.record_poll(
+                db, "etsy", sales, latest_sale_timestamp, backfilled
+            )
+            logger.info(f"current num sales: {current_num_sales}")
+        finally:
+            ledger.close()
 
-        # write out the most recent sale's date (results were sorted by created_at at desc, so latest one is first one)
-        latest_sale_timestamp = sales[0].datetime
-        if latest_sale_timestamp:
-            db.write_timestamp(latest_sale_timestamp)
-            db.write_num_sales(current_num_sales)
+        flush_outbox(discord, outbox, current_num_sales)
+        await_pizza_party(discord, current_num_sales)
 
     except Exception as e:
         logger.error("%s: %s", WACK_ERROR_SENTINEL, e)
@@ -159,6 +308,13 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
 
     args = parser.parse_args()
-    wackabase = Wackabase()
-    main(db=wackabase, dry=args.dry)
-    wackabase.write_success()
+
+    # grab the lock
+    try:
+        lock = FileLock(LOCKFILE, timeout=5)
+        with lock:
+            with open_wackabase("etsy") as wackabase:
+                main(db=wackabase, dry=args.dry)
+                wackabase.write_success()
+    except Timeout:
+        logger.info("Could not acquire lock! Exiting.")
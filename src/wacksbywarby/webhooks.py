@@ -0,0 +1,292 @@
+"""
+Receive order webhooks so sales are announced as they happen instead of on the next
+cron poll. Polling still runs as a slower reconciliation sweep, and since everything
+goes through the outbox a sale that arrives both ways is only announced once.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from dotenv import load_dotenv
+from filelock import FileLock
+
+from wacksbywarby.constants import WACK_ERROR_SENTINEL
+from wacksbywarby.db import open_wackabase
+from wacksbywarby.discord import Discord
+from wacksbywarby.models import Sale
+from wacksbywarby.outbox import Outbox
+from wacksbywarby.wack import flush_outbox
+from wacksbywarby.werbies import IdType
+
+load_dotenv()
+
+logger = logging.getLogger("webhooks")
+
+DEFAULT_PORT = 8787
+# webhook payloads are a single order, anything this big isn't one of them
+MAX_BODY_BYTES = 1024 * 1024
+SQUARE_SIGNATURE_HEADER = "x-square-hmacsha256-signature"
+# how long a webhook waits on a poll that's already running for the same provider
+LOCK_TIMEOUT_SECONDS = 30
+
+# checks a request really came from the provider, given its headers, query and raw body
+Verify = Callable[[Mapping[str, str], Dict[str, List[str]], bytes], bool]
+OnSales = Callable[[IdType, List[Sale]], None]
+
+
+@dataclass
+class WebhookRoute:
+    provider: IdType
+    verify: Verify
+    # turns a parsed payload into the sales to announce, [] if there's nothing to announce
+    to_sales: Callable[[Any], List[Sale]]
+
+
+def square_signature(signature_key: str, notification_url: str, body: bytes) -> str:
+    """https://developer.squareup.com/docs/webhooks/step3validate"""
+    digest = hmac.new(
+        signature_key.encode(), notification_url.encode() + body, hashlib.sha256
+    ).digest()
+    return base64.b64encode(digest).decode()
+
+
+def square_route(
+    signature_key: str,
+    notification_url: str,
+    get_sales_for_order: Callable[[str], List[Sale]],
+) -> WebhookRoute:
+    """
+    Square's order.updated event only has the order's id and state, so completed orders
+    are fetched and turned into sales the same way a poll would
+    """
+
+    def verify(headers: Mapping[str, str], query, body: bytes) -> bool:
+        signature = headers.get(SQUARE_SIGNATURE_HEADER, "")
+        expected = square_signature(signature_key, notification_url, body)
+        return hmac.compare_digest(signature, expected)
+
+    def to_sales(payload: dict) -> List[Sale]:
+        if payload.get("type") != "order.updated":
+            logger.info(f"ignoring square {payload.get('type')} event")
+            return []
+        order = payload["data"]["object"]["order_updated"]
+        if order.get("state") != "COMPLETED":
+            return []
+        return get_sales_for_order(order["order_id"])
+
+    return WebhookRoute(provider="square", verify=verify, to_sales=to_sales)
+
+
+def shift4shop_route(
+    token: str, orders_to_sales: Callable[[List[dict]], List[Sale]]
+) -> WebhookRoute:
+    """
+    Shift4Shop doesn't sign its webhooks, so the url registered with it carries a
+    shared secret, e.g. https://example.com/webhooks/shift4shop?token=xxx. The payload
+    is the same order json the orders api returns.
+    """
+
+    def verify(headers, query: Dict[str, List[str]], body: bytes) -> bool:
+        return hmac.compare_digest(query.get("token", [""])[0], token)
+
+    def to_sales(payload: Any) -> List[Sale]:
+        orders = payload if isinstance(payload, list) else [payload]
+        return orders_to_sales(orders)
+
+    return WebhookRoute(provider="shift4shop", verify=verify, to_sales=to_sales)
+
+
+class WebhookServer:
+    """
+    A small http server that verifies webhooks for each route (keyed by path), turns
+    them into sales and hands them to on_sales before responding. If anything fails
+    the provider gets a 500 and retries the delivery later.
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, WebhookRoute],
+        on_sales: OnSales,
+        host: str = "127.0.0.1",
+        port: int = DEFAULT_PORT,
+    ) -> None:
+        self.routes = routes
+        self.on_sales = on_sales
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        host, port = self.httpd.server_address[:2]
+        return str(host), int(port)
+
+    def serve_forever(self):
+        logger.info(f"listening for webhooks on {self.address}: {list(self.routes)}")
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def handle(
+        self, path: str, headers: Mapping[str, str], body: bytes
+    ) -> Tuple[int, str]:
+        url = urlsplit(path)
+        route = self.routes.get(url.path)
+        if not route:
+            return 404, "not found"
+        if not route.verify(headers, parse_qs(url.query), body):
+            logger.warning(f"bad signature for {route.provider} webhook")
+            return 401, "bad signature"
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, "bad json"
+        try:
+            sales = route.to_sales(payload)
+            if sales:
+                logger.info(f"{len(sales)} sales from {route.provider} webhook")
+                self.on_sales(route.provider, sales)
+        except Exception as e:
+            logger.error(
+                "%s could not handle %s webhook: %s",
+                WACK_ERROR_SENTINEL,
+                route.provider,
+                e,
+            )
+            return 500, "error"
+        return 200, "ok"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length > MAX_BODY_BYTES:
+                    self._respond(413, "too large")
+                    return
+                body = self.rfile.read(length)
+                # http.client headers are case insensitive but a plain dict isn't
+                headers = {key.lower(): value for key, value in self.headers.items()}
+                self._respond(*server.handle(self.path, headers, body))
+
+            def _respond(self, status: int, message: str):
+                response = message.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return Handler
+
+
+def announce_to_outbox(
+    discord: Discord, database_dir: str, lockfile: str
+) -> Callable[[IdType, List[Sale]], None]:
+    """
+    on_sales for one provider: record the sales in its outbox and announce them, holding
+    the same lock as its poll so the two never write the outbox at the same time
+    """
+
+    def on_sales(provider: IdType, sales: List[Sale]):
+        with FileLock(lockfile, timeout=LOCK_TIMEOUT_SECONDS), open_wackabase(
+            provider, database_dir
+        ) as db:
+            outbox = Outbox(db, provider=provider)
+            new_sales = outbox.enqueue(sales)
+            if not new_sales:
+                return
+            # the poll writes the real count, this is just for the message
+            num_total_sales = db.get_last_num_sales() + len(new_sales)
+            flush_outbox(discord, outbox, num_total_sales)
+
+    return on_sales
+
+
+def build_server(host: str, port: int, dry=False) -> WebhookServer:
+    """Routes for every provider with webhook settings in the environment"""
+    # imported here since the integrations build on this package, not the other way around
+    from wacks4shop import wack as wacks4shop
+    from wacks4square import constants as wacks4square
+    from wacks4square import wack as square_wack
+
+    discord = Discord(debug=dry)
+    routes: Dict[str, WebhookRoute] = {}
+    on_sales_by_provider: Dict[IdType, OnSales] = {}
+
+    square_key = os.getenv("SQUARE_WEBHOOK_SIGNATURE_KEY")
+    square_url = os.getenv("SQUARE_WEBHOOK_URL")
+    if square_key and square_url:
+
+        def get_square_sales(order_id: str) -> List[Sale]:
+            # creds are re-read each time since refresh.py rotates them
+            with open_wackabase("square", wacks4square.DATABASE_DIR) as db:
+                square = square_wack.make_client(db, dry=dry)
+            return square.get_sales_for_order(order_id)
+
+        routes["/webhooks/square"] = square_route(
+            square_key, square_url, get_square_sales
+        )
+        on_sales_by_provider["square"] = announce_to_outbox(
+            discord, wacks4square.DATABASE_DIR, wacks4square.LOCKFILE
+        )
+
+    shift4shop_token = os.getenv("SHIFT4SHOP_WEBHOOK_TOKEN")
+    if shift4shop_token:
+        shift4shop = wacks4shop.make_client(dry=dry)
+        routes["/webhooks/shift4shop"] = shift4shop_route(
+            shift4shop_token,
+            lambda orders: wacks4shop.to_sales(shift4shop.sales_from_orders(orders)),
+        )
+        on_sales_by_provider["shift4shop"] = announce_to_outbox(
+            discord, wacks4shop.DATABASE_DIR, wacks4shop.LOCKFILE
+        )
+
+    def on_sales(provider: IdType, sales: List[Sale]):
+        on_sales_by_provider[provider](provider, sales)
+
+    return WebhookServer(routes, on_sales, host=host, port=port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wacks webhooks!!")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=int(os.getenv("WACKS_WEBHOOK_PORT", DEFAULT_PORT))
+    )
+    parser.add_argument(
+        "--dry",
+        action="store_true",
+        required=False,
+        help="run as dry run",
+    )
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    args = parser.parse_args()
+    server = build_server(args.host, args.port, dry=args.dry)
+    if not server.routes:
+        logger.error("No webhook settings found, nothing to listen for")
+    else:
+        server.serve_forever()
@@ -1,50 +1,162 @@
 import json
-from typing import Literal, Optional
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, Literal, Optional, Tuple
 
+from wacksbywarby.constants import WACK_ERROR_SENTINEL
 from wacksbywarby.models import Werby
 
+logger = logging.getLogger("werbies")
+
 DB_PATH = "werbies.json"
 IdType = Literal["etsy", "shift4shop", "square"]
+# how often a lookup is allowed to stat werbies.json to see if it has been edited
+RELOAD_CHECK_SECONDS = 5.0
+
+
+class WerbiesCatalog:
+    """
+    An in-memory index over werbies.json, built once and kept for the life of the process.
+
+    Each provider gets its own reverse index so a sale can be resolved with a single dict
+    lookup instead of re-reading the file and scanning every werby. At most once every
+    check_interval seconds a lookup will stat the file, and if its mtime or size changed
+    the indexes are rebuilt and swapped in whole. A malformed edit keeps the last good
+    indexes around.
+    """
+
+    def __init__(
+        self, path: str = DB_PATH, check_interval: float = RELOAD_CHECK_SECONDS
+    ) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self.indexes: Dict[str, Dict[str, Werby]] = self._build_indexes({})
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.reload()
+
+    def get(self, listing_id: str, id_type: IdType = "etsy") -> Optional[Werby]:
+        self.maybe_reload()
+        return self.indexes[id_type].get(str(listing_id))
+
+    def get_many(
+        self, listing_ids: Iterable[str], id_type: IdType = "etsy"
+    ) -> Dict[str, Optional[Werby]]:
+        """
+        Resolve a batch of ids against a single snapshot of the indexes. Repeated ids are
+        only looked up once, and the result is keyed by the ids as strings.
+        """
+        self.maybe_reload()
+        index = self.indexes[id_type]
+        return {
+            listing_id: index.get(listing_id)
+            for listing_id in set(map(str, listing_ids))
+        }
+
+    def maybe_reload(self) -> bool:
+        """Reload if it has been long enough since we last checked the file"""
+        if time.monotonic() < self._next_check:
+            return False
+        return self.reload()
+
+    def reload(self) -> bool:
+        """
+        Rebuild the indexes if werbies.json changed since the last load.
+        Returns True if new indexes were swapped in.
+        """
+        # if another thread is already reloading, just keep using the current indexes
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                if self._stamp is not None:
+                    logger.error(
+                        "%s %s went missing, keeping last loaded werbies",
+                        WACK_ERROR_SENTINEL,
+                        self.path,
+                    )
+                return False
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if stamp == self._stamp:
+                return False
+            # remember the stamp even if the load fails so a broken file is only reported once
+            self._stamp = stamp
+            try:
+                indexes = self._build_indexes(Werbies.read_werbies_file(self.path))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logger.error(
+                    "%s Could not load %s, keeping last loaded werbies: %s",
+                    WACK_ERROR_SENTINEL,
+                    self.path,
+                    e,
+                )
+                return False
+            self.indexes = indexes
+            logger.info("loaded %s werbies from %s", len(indexes["etsy"]), self.path)
+            return True
+        finally:
+            self._reload_lock.release()
+
+    @staticmethod
+    def _build_indexes(id_to_data: dict) -> Dict[str, Dict[str, Werby]]:
+        etsy: Dict[str, Werby] = {}
+        shift4shop: Dict[str, Werby] = {}
+        square: Dict[str, Werby] = {}
+        for listing_id, data in id_to_data.items():
+            werby = Werby(
+                name=data["name"], images=tuple(data["images"]), color=data.get("color")
+            )
+            etsy[listing_id] = werby
+            if data.get("shift4shop_id") is not None:
+                # shift4shop ids are stored as ints in werbies.json, normalize so either form matches
+                shift4shop[str(data["shift4shop_id"])] = werby
+            # square data is stored as an array with each variation which has its own id e.g. "4oz tin", "Wax melt"
+            for variation in data.get("square_data", []):
+                variation_name = variation["variation"]
+                if variation_name == "Regular":
+                    square[variation["id"]] = werby
+                else:
+                    # include the name of the variation to distinguish the different sales
+                    square[variation["id"]] = Werby(
+                        name=f"{werby.name} ({variation_name})",
+                        images=werby.images,
+                        color=werby.color,
+                    )
+        return {"etsy": etsy, "shift4shop": shift4shop, "square": square}
+
+
+_catalog: Optional[WerbiesCatalog] = None
 
 
 class Werbies:
+    @staticmethod
+    def catalog() -> WerbiesCatalog:
+        """Lazily build the process-wide catalog the first time it's needed"""
+        global _catalog
+        if _catalog is None:
+            _catalog = WerbiesCatalog()
+        return _catalog
+
     @staticmethod
     def get_embed_data(listing_id: str, id_type: IdType = "etsy") -> Optional[Werby]:
-        id_to_data = Werbies.read_werbies_file()
-
-        data = None
-        if id_type == "etsy":
-            data = id_to_data.get(listing_id)
-        elif id_type == "square":
-            for werby in id_to_data.values():
-                # square data is stored as an array with each variation which has its own id e.g. "4oz tin", "Wax melt"
-                variations = [
-                    variation
-                    for variation in werby.get("square_data", [])
-                    if variation["id"] == listing_id
-                ]
-                if variations:
-                    data = werby
-                    variation_name = variations[0]["variation"]
-                    if variation_name != "Regular":
-                        # include the name of the variation to distinguish the different sales
-                        data["name"] = f"{werby['name']} ({variation_name})"
-                    break
-        elif id_type == "shift4shop":
-            for werby in id_to_data.values():
-                if werby.get("shift4shop_id") == listing_id:
-                    data = werby
-                    break
-
-        if data is None:
-            return None
-
-        return Werby(name=data["name"], images=data["images"], color=data.get("color"))
+        return Werbies.catalog().get(listing_id, id_type=id_type)
+
+    @staticmethod
+    def get_embed_data_many(
+        listing_ids: Iterable[str], id_type: IdType = "etsy"
+    ) -> Dict[str, Optional[Werby]]:
+        return Werbies.catalog().get_many(listing_ids, id_type=id_type)
 
     @staticmethod
-    def read_werbies_file() -> dict:
+    def read_werbies_file(path: str = DB_PATH) -> dict:
         try:
-            with open(DB_PATH, "r") as f:
+            with open(path, "r") as f:
                 id_to_data = json.load(f)
         except FileNotFoundError:
             id_to_data = {}